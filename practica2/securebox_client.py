@@ -19,21 +19,40 @@ Descarga y subida de ficheros:
     --upload FILE           Sube un fichero al servidor tras firmarlo usando SHA256 
                             y RSA y cifrarlo con AES256-CBC. Hay que especificar
                             el destinadatio usando --dest_id
+    --upload_batch FILE|DIR [FILE|DIR ...]
+                            Sube varios ficheros, o todos los de los directorios
+                            indicados, firmando y cifrando en paralelo mientras
+                            se suben los ya cifrados. Hay que especificar el
+                            destinatario usando --dest_id
     --source_id ID          ID del usuario emisor. Usar en combinación 
                             con --download
-    --dest_id ID            ID del usuario destinatario. Usar en combinación con
-                            --upload, --encrypt o --enc_sign
+    --dest_id ID [ID ...]   ID del usuario destinatario. Usar en combinación con
+                            --upload, --upload_batch, --encrypt o --enc_sign.
+                            --upload y --enc_sign aceptan varios destinatarios:
+                            el fichero se firma y se cifra una sola vez y solo
+                            se cifra la clave de sesión para cada uno
     --list_files            Lista todos los ficheros subidos
     --download FILE_ID      Descarga el fichero con id FILE_ID. Hay que especificar
                             el emisor usando --source_id
     --delete_file FILE_ID   Borrar el fichero con id FILE_ID
     --delete_files_all      Borrar todos los ficheros subidos
+    --refresh_keys          Volver a pedir al servidor las claves públicas
+                            aunque estén en la cache y aceptarlas aunque
+                            hayan cambiado. Usar en combinación con --upload,
+                            --download, --encrypt o --enc_sign
 
 Firma y cifrado offline:
 
     --encrypt FILE          Cifra un fichero usando AES256-CBC
     --sign FILE             Firma un fichero usando RSA 2048 y SHA256
     --enc_sign FILE         Firma y cifra un archivo
+
+Agente de claves:
+
+    --agent_start           Desbloquea la clave privada y la deja en un agente
+                            en segundo plano. Mientras esté en marcha no se
+                            pide la contraseña en el resto de comandos
+    --agent_stop            Para el agente
 """
 import signal
 import sys
@@ -74,8 +93,31 @@ def load_securebox_config():
                 print("Fichero de configuración invalido. %s no encontrado" % key)
                 sys.exit(1)
 
+        # Valores opcionales de la conexión con la api
+        optional = {'http_pool_size': 10, 'http_retries': 3,
+                    'http_backoff': 0.5, 'http_timeout': [5, 60],
+                    'delete_concurrency': 8, 'delete_rate': 20,
+                    'key_cache_file': 'public_keys.json', 'key_cache_ttl': 86400,
+                    'agent_idle_timeout': 900,
+                    'upload_concurrency': 4, 'crypto_workers': None,
+                    'cipher': 'aes-cbc', 'crypto_threads': 1}
+        for key, value in optional.items():
+            cfg.setdefault(key, value)
+
+        if cfg['cipher'] not in cripto.CIPHERS:
+            print("Fichero de configuración invalido. cipher tiene que ser uno de: %s" %
+                  ', '.join(cripto.CIPHERS))
+            sys.exit(1)
+
         # Convertimos el diccionario a un Namespace
-        return SimpleNamespace(api_key=cfg['api_key'], api_base_url=cfg['api_base_url'], rsa_key_size=cfg['rsa_key_size'], aes_key_size=cfg['aes_key_size'])
+        return SimpleNamespace(api_key=cfg['api_key'], api_base_url=cfg['api_base_url'], rsa_key_size=cfg['rsa_key_size'], aes_key_size=cfg['aes_key_size'],
+                               http_pool_size=cfg['http_pool_size'], http_retries=cfg['http_retries'],
+                               http_backoff=cfg['http_backoff'], http_timeout=cfg['http_timeout'],
+                               delete_concurrency=cfg['delete_concurrency'], delete_rate=cfg['delete_rate'],
+                               key_cache_file=cfg['key_cache_file'], key_cache_ttl=cfg['key_cache_ttl'],
+                               agent_idle_timeout=cfg['agent_idle_timeout'],
+                               upload_concurrency=cfg['upload_concurrency'], crypto_workers=cfg['crypto_workers'],
+                               cipher=cfg['cipher'], crypto_threads=cfg['crypto_threads'])
 
 
 if __name__ == '__main__':
@@ -97,6 +139,7 @@ if __name__ == '__main__':
 
     # Subida y descarga de ficheros
     g.add_argument('--upload',  type=str)
+    g.add_argument('--upload_batch', '--upload-batch', nargs='+', type=str)
     g.add_argument('--download', type=str)
     g.add_argument('--delete_file', type=str)
     g.add_argument('--delete_files_all', action='store_true')
@@ -107,11 +150,21 @@ if __name__ == '__main__':
     g.add_argument('--sign', type=str)
     g.add_argument('--enc_sign',  type=str)
 
+    # Agente de claves
+    g.add_argument('--agent_start', action='store_true')
+    g.add_argument('--agent_stop', action='store_true')
+
+    # Opciones de la cache de claves públicas
+    parser.add_argument('--refresh_keys', action='store_true')
+
     # Parseamos sin haber registrado flags dependientes de otros
     opts, rem_args = parser.parse_known_args()
 
     # Si es upload o download, añadimos los argumentos obligatorios de cada uno
-    if opts.upload or opts.encrypt or opts.enc_sign:
+    if opts.upload or opts.enc_sign:
+        parser.add_argument('--dest_id', required=True, nargs='+', type=str)
+
+    if opts.upload_batch or opts.encrypt:
         parser.add_argument('--dest_id', required=True, type=str)
 
     if opts.download:
@@ -125,6 +178,7 @@ if __name__ == '__main__':
 
     # Intentamos cargar la configuración del programa
     cfg = load_securebox_config()
+    cfg.refresh_keys = args.refresh_keys
 
     # Dispacher en función de los flags recibidos
     if(args.create_id != None):
@@ -149,6 +203,8 @@ if __name__ == '__main__':
         files.borrar_fichero(cfg, args.delete_file)
     elif(args.upload):
         files.subir_fichero(cfg, args.upload, args.dest_id)
+    elif(args.upload_batch):
+        files.subir_lote(cfg, args.upload_batch, args.dest_id)
     elif(args.delete_files_all):
         files.borrar_todos(cfg)
     elif(args.list_files):
@@ -161,6 +217,10 @@ if __name__ == '__main__':
         files.download(cfg, args.download, args.source_id)
     elif(args.enc_sign):
         files.enc_sign(cfg, args.enc_sign, args.dest_id)
+    elif(args.agent_start):
+        users.arrancar_agente(cfg)
+    elif(args.agent_stop):
+        users.parar_agente(cfg)
     else:
         # si no se recibe ningun flag, mostramos la ayuda y salimos del programa
         parser.print_help()
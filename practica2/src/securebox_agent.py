@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""Modulo con el agente de securebox, un proceso al estilo de ssh-agent
+que guarda en memoria la clave privada ya descifrada para no tener que
+pedir la contraseña y repetir la derivación scrypt en cada comando.
+
+El agente escucha en un socket Unix dentro de un directorio que solo
+puede leer el propio usuario. Recibe peticiones de firma y de descifrado
+y nunca entrega la clave privada. Si pasa un tiempo sin recibir
+peticiones termina solo y borra el socket.
+
+Protocolo: una petición y una respuesta por línea, en JSON, con los datos
+binarios en hexadecimal.
+    {"op": "info"}                  -> {"ok": true, "user_id": ..., "key_size": ...}
+    {"op": "sign", "hash": HEX}     -> {"ok": true, "signature": HEX}
+    {"op": "decrypt", "data": HEX}  -> {"ok": true, "data": HEX}
+    {"op": "stop"}                  -> {"ok": true}
+Si algo falla la respuesta es {"ok": false, "error": "..."}
+
+"""
+import binascii
+import json
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+from Crypto.Hash import SHA256
+import securebox_crypto as cripto
+
+# Variable de entorno con la ruta del socket del agente
+AGENT_SOCK_ENV = 'SECUREBOX_AGENT_SOCK'
+
+# Segundos sin peticiones tras los que el agente termina
+AGENT_IDLE_TIMEOUT = 15 * 60
+
+
+def agent_socket_path():
+    """Devuelve la ruta del socket del agente. Se puede cambiar con
+    la variable de entorno SECUREBOX_AGENT_SOCK
+    """
+    if os.environ.get(AGENT_SOCK_ENV):
+        return os.environ[AGENT_SOCK_ENV]
+    directorio = os.path.join(tempfile.gettempdir(), 'securebox-%d' % os.getuid())
+    return os.path.join(directorio, 'agent.sock')
+
+
+class HashRecibido():
+    """ Hash SHA256 del que solo se conoce el resultado, con lo
+    necesario para que pkcs1_15 lo pueda firmar
+    """
+    oid = SHA256.new().oid
+    digest_size = SHA256.digest_size
+
+    def __init__(self, digest):
+        if len(digest) != self.digest_size:
+            raise ValueError('Hash SHA256 de tamaño incorrecto')
+        self._digest = digest
+
+    def digest(self):
+        return self._digest
+
+
+class _Manejador(socketserver.StreamRequestHandler):
+    """ Atiende las peticiones de una conexión con el agente
+    """
+
+    def handle(self):
+        agente = self.server.agente
+        for linea in self.rfile:
+            agente.ultima_peticion = time.monotonic()
+            try:
+                respuesta = agente.responder(json.loads(linea.decode('utf-8')))
+            except (ValueError, TypeError, KeyError) as e:
+                respuesta = {'ok': False, 'error': str(e) or type(e).__name__}
+            self.wfile.write(json.dumps(respuesta).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class Agente():
+    """ Agente que guarda la clave privada de un usuario y firma y
+    descifra con ella
+    """
+
+    def __init__(self, user_id, private_key, path=None, idle_timeout=AGENT_IDLE_TIMEOUT):
+        """Crea el socket del agente. No atiende peticiones hasta que
+        se llama a serve()
+
+        ARGUMENTOS:
+            user_id: id del usuario dueño de la clave
+            private_key: clave privada RSA ya descifrada
+            path: ruta del socket. Por defecto agent_socket_path()
+            idle_timeout: segundos sin peticiones tras los que el agente termina
+
+        """
+        self.user_id = user_id
+        self.private_key = private_key
+        self.path = path or agent_socket_path()
+        self.idle_timeout = idle_timeout
+        self.ultima_peticion = time.monotonic()
+
+        directorio = os.path.dirname(self.path)
+        os.makedirs(directorio, mode=0o700, exist_ok=True)
+        if os.stat(directorio).st_uid != os.getuid():
+            raise PermissionError('El directorio %s no pertenece al usuario' % directorio)
+
+        # Un socket que ya no tiene a nadie escuchando se puede reutilizar
+        if os.path.exists(self.path):
+            if ClienteAgente.conectar(self.path) is not None:
+                raise FileExistsError('Ya hay un agente escuchando en %s' % self.path)
+            os.remove(self.path)
+
+        antigua = os.umask(0o177)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(self.path, _Manejador)
+        finally:
+            os.umask(antigua)
+        self.server.daemon_threads = True
+        self.server.agente = self
+
+    def responder(self, peticion):
+        """Ejecuta una petición y devuelve el diccionario de la respuesta
+
+        ARGUMENTOS:
+            peticion: diccionario con la petición
+
+        """
+        op = peticion['op']
+        if op == 'info':
+            return {'ok': True, 'user_id': self.user_id,
+                    'key_size': self.private_key.size_in_bytes()}
+        elif op == 'sign':
+            digest = HashRecibido(binascii.unhexlify(peticion['hash']))
+            signature = cripto.sign_hash(self.private_key, digest)
+            return {'ok': True, 'signature': binascii.hexlify(signature).decode('ascii')}
+        elif op == 'decrypt':
+            data = cripto.rsa_decrypt(self.private_key, binascii.unhexlify(peticion['data']))
+            return {'ok': True, 'data': binascii.hexlify(data).decode('ascii')}
+        elif op == 'stop':
+            threading.Thread(target=self.server.shutdown).start()
+            return {'ok': True}
+        return {'ok': False, 'error': 'Operación desconocida %s' % op}
+
+    def vigilar(self):
+        """Hilo que para el agente cuando pasa idle_timeout sin peticiones"""
+        while True:
+            restante = self.ultima_peticion + self.idle_timeout - time.monotonic()
+            if restante <= 0:
+                self.server.shutdown()
+                return
+            time.sleep(min(restante, 1))
+
+    def serve(self):
+        """Atiende peticiones hasta que se pide parar o se agota el tiempo
+        de inactividad. Al terminar borra el socket
+        """
+        vigilante = threading.Thread(target=self.vigilar)
+        vigilante.daemon = True
+        vigilante.start()
+        try:
+            self.server.serve_forever(poll_interval=0.5)
+        finally:
+            self.server.server_close()
+            self.private_key = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class ClienteAgente():
+    """ Conexión con un agente. Tiene el mismo interfaz que necesita
+    User para firmar y descifrar con la clave local
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.fp = sock.makefile('rwb')
+        self.lock = threading.Lock()
+        info = self.peticion(op='info')
+        self.user_id = info['user_id']
+        self.key_size = info['key_size']
+
+    @staticmethod
+    def conectar(path=None):
+        """Se conecta al agente
+
+        ARGUMENTOS:
+            path: ruta del socket. Por defecto agent_socket_path()
+
+        RETURN:
+            Un ClienteAgente o None si no hay ningún agente escuchando
+        """
+        path = path or agent_socket_path()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            return ClienteAgente(sock)
+        except (OSError, ValueError, KeyError):
+            sock.close()
+            return None
+
+    def peticion(self, **peticion):
+        """Manda una petición al agente y devuelve su respuesta
+
+        EXCEPCIONES:
+            ValueError si el agente devuelve un error
+            ConnectionError si el agente ha cerrado la conexión
+        """
+        with self.lock:
+            self.fp.write(json.dumps(peticion).encode('utf-8') + b'\n')
+            self.fp.flush()
+            linea = self.fp.readline()
+        if not linea:
+            raise ConnectionError('El agente de securebox ha cerrado la conexión')
+        respuesta = json.loads(linea.decode('utf-8'))
+        if not respuesta['ok']:
+            raise ValueError(respuesta['error'])
+        return respuesta
+
+    def sign_hash(self, sha256_hash):
+        """Firma un hash SHA256 ya calculado con la clave del agente
+
+        ARGUMENTOS:
+            sha256_hash: objeto SHA256 con el hash de los datos
+
+        """
+        res = self.peticion(op='sign', hash=sha256_hash.hexdigest())
+        return binascii.unhexlify(res['signature'])
+
+    def rsa_decrypt(self, data):
+        """Descifra con RSA usando la clave del agente
+
+        ARGUMENTOS:
+            data: datos cifrados
+
+        """
+        res = self.peticion(op='decrypt', data=binascii.hexlify(data).decode('ascii'))
+        return binascii.unhexlify(res['data'])
+
+    def stop(self):
+        """Pide al agente que termine"""
+        self.peticion(op='stop')
+        self.close()
+
+    def close(self):
+        self.fp.close()
+        self.sock.close()
@@ -6,9 +6,44 @@ usadas en el cliente securebox.
 from Crypto.Signature import pkcs1_15
 from Crypto.Random import get_random_bytes
 from Crypto.Util.Padding import pad, unpad
-from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.Cipher import AES, ChaCha20_Poly1305, PKCS1_OAEP
 from Crypto.Hash import SHA256
 from Crypto.PublicKey import RSA
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Tamaño de los bloques en los que se leen y cifran los ficheros. Es múltiplo
+# del tamaño de bloque de AES para no tener que guardar restos entre bloques
+CHUNK_SIZE = 64 * 1024
+
+# Formato de contenedor versión 2, con cifrado autenticado por segmentos:
+#   'SBX' | versión (1) | algoritmo (1) | tamaño de segmento (4) |
+#   prefijo de nonce (7) | clave de sesión cifrada con RSA | segmentos
+# Cada segmento es el cifrado de SEGMENT_SIZE bytes de datos (el último puede
+# ser más corto) seguido de su etiqueta. El nonce de cada segmento es
+# prefijo | número de segmento (4) | 1 si es el último o 0 si no, así que no
+# se pueden reordenar, quitar ni añadir segmentos sin que se detecte.
+# La cabecera ocupa lo mismo que el iv del formato original (versión 1,
+# AES-CBC), que no tiene cabecera: un fichero que no empieza por 'SBX' con
+# una versión conocida se lee como de la versión 1.
+CONTAINER_MAGIC = b'SBX'
+CONTAINER_V2 = 2
+CONTAINER_HEADER_SIZE = 16
+NONCE_PREFIX_SIZE = 7
+SEGMENT_SIZE = CHUNK_SIZE
+TAG_SIZE = 16
+
+# Tamaños de segmento aceptados al leer. El tamaño viene en la cabecera, que
+# no se autentica hasta descifrar el primer segmento, y cada segmento se
+# guarda entero en memoria antes de comprobarlo
+MIN_SEGMENT_SIZE = 1024
+MAX_SEGMENT_SIZE = 1024 * 1024
+
+# Algoritmos que se pueden usar para cifrar. aes-cbc es el formato original
+ALG_AES_GCM = 1
+ALG_CHACHA20_POLY1305 = 2
+CIPHERS = {'aes-cbc': None, 'aes-gcm': ALG_AES_GCM,
+           'chacha20-poly1305': ALG_CHACHA20_POLY1305}
 
 
 def generate_rsa_key_pair(rsa_key_size):
@@ -81,6 +116,74 @@ def encrypt_data(data, aes_key_size):
     return iv, key, enc.encrypt(pad(data, AES.block_size))
 
 
+def new_session_key(aes_key_size):
+    """Genera una clave de sesión aleatoria y un vector de inicialización
+    para cifrar con AES-CBC
+
+    ARGUMENTOS:
+        aes_key_size: tamaño de la clave AES en bytes
+
+    RETURN:
+        iv, clave de sesión
+
+    """
+    return get_random_bytes(AES.block_size), get_random_bytes(aes_key_size)
+
+
+def encrypted_size(data_size):
+    """Calcula el tamaño que ocupan unos datos tras cifrarlos con AES-CBC
+    y relleno PKCS7
+
+    ARGUMENTOS:
+        data_size: tamaño de los datos en bytes
+
+    RETURN:
+        tamaño de los datos cifrados en bytes
+
+    """
+    return (data_size // AES.block_size + 1) * AES.block_size
+
+
+def read_chunks(fp, chunk_size=CHUNK_SIZE):
+    """Generador que lee un fichero en bloques de tamaño fijo
+
+    ARGUMENTOS:
+        fp: fichero abierto en modo binario
+        chunk_size: tamaño de cada bloque en bytes
+
+    """
+    while True:
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def encrypt_chunks(chunks, session_key, iv):
+    """Generador que cifra con AES-CBC una secuencia de bloques de datos
+    y añade el relleno PKCS7 al final. El resultado es el mismo que el de
+    encrypt_data sobre todos los datos juntos, pero sin tenerlos en memoria
+
+    ARGUMENTOS:
+        chunks: iterable con los bloques de datos a cifrar
+        session_key: clave de sesión
+        iv: vector de inicialización
+
+    """
+    enc = AES.new(session_key, AES.MODE_CBC, iv)
+    resto = b''
+
+    for chunk in chunks:
+        if resto:
+            chunk = resto + chunk
+        corte = len(chunk) - len(chunk) % AES.block_size
+        resto = chunk[corte:]
+        if corte:
+            yield enc.encrypt(chunk[:corte] if resto else chunk)
+
+    yield enc.encrypt(pad(resto, AES.block_size))
+
+
 def decrypt_data(enc_data, iv, session_key):
     """Descrifra datos cifrados con AES-CBC
 
@@ -99,6 +202,46 @@ def decrypt_data(enc_data, iv, session_key):
     return unpad(dec.decrypt(enc_data), AES.block_size)
 
 
+def decrypt_chunks(chunks, session_key, iv):
+    """Generador que descifra con AES-CBC una secuencia de bloques de datos
+    cifrados y quita el relleno PKCS7 del final. El último bloque de AES se
+    retiene hasta el final porque es el que lleva el relleno
+
+    ARGUMENTOS:
+        chunks: iterable con los bloques de datos cifrados, de cualquier tamaño
+        session_key: clave de sesión
+        iv: vector de inicialización
+
+    Lanza ValueError si la longitud o el relleno no son correctos.
+
+    """
+    dec = AES.new(session_key, AES.MODE_CBC, iv)
+    resto = b''
+    ultimo = None
+
+    for chunk in chunks:
+        if resto:
+            chunk = resto + chunk
+        corte = len(chunk) - len(chunk) % AES.block_size
+        resto = chunk[corte:]
+        if not corte:
+            continue
+
+        data = dec.decrypt(chunk[:corte] if resto else chunk)
+        if ultimo:
+            yield ultimo
+        if len(data) > AES.block_size:
+            yield data[:-AES.block_size]
+        ultimo = data[-AES.block_size:]
+
+    if resto or ultimo is None:
+        raise ValueError("Los datos cifrados no tienen una longitud valida")
+
+    data = unpad(ultimo, AES.block_size)
+    if data:
+        yield data
+
+
 def get_hash_sha265(data):
     """Calcula el hash de los datos usando
     el algoritmo SHA256
@@ -115,6 +258,22 @@ def get_hash_sha265(data):
     return h
 
 
+def get_hash_sha265_chunks(chunks):
+    """Calcula el hash SHA256 de unos datos que se leen por bloques
+
+    ARGUMENTOS:
+        chunks: iterable con los bloques de datos
+
+    RETURN:
+        el hash SHA256 de todos los bloques
+
+    """
+    h = SHA256.new()
+    for chunk in chunks:
+        h.update(chunk)
+    return h
+
+
 def sign_data(private_key, data):
     """Firma los datos usando la clave privada proporcionada
     y devuelve la firma.
@@ -131,12 +290,44 @@ def sign_data(private_key, data):
     # Calculamos el hash del fichero
     sha256_hash = get_hash_sha265(data)
 
-    signObj = pkcs1_15.new(private_key)
-
     # Calculamos y devolvemos la firma
+    return sign_hash(private_key, sha256_hash)
+
+
+def sign_hash(private_key, sha256_hash):
+    """Firma un hash SHA256 ya calculado usando la clave privada proporcionada
+
+    ARGUMENTOS:
+        private_key: clave privada usada para firmar
+        sha256_hash: objeto SHA256 con el hash de los datos
+
+    RETURN:
+        Devuelve la firma generada.
+
+    """
+    signObj = pkcs1_15.new(private_key)
     return signObj.sign(sha256_hash)
 
 
+def verify_signature_hash(public_key, signature, sha256_hash):
+    """Verifica la firma de un mensaje cuyo hash ya se ha calculado.
+
+    ARGUMENTOS:
+        public_key: clave pública del emisor del mensaje
+        signature: firma del mensaje
+        sha256_hash: objeto SHA256 con el hash del mensaje
+
+    RETURN:
+        True si la firma es correcta, False si no
+
+    """
+    try:
+        pkcs1_15.new(public_key).verify(sha256_hash, signature)
+        return True
+    except (ValueError, TypeError):
+        return False
+
+
 def verify_signature(public_key, signature, data):
     """Verifica la firma de un mensaje.
 
@@ -160,3 +351,173 @@ def verify_signature(public_key, signature, data):
         return True
     except (ValueError, TypeError):
         return False
+
+
+def new_container_header(cipher, aes_key_size, segment_size=SEGMENT_SIZE):
+    """Genera la cabecera común a todos los destinatarios de un fichero y la
+    clave de sesión con la que se cifra
+
+    ARGUMENTOS:
+        cipher: algoritmo de cifrado, una de las claves de CIPHERS
+        aes_key_size: tamaño de la clave AES en bytes. ChaCha20 siempre
+        usa claves de 32 bytes
+        segment_size: bytes de datos de cada segmento del formato autenticado
+
+    RETURN:
+        cabecera, clave de sesión. Con aes-cbc la cabecera es el iv
+
+    """
+    alg = CIPHERS[cipher]
+    if alg is None:
+        return new_session_key(aes_key_size)
+
+    key_size = 32 if alg == ALG_CHACHA20_POLY1305 else aes_key_size
+    header = CONTAINER_MAGIC + bytes([CONTAINER_V2, alg]) + \
+        segment_size.to_bytes(4, 'big') + get_random_bytes(NONCE_PREFIX_SIZE)
+    return header, get_random_bytes(key_size)
+
+
+def parse_container_header(header):
+    """Interpreta la cabecera de un fichero cifrado
+
+    ARGUMENTOS:
+        header: primeros CONTAINER_HEADER_SIZE bytes del fichero
+
+    RETURN:
+        None si el fichero tiene el formato original con AES-CBC, o una
+        tupla con el algoritmo, el tamaño de segmento y el prefijo de nonce
+
+    Lanza ValueError si la cabecera es de la versión 2 pero no es válida.
+
+    """
+    if header[:3] != CONTAINER_MAGIC or header[3] != CONTAINER_V2:
+        return None
+    segment_size = int.from_bytes(header[5:9], 'big')
+    if header[4] not in (ALG_AES_GCM, ALG_CHACHA20_POLY1305) or \
+            not MIN_SEGMENT_SIZE <= segment_size <= MAX_SEGMENT_SIZE:
+        raise ValueError("Cabecera de contenedor inválida")
+    return header[4], segment_size, header[9:]
+
+
+def container_body_size(header, data_size):
+    """Calcula el tamaño que ocupan unos datos tras cifrarlos con el formato
+    indicado por la cabecera, sin contar la cabecera ni la clave cifrada
+
+    ARGUMENTOS:
+        header: cabecera del fichero
+        data_size: tamaño de los datos en bytes
+
+    """
+    formato = parse_container_header(header)
+    if formato is None:
+        return encrypted_size(data_size)
+    _, segment_size, _ = formato
+    segmentos = max(1, -(-data_size // segment_size))
+    return data_size + segmentos * TAG_SIZE
+
+
+def _segments(chunks, size):
+    """Generador que reparte una secuencia de bloques en segmentos de un
+    tamaño fijo. Devuelve tuplas (segmento, es_el_último). Siempre devuelve
+    al menos un segmento, aunque esté vacío
+    """
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        # Se guarda al menos un byte para saber cuál es el último segmento
+        while len(buf) > size:
+            yield bytes(buf[:size]), False
+            del buf[:size]
+    yield bytes(buf), True
+
+
+def _map_in_order(func, items, workers):
+    """Como map, pero con varios hilos si workers > 1. Los resultados se
+    devuelven en orden y solo hay 2 * workers elementos en vuelo
+    """
+    if workers <= 1:
+        yield from map(func, items)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pendientes = deque()
+        for item in items:
+            pendientes.append(pool.submit(func, item))
+            if len(pendientes) >= 2 * workers:
+                yield pendientes.popleft().result()
+        while pendientes:
+            yield pendientes.popleft().result()
+
+
+def _aead(alg, session_key, nonce_prefix, numero, ultimo):
+    """Devuelve el cifrador autenticado de un segmento"""
+    nonce = nonce_prefix + numero.to_bytes(4, 'big') + (b'\x01' if ultimo else b'\x00')
+    if alg == ALG_CHACHA20_POLY1305:
+        return ChaCha20_Poly1305.new(key=session_key, nonce=nonce)
+    return AES.new(session_key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_SIZE)
+
+
+def encrypt_container(chunks, session_key, header, workers=1):
+    """Generador que cifra una secuencia de bloques con el formato indicado
+    por la cabecera. Con el formato autenticado los segmentos se pueden
+    cifrar en varios hilos
+
+    ARGUMENTOS:
+        chunks: iterable con los bloques de datos a cifrar
+        session_key: clave de sesión
+        header: cabecera del fichero, de new_container_header
+        workers: hilos con los que cifrar los segmentos
+
+    """
+    formato = parse_container_header(header)
+    if formato is None:
+        yield from encrypt_chunks(chunks, session_key, header)
+        return
+
+    alg, segment_size, nonce_prefix = formato
+
+    def cifrar(segmento):
+        numero, (data, ultimo) = segmento
+        cipher = _aead(alg, session_key, nonce_prefix, numero, ultimo)
+        cipher.update(header)
+        data, tag = cipher.encrypt_and_digest(data)
+        return data + tag
+
+    yield from _map_in_order(cifrar, enumerate(_segments(chunks, segment_size)), workers)
+
+
+def decrypt_container(chunks, session_key, header, workers=1):
+    """Generador que descifra una secuencia de bloques con el formato
+    indicado por la cabecera. Con el formato autenticado cada segmento se
+    comprueba antes de devolverlo y los segmentos se pueden descifrar en
+    varios hilos
+
+    ARGUMENTOS:
+        chunks: iterable con los bloques de datos cifrados, de cualquier tamaño
+        session_key: clave de sesión
+        header: cabecera del fichero
+        workers: hilos con los que descifrar los segmentos
+
+    Lanza ValueError si los datos están corruptos o incompletos.
+
+    """
+    formato = parse_container_header(header)
+    if formato is None:
+        yield from decrypt_chunks(chunks, session_key, header)
+        return
+
+    alg, segment_size, nonce_prefix = formato
+
+    def descifrar(segmento):
+        numero, (data, ultimo) = segmento
+        if len(data) < TAG_SIZE:
+            raise ValueError("Los datos cifrados no tienen una longitud valida")
+        cipher = _aead(alg, session_key, nonce_prefix, numero, ultimo)
+        cipher.update(header)
+        try:
+            return cipher.decrypt_and_verify(data[:-TAG_SIZE], data[-TAG_SIZE:])
+        except ValueError:
+            raise ValueError("El segmento %d está corrupto o incompleto" % numero)
+
+    yield from _map_in_order(descifrar, enumerate(_segments(chunks, segment_size + TAG_SIZE)),
+                             workers)
@@ -13,18 +13,27 @@ from securebox_utils import query_yes_no
 import securebox_crypto as cripto
 from securebox_utils import api_call, format_error
 from Crypto.PublicKey import RSA
-from Crypto.Hash import SHA1
+from Crypto.Hash import SHA1, SHA256
 from Crypto.Cipher import AES, PKCS1_OAEP
 from Crypto.Util.Padding import pad, unpad
 from Crypto.Random import get_random_bytes
 from Crypto.Signature import pkcs1_15
 from Crypto import Random
-from securebox_utils import api_call, Payload, find_unused_filename, ask_for_filename_if_needed
+from securebox_utils import api_call, get_api_client, LimitadorTasa, MultipartStream, find_unused_filename, ask_for_filename_if_needed
 from securebox_users import User
+from securebox_agent import ClienteAgente
+from securebox_keys import get_key_cache, ClaveCambiada
 import securebox_crypto as cripto
 import requests
 import base64
 import re
+import tempfile
+import time
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
+from itertools import chain
 
 LIST_FILES = 'files/list'
 UPLOAD_FILE = 'files/upload'
@@ -34,7 +43,10 @@ GET_PUBLIC_KEY = 'users/getPublicKey'
 
 
 def get_public_key(cfg, userId):
-    """Obtiene la clave pública del un usuario
+    """Obtiene la clave pública del un usuario. Si está en la cache de
+    claves y no ha caducado no se pide al servidor. Si el servidor devuelve
+    una clave distinta a la fijada en la cache, el programa termina salvo
+    que se haya pedido refrescar las claves con cfg.refresh_keys
 
     ARGS:
         cfg: diccionario con la configuración del cliente
@@ -44,8 +56,15 @@ def get_public_key(cfg, userId):
         La clave pública del usuario con id userId. Si ocurre algun error,
         el programa termina.
     """
-    res, status = api_call(cfg.api_base_url, cfg.api_key,
-                           GET_PUBLIC_KEY, args={'userID': userId})
+    cache = get_key_cache(cfg)
+    refresh = getattr(cfg, 'refresh_keys', False)
+
+    if not refresh:
+        public_key = cache.get(userId)
+        if public_key is not None:
+            return public_key
+
+    res, status = api_call(cfg, GET_PUBLIC_KEY, args={'userID': userId})
 
     if(status != 200):
         print('Error obteniendo clave publica:\n\t%s\n' %
@@ -54,21 +73,34 @@ def get_public_key(cfg, userId):
 
     try:
         public_key = RSA.importKey(res['publicKey'])
-        return public_key
     except:
         print('Invalid public key')
         sys.exit()
 
+    try:
+        cache.put(userId, public_key, refresh=refresh)
+    except ClaveCambiada as e:
+        cprint('\n' + str(e), color='red')
+        print('Si el cambio es legítimo, vuelve a ejecutar con --refresh_keys')
+        sys.exit()
+
+    return public_key
+
 
-def subir_fichero(cfg, file, dest_id) -> None:
-    """Sube un fichero firmado y cifrado al servidor Securebox
+def subir_fichero(cfg, file, dest_ids) -> None:
+    """Sube un fichero firmado y cifrado al servidor Securebox. Con varios
+    destinatarios el fichero se firma y se cifra una sola vez y se sube una
+    copia para cada uno que solo cambia en la clave de sesión cifrada
 
     ARGS:
         cfg: diccionario con la configuración del cliente
         file: nombre del archivo a enviar
-        dest_id: id del usuario al que se quiere enviar un fichero
+        dest_ids: id o lista de ids de los usuarios a los que se quiere
+        enviar el fichero
 
     """
+    dest_ids = normalizar_destinatarios(dest_ids)
+
     print("Solicitado envio de fichero a SecureBox\n")
 
     # Comprobamos que existe una identidad registrada
@@ -84,29 +116,257 @@ def subir_fichero(cfg, file, dest_id) -> None:
         print("   %s\n" % str(e))
         sys.exit(1)
 
-    # firmamos y ciframos
-    enc_data = enc_sign_aux(cfg, fp, dest_id)
-
-    # Submimos el fichero
-    print("-> Subiendo fichero a servidor...", flush="True", end='')
-    in_memory_file = Payload(fp.name, initial_bytes=enc_data)
-    in_memory_file.seek(0)
+    # firmamos y preparamos el cifrado, que se hace mientras se envia
+    cabeceras, body_size, cuerpo = enc_sign_aux(cfg, fp, dest_ids)
 
-    res, status = api_call(cfg.api_base_url, cfg.api_key, UPLOAD_FILE, files={
-        'ufile': in_memory_file})
+    # Con varios destinatarios el cuerpo cifrado se guarda una vez y se
+    # vuelve a leer para cada subida
+    tmp_filename = None
+    if len(cabeceras) > 1:
+        print("-> Cifrando fichero...", flush="True", end='')
+        tmp_filename = guardar_cuerpo(cuerpo)
+        fp.close()
+        print(colored('OK', color='green'))
 
-    # Comprobamos que se ha enviado correctamente
-    if(status != 200):
-        print('Error subiendo fichero:\n\t%s' %
-              format_error(res), end='')
+    errores = 0
+    try:
+        for dest_id, cabecera in cabeceras.items():
+            # Submimos el fichero
+            if tmp_filename:
+                print("-> Subiendo fichero para ID %s..." % dest_id, flush="True", end='')
+                body_fp = open(tmp_filename, 'rb')
+                chunks = chain([cabecera], cripto.read_chunks(body_fp))
+            else:
+                print("-> Cifrando y subiendo fichero a servidor...", flush="True", end='')
+                body_fp = fp
+                chunks = chain([cabecera], cuerpo)
+
+            body = MultipartStream('ufile', os.path.basename(file), chunks,
+                                   len(cabecera) + body_size)
+            with body_fp:
+                res, status = api_call(cfg, UPLOAD_FILE, stream=body)
+
+            # Comprobamos que se ha enviado correctamente
+            if(status != 200):
+                print('Error subiendo fichero:\n\t%s' %
+                      format_error(res), end='')
+                errores += 1
+                continue
+            print(colored('OK', color='green'))
+            print('Fichero "{}" subido correctamente ({} bytes). ID fichero: {}\n'.format(
+                file, res['file_size'], res['file_id']))
+    finally:
+        if tmp_filename:
+            os.remove(tmp_filename)
+
+    if errores:
         sys.exit()
+
+
+# Estado de cada proceso del pool de cifrado de subir_lote
+_lote = {}
+
+
+def expandir_ficheros(paths):
+    """Devuelve la lista de ficheros a partir de una lista de ficheros y
+    directorios. Los directorios se recorren recursivamente
+
+    ARGS:
+        paths: lista de rutas
+
+    """
+    ficheros = []
+    for path in paths:
+        if os.path.isdir(path):
+            for raiz, dirs, nombres in os.walk(path):
+                dirs.sort()
+                ficheros.extend(os.path.join(raiz, n) for n in sorted(nombres))
+        else:
+            ficheros.append(path)
+    return ficheros
+
+
+def iniciar_cifrado_lote(private_key, public_key, aes_key_size, cipher):
+    """Inicializa un proceso del pool de cifrado de subir_lote
+
+    ARGS:
+        private_key: clave privada en formato DER, o None para firmar con
+        el agente de securebox
+        public_key: clave pública del destinatario en formato DER
+        aes_key_size: tamaño de la clave de sesión
+        cipher: algoritmo de cifrado, una de las claves de cripto.CIPHERS
+
+    """
+    if private_key is None:
+        _lote['firmante'] = ClienteAgente.conectar()
+    else:
+        _lote['firmante'] = User(None, None, None, RSA.import_key(private_key))
+    _lote['public_key'] = RSA.import_key(public_key)
+    _lote['aes_key_size'] = aes_key_size
+    _lote['cipher'] = cipher
+
+
+def cifrar_lote(filename, directorio):
+    """Firma y cifra un fichero en un proceso del pool de subir_lote y
+    escribe el resultado en un fichero temporal
+
+    ARGS:
+        filename: fichero a firmar y cifrar
+        directorio: directorio en el que crear el fichero temporal
+
+    RETURN:
+        La ruta del fichero temporal y su tamaño
+    """
+    with open(filename, 'rb') as fp:
+        signature, data_size = firmar_aux(fp, _lote['firmante'])
+        size, chunks = cifrar_aux(fp, signature, data_size, _lote['public_key'],
+                                  _lote['aes_key_size'], _lote['cipher'])
+        fd, tmp_filename = tempfile.mkstemp(dir=directorio)
+        with os.fdopen(fd, 'wb') as ofp:
+            for chunk in chunks:
+                ofp.write(chunk)
+    return tmp_filename, size
+
+
+def subir_lote(cfg, paths, dest_id) -> None:
+    """Sube varios ficheros firmados y cifrados al servidor Securebox. La
+    firma y el cifrado se hacen en un pool de cfg.crypto_workers procesos y
+    los ficheros ya cifrados se suben a la vez por cfg.upload_concurrency
+    hilos que comparten las conexiones del cliente de la api. Como mucho
+    hay el doble de ficheros cifrados esperando a subirse que hilos de subida
+
+    ARGS:
+        cfg: diccionario con la configuración del cliente
+        paths: lista de ficheros y directorios a subir
+        dest_id: id del usuario al que se quieren enviar los ficheros
+
+    """
+    print("Solicitado envio de ficheros a SecureBox\n")
+
+    if not User.check_if_user_exists():
+        print("Error: No se ha encontrado una identidad. Registra un nuevo usuario usando --create_id")
+        print("     ./securebox_client.py --create_id alice alice@example.com\n")
+        sys.exit(0)
+
+    ficheros = expandir_ficheros(paths)
+    if not ficheros:
+        print('No se ha encontrado ningun fichero')
+        return
+
+    user = User.load_user_from_file()
+
+    print("-> Recuperando clave pública de ID %s..." %
+          dest_id, flush="True", end='')
+    public_key = get_public_key(cfg, dest_id)
     print(colored('OK', color='green'))
-    print('Fichero "{}" subido correctamente ({} bytes). ID fichero: {}\n'.format(
-        file, res['file_size'], res['file_id']))
+
+    private_der = None if user.agente else user.private_key.export_key(format='DER')
+    public_der = public_key.export_key(format='DER')
+
+    concurrencia = getattr(cfg, 'upload_concurrency', 4)
+    pendientes = threading.BoundedSemaphore(2 * concurrencia)
+    lock = threading.Lock()
+    terminado = threading.Event()
+    estado = {'hechos': 0, 'bytes': 0, 'errores': {}}
+    directorio = tempfile.mkdtemp(prefix='securebox_lote_')
+    inicio = time.monotonic()
+
+    def terminar(filename, error=None, res=None, size=0):
+        with lock:
+            estado['hechos'] += 1
+            if error:
+                estado['errores'][filename] = error
+                resultado = colored('ERROR', color='red')
+            else:
+                estado['bytes'] += size
+                resultado = '%s ID %s' % (colored('OK', color='green'), res['file_id'])
+            segundos = time.monotonic() - inicio
+            print('  [%d/%d] %s %s (%.2f MB/s)' % (
+                estado['hechos'], len(ficheros), filename, resultado,
+                estado['bytes'] / segundos / 1e6), flush=True)
+            if estado['hechos'] == len(ficheros):
+                terminado.set()
+        pendientes.release()
+
+    def subir(filename, tmp_filename, size):
+        try:
+            with open(tmp_filename, 'rb') as fp:
+                body = MultipartStream('ufile', os.path.basename(filename),
+                                       cripto.read_chunks(fp), size)
+                res, status = api_call(cfg, UPLOAD_FILE, stream=body)
+        except Exception as e:
+            terminar(filename, error='%s\n' % e)
+            return
+        finally:
+            os.remove(tmp_filename)
+
+        if status != 200:
+            terminar(filename, error=format_error(res))
+        else:
+            terminar(filename, res=res, size=size)
+
+    def cifrado(filename, futuro):
+        try:
+            tmp_filename, size = futuro.result()
+        except Exception as e:
+            # Cualquier error tiene que contar como terminado, o subir_lote
+            # se quedaría esperando a este fichero
+            terminar(filename, error='%s\n' % e)
+            return
+        subidas.submit(subir, filename, tmp_filename, size)
+
+    print("-> Firmando, cifrando y subiendo %d ficheros..." % len(ficheros))
+    try:
+        with ProcessPoolExecutor(max_workers=getattr(cfg, 'crypto_workers', None),
+                                 initializer=iniciar_cifrado_lote,
+                                 initargs=(private_der, public_der, cfg.aes_key_size,
+                                           getattr(cfg, 'cipher', 'aes-cbc'))) as procesos, \
+                ThreadPoolExecutor(max_workers=concurrencia) as subidas:
+            for filename in ficheros:
+                pendientes.acquire()
+                futuro = procesos.submit(cifrar_lote, filename, directorio)
+                futuro.add_done_callback(partial(cifrado, filename))
+            terminado.wait()
+    finally:
+        shutil.rmtree(directorio, ignore_errors=True)
+
+    segundos = time.monotonic() - inicio
+    subidos = len(ficheros) - len(estado['errores'])
+    print('-> %d ficheros subidos y %d errores en %.2f segundos' %
+          (subidos, len(estado['errores']), segundos))
+    print('-> %.1f ficheros/s, %.2f MB/s' %
+          (subidos / segundos, estado['bytes'] / segundos / 1e6))
+    for filename, error in estado['errores'].items():
+        print('   %s: %s' % (filename, error), end='')
+
+
+def separar_cabecera(chunks, size):
+    """Separa los primeros bytes de un iterable de bloques
+
+    ARGS:
+        chunks: iterable con bloques de datos
+        size: número de bytes de la cabecera
+
+    RETURN:
+        Tupla con los bytes de la cabecera y un iterador con el resto de
+        bloques. Lanza ValueError si no hay datos suficientes.
+    """
+    it = iter(chunks)
+    cabecera = b''
+    for chunk in it:
+        cabecera += chunk
+        if len(cabecera) >= size:
+            break
+
+    if len(cabecera) < size:
+        raise ValueError("Fichero demasiado corto")
+    return cabecera[:size], chain([cabecera[size:]], it)
 
 
 def download(cfg, file_id, source_id):
-    """Desgarga un fichero del servidor securebox
+    """Desgarga un fichero del servidor securebox. El fichero se descifra
+    y se calcula su hash a medida que llega, y se escribe en un fichero
+    temporal que solo se renombra al nombre final si la firma es correcta
 
     ARGS:
         cfg: diccionario con la configuración del cliente
@@ -118,12 +378,18 @@ def download(cfg, file_id, source_id):
         print("     ./securebox_client.py --create_id alice alice@example.com\n")
         sys.exit(0)
 
+    user = User.load_user_from_file()
+
+    # Cargar la clave pública del origen, necesaria para saber el tamaño de la firma
+    print("-> Recuperando clave pública de ID %s..." %
+          source_id, flush="True", end='')
+    public_key = get_public_key(cfg, source_id)
+    print(colored('OK', color='green'))
+
     # descargarmos el fichero
     print("Descargando fichero de SecureBox...", flush="True", end='')
-    url = '{}/{}'.format(cfg.api_base_url, DOWNLOAD_FILE)
-    headers = {'Authorization': 'Bearer ' + cfg.api_key}
-
-    r = requests.post(url, json={'file_id': file_id}, headers=headers)
+    r = get_api_client(cfg).post(DOWNLOAD_FILE, args={'file_id': file_id},
+                                 stream_response=True)
 
     if r.status_code != 200:
         print('\nError descargando fichero:\n\t%s' %
@@ -131,43 +397,84 @@ def download(cfg, file_id, source_id):
         sys.exit()
 
     print(colored('OK', color='green'))
-    print("-> %d bytes descargados correctamente" % len(r.content))
-
-     
-    iv = r.content[:16]
-    enc_key = r.content[16:272]
-    enc_data = r.content[272:]
 
-    user = User.load_user_from_file()
-    
+    # Descifrado, hash y escritura a medida que llegan los datos
     print("-> Descifrando fichero...", flush="True", end='')
-    session_key = cripto.rsa_decrypt(user.private_key, enc_key)
-    dec_data = cripto.decrypt_data(enc_data, iv, session_key)
-    print(colored('OK', color='green'))
+    fd, tmp_filename = tempfile.mkstemp(dir='.', prefix='.securebox_', suffix='.part')
+    sha256_hash = SHA256.new()
+    recibidos = [0]
+
+    def contar(chunks):
+        for chunk in chunks:
+            recibidos[0] += len(chunk)
+            yield chunk
+
+    descifrado = False
+    try:
+        with os.fdopen(fd, 'wb') as ofp:
+            body = contar(r.iter_content(cripto.CHUNK_SIZE))
+            key_size = user.key_size()
+            cabecera, enc_chunks = separar_cabecera(
+                body, cripto.CONTAINER_HEADER_SIZE + key_size)
+            header = cabecera[:cripto.CONTAINER_HEADER_SIZE]
+            enc_key = cabecera[cripto.CONTAINER_HEADER_SIZE:]
+
+            session_key = user.rsa_decrypt(enc_key)
+            # La cabecera indica si es el formato original con AES-CBC o el
+            # autenticado, en el que cada segmento se comprueba al llegar
+            dec_chunks = cripto.decrypt_container(
+                enc_chunks, session_key, header, getattr(cfg, 'crypto_threads', 1))
+            signature, dec_chunks = separar_cabecera(
+                dec_chunks, public_key.size_in_bytes())
+
+            for chunk in dec_chunks:
+                sha256_hash.update(chunk)
+                ofp.write(chunk)
+        descifrado = True
+    except (ValueError, TypeError, requests.RequestException) as e:
+        cprint('ERROR', color='red')
+        print("   %s\n" % str(e))
+    finally:
+        r.close()
+        # No dejamos el fichero temporal si algo ha fallado o se ha interrumpido
+        if not descifrado:
+            os.remove(tmp_filename)
+
+    if not descifrado:
+        sys.exit()
 
-    # Cargar la clave pública del origen
-    print("-> Recuperando clave pública de ID %s..." %
-          source_id, flush="True", end='')
-    public_key = get_public_key(cfg, source_id)
     print(colored('OK', color='green'))
+    print("-> %d bytes descargados correctamente" % recibidos[0])
 
     print("-> Verificando firma...", flush="True", end='')
-    if cripto.verify_signature(public_key, dec_data[:256], dec_data[256:]):
+    if cripto.verify_signature_hash(public_key, signature, sha256_hash):
         cprint('OK', color='green')
     else:
+        os.remove(tmp_filename)
         cprint('ERROR', color='red')
         sys.exit()
 
-    # Obtenemos el nombre del archivo
-    d = r.headers['content-disposition']
-    filename = re.findall("filename=(.+)", d)[0][1:-1]
+    # Si se interrumpe la pregunta por el nombre no dejamos el temporal
+    renombrado = False
+    try:
+        # Obtenemos el nombre del archivo
+        d = r.headers['content-disposition']
+        filename = re.findall("filename=(.+)", d)[0][1:-1]
 
-    # Comprobamos que el nombre esté libre
-    filename = ask_for_filename_if_needed(filename)
+        # Comprobamos que el nombre esté libre
+        filename = ask_for_filename_if_needed(filename)
 
-    fp = open(filename, "wb")
-    fp.write(dec_data[256:])
-    fp.close()
+        # mkstemp crea el temporal con permisos 0600; el fichero descargado
+        # lleva los permisos normales según la umask, como con open()
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_filename, 0o666 & ~umask)
+
+        os.replace(tmp_filename, filename)
+        renombrado = True
+    finally:
+        if not renombrado:
+            os.remove(tmp_filename)
 
     print("Fichero '%s' descargado y verificado correctamente\n " % filename)
 
@@ -183,19 +490,43 @@ def borrar_fichero(cfg, file_id):
     """
     print('Solicitando borrado del fichero #%s...' %
           file_id, flush=True, end='')
-    res, status = api_call(cfg.api_base_url, cfg.api_key,
-                           DELETE_FILE, args={'file_id': file_id})
+    error = borrar_fichero_aux(cfg, file_id)
 
-    if status != 200:
-        print('\nError eliminando fichero:\n\t%s' % format_error(res), end='')
+    if error:
+        print('\nError eliminando fichero:\n\t%s' % error, end='')
         sys.exit()
     else:
         print(colored('OK', color='green'))
-        print('Fichero con ID#%s borrado correctamente' % res['file_id'])
+        print('Fichero con ID#%s borrado correctamente' % file_id)
+
+
+def borrar_fichero_aux(cfg, file_id):
+    """ Borra un fichero sin imprimir nada ni terminar el programa,
+    para poder usarse desde varios hilos
+
+    ARGS:
+        cfg: configuración del cliente
+        file_id: id del fichero que se quiere borrar
+
+    RETURN:
+        None si se ha borrado o una cadena con el error
+
+    """
+    try:
+        res, status = api_call(cfg, DELETE_FILE, args={'file_id': file_id})
+    except (ValueError, requests.RequestException) as e:
+        return '%s\n' % e
+
+    if status != 200:
+        return format_error(res)
+    return None
 
 
 def borrar_todos(cfg) -> None:
-    """Borra todos los archivos subidos
+    """Borra todos los archivos subidos. Los borrados se hacen en paralelo
+    con cfg.delete_concurrency hilos y sin pasar de cfg.delete_rate
+    peticiones por segundo. Un error no detiene el resto de borrados,
+    al final se imprime un resumen
 
     ARGS:
         cfg: configuración del cliente
@@ -203,20 +534,45 @@ def borrar_todos(cfg) -> None:
     """
     # Solicitamos la lista de todos los ficheros
     print('Solicitando lista de ficheros...', flush=True, end='')
-    res, status = api_call(cfg.api_base_url, cfg.api_key, LIST_FILES)
+    res, status = api_call(cfg, LIST_FILES)
 
     if status != 200:
         print('Error solicitando lista de ficheros:\n\t%s' %
               format_error(res), end='')
         sys.exit()
-    else:
-        print(colored('OK', color='green'))
-        if res['num_files'] == 0:
-            print('No se ha encontrado ningun fichero')
-        else:
-            # Borramos uno por uno
-            for f in res['files_list']:
-                borrar_fichero(cfg, f['fileID'])
+
+    print(colored('OK', color='green'))
+    if res['num_files'] == 0:
+        print('No se ha encontrado ningun fichero')
+        return
+
+    file_ids = [f['fileID'] for f in res['files_list']]
+    limitador = LimitadorTasa(getattr(cfg, 'delete_rate', 0))
+
+    def borrar(file_id):
+        limitador.esperar()
+        return borrar_fichero_aux(cfg, file_id)
+
+    print('Borrando %d ficheros...' % len(file_ids))
+    errores = {}
+    inicio = time.monotonic()
+    with ThreadPoolExecutor(max_workers=getattr(cfg, 'delete_concurrency', 8)) as pool:
+        futuros = {pool.submit(borrar, file_id): file_id for file_id in file_ids}
+        for hecho, futuro in enumerate(as_completed(futuros), 1):
+            file_id = futuros[futuro]
+            error = futuro.result()
+            if error:
+                errores[file_id] = error
+                estado = colored('ERROR', color='red')
+            else:
+                estado = colored('OK', color='green')
+            print('  [%d/%d] Fichero #%s %s' % (hecho, len(file_ids), file_id, estado))
+
+    segundos = time.monotonic() - inicio
+    print('-> %d ficheros borrados y %d errores en %.2f segundos' %
+          (len(file_ids) - len(errores), len(errores), segundos))
+    for file_id, error in errores.items():
+        print('   #%s: %s' % (file_id, error), end='')
 
 
 def listar_ficheros(cfg):
@@ -229,7 +585,7 @@ def listar_ficheros(cfg):
     """
     print('Solicitando lista de ficheros...', flush=True, end='')
 
-    res, status = api_call(cfg.api_base_url, cfg.api_key, LIST_FILES)
+    res, status = api_call(cfg, LIST_FILES)
 
     if status != 200:
         print('Error solicitando lista de ficheros:\n\t%s' %
@@ -279,17 +635,18 @@ def sign_fichero(cfg, filename):
         print(str(e))
         sys.exit()
 
-    data = fp.read()
-    fp.close()
-
-    # Generamos la firma
+    # Generamos la firma leyendo el fichero por bloques
     print("-> Firmando fichero...", flush="True", end='')
-    signature = cripto.sign_data(user.private_key, data)
+    sha256_hash = cripto.get_hash_sha265_chunks(cripto.read_chunks(fp))
+    signature = user.sign_hash(sha256_hash)
     print(colored('OK', color='green'))
 
     # Guardamos el archivo firmado
     ofp.write(signature)
-    ofp.write(data)
+    fp.seek(0)
+    for chunk in cripto.read_chunks(fp):
+        ofp.write(chunk)
+    fp.close()
     ofp.close()
     print('Fichero firmado escrito correctamente en %s\n' % outfilename)
 
@@ -325,25 +682,48 @@ def encrypt(cfg, filename, dest_id) -> None:
         print(str(e))
         sys.exit()
 
-    data = fp.read()
-    fp.close()
-
-    print("-> Cifrando fichero...", flush="True", end='')
-    iv, session_key, enc_data = cripto.encrypt_data(data, cfg.aes_key_size)
-    print(colored('OK', color='green'))
+    header, session_key = cripto.new_container_header(
+        getattr(cfg, 'cipher', 'aes-cbc'), cfg.aes_key_size)
 
     print("-> Cifrando clave de sesión...", flush="True", end='')
     enc_session_key = cripto.rsa_encrypt(public_key, session_key)
     print(colored('OK', color='green'))
 
-    ofp.write(iv)
+    # Ciframos y escribimos por bloques
+    print("-> Cifrando fichero...", flush="True", end='')
+    ofp.write(header)
     ofp.write(enc_session_key)
-    ofp.write(enc_data)
+    for chunk in cripto.encrypt_container(cripto.read_chunks(fp), session_key, header,
+                                          getattr(cfg, 'crypto_threads', 1)):
+        ofp.write(chunk)
+    fp.close()
     ofp.close()
+    print(colored('OK', color='green'))
     print('Fichero cifrado escrito correctamente en %s\n' % outfilename)
 
 
-def enc_sign_aux(cfg, in_file, dest_id):
+def enc_sign_aux(cfg, in_file, dest_ids):
+    """Firma un fichero y prepara su cifrado para uno o varios destinatarios.
+    El fichero se firma y se cifra con AES una sola vez, con una clave de
+    sesión común; para cada destinatario solo se cifra con RSA la clave de
+    sesión. El fichero se lee dos veces por bloques: una para calcular la
+    firma y otra, a medida que se consume el resultado, para cifrarlo, asi
+    que la memoria usada no depende del tamaño del fichero
+
+    ARGS:
+        cfg: namespace con la configuración del servidor
+        in_file: fichero abierto en modo binario. Tiene que seguir abierto
+        hasta que se consuman los bloques devueltos
+        dest_ids: id o lista de ids de los usuarios a los que se quiere
+        enviar el fichero
+
+    RETURN:
+        Tupla con un diccionario con la cabecera de cada destinatario
+        (iv | clave de sesión cifrada), el tamaño del cuerpo y un generador
+        con los bloques del cuerpo común: cifrado(firma | datos)
+    """
+    dest_ids = normalizar_destinatarios(dest_ids)
+
     if not User.check_if_user_exists():
         print("Error: No se ha encontrado una identidad. Registra un nuevo usuario usando --create_id")
         print("     ./securebox_client.py --create_id alice alice@example.com\n")
@@ -352,38 +732,145 @@ def enc_sign_aux(cfg, in_file, dest_id):
     # cargar nuestro usuario clave privada
     user = User.load_user_from_file()
 
-    print("-> Recuperando clave pública de ID %s..." %
-          dest_id, flush="True", end='')
-    public_key = get_public_key(cfg, dest_id)
-    print(colored('OK', color='green'))
-
-    data = in_file.read()
+    public_keys = []
+    for dest_id in dest_ids:
+        print("-> Recuperando clave pública de ID %s..." %
+              dest_id, flush="True", end='')
+        public_keys.append(get_public_key(cfg, dest_id))
+        print(colored('OK', color='green'))
 
     print("-> Firmando fichero...", flush="True", end='')
-    signature = cripto.sign_data(user.private_key, data)
-    print(colored('OK', color='green'))
-
-    print("-> Cifrando fichero...", flush="True", end='')
-    iv, session_key, enc_data = cripto.encrypt_data(
-        signature + data, cfg.aes_key_size)
+    signature, data_size = firmar_aux(in_file, user)
     print(colored('OK', color='green'))
 
     print("-> Cifrando clave de sesión...", flush="True", end='')
-    enc_session_key = cripto.rsa_encrypt(public_key, session_key)
+    cabeceras, body_size, cuerpo = cifrar_multi_aux(
+        in_file, signature, data_size, public_keys, cfg.aes_key_size,
+        getattr(cfg, 'cipher', 'aes-cbc'), getattr(cfg, 'crypto_threads', 1))
     print(colored('OK', color='green'))
 
-    return iv+enc_session_key+enc_data
+    return dict(zip(dest_ids, cabeceras)), body_size, cuerpo
+
+
+def normalizar_destinatarios(dest_ids):
+    """Devuelve la lista de destinatarios sin repetidos, en el orden en
+    el que se han indicado
+
+    ARGS:
+        dest_ids: id o lista de ids de usuarios
+
+    """
+    if isinstance(dest_ids, str):
+        dest_ids = [dest_ids]
+    return list(dict.fromkeys(dest_ids))
+
+
+def firmar_aux(in_file, firmante):
+    """Lee un fichero por bloques y firma su hash SHA256
+
+    ARGS:
+        in_file: fichero abierto en modo binario
+        firmante: objeto con un método sign_hash, como User o ClienteAgente
+
+    RETURN:
+        Tupla con la firma y el tamaño del fichero
+    """
+    in_file.seek(0)
+    sha256_hash = cripto.get_hash_sha265_chunks(cripto.read_chunks(in_file))
+    return firmante.sign_hash(sha256_hash), in_file.tell()
 
 
-def enc_sign(cfg, filename, dest_id) -> None:
-    """Firma y cifra un fichero en local
+def cifrar_aux(in_file, signature, data_size, public_key, aes_key_size, cipher='aes-cbc'):
+    """Genera una clave de sesión, la cifra para el destinatario y prepara el
+    cifrado del fichero, que se hace a medida que se consumen los bloques
+
+    ARGS:
+        in_file: fichero abierto en modo binario. Tiene que seguir abierto
+        hasta que se consuman los bloques devueltos
+        signature: firma del fichero
+        data_size: tamaño del fichero
+        public_key: clave pública del destinatario
+        aes_key_size: tamaño de la clave de sesión
+        cipher: algoritmo de cifrado, una de las claves de cripto.CIPHERS
+
+    RETURN:
+        Tupla con el tamaño total y un generador con los bloques del
+        resultado: cabecera | clave de sesión cifrada | cifrado(firma | datos)
+    """
+    cabeceras, body_size, cuerpo = cifrar_multi_aux(
+        in_file, signature, data_size, [public_key], aes_key_size, cipher)
+    return len(cabeceras[0]) + body_size, chain(cabeceras, cuerpo)
+
+
+def cifrar_multi_aux(in_file, signature, data_size, public_keys, aes_key_size,
+                     cipher='aes-cbc', workers=1):
+    """Genera una clave de sesión, la cifra para cada destinatario y prepara
+    el cifrado del fichero, común para todos, que se hace a medida que se
+    consumen los bloques
+
+    ARGS:
+        in_file: fichero abierto en modo binario. Tiene que seguir abierto
+        hasta que se consuman los bloques devueltos
+        signature: firma del fichero
+        data_size: tamaño del fichero
+        public_keys: lista con las claves públicas de los destinatarios
+        aes_key_size: tamaño de la clave de sesión
+        cipher: algoritmo de cifrado, una de las claves de cripto.CIPHERS
+        workers: hilos con los que cifrar los segmentos del formato autenticado
+
+    RETURN:
+        Tupla con la lista de cabeceras de cada destinatario
+        (cabecera común | clave de sesión cifrada), el tamaño del cuerpo y un
+        generador con los bloques del cuerpo: cifrado(firma | datos)
+    """
+    header, session_key = cripto.new_container_header(cipher, aes_key_size)
+    cabeceras = [header + cripto.rsa_encrypt(public_key, session_key)
+                 for public_key in public_keys]
+
+    def cuerpo():
+        in_file.seek(0)
+        yield from cripto.encrypt_container(
+            chain([signature], cripto.read_chunks(in_file)), session_key, header, workers)
+
+    body_size = cripto.container_body_size(header, len(signature) + data_size)
+    return cabeceras, body_size, cuerpo()
+
+
+def guardar_cuerpo(cuerpo, directorio=None):
+    """Escribe el cuerpo cifrado común de varios destinatarios en un fichero
+    temporal, para poder leerlo varias veces sin volver a cifrarlo
+
+    ARGS:
+        cuerpo: iterable con los bloques cifrados
+        directorio: directorio del fichero temporal. Por defecto el del sistema
+
+    RETURN:
+        La ruta del fichero temporal. Hay que borrarlo al terminar
+    """
+    fd, tmp_filename = tempfile.mkstemp(dir=directorio, prefix='.securebox_', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as ofp:
+            for chunk in cuerpo:
+                ofp.write(chunk)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+    return tmp_filename
+
+
+def enc_sign(cfg, filename, dest_ids) -> None:
+    """Firma y cifra un fichero en local. Con varios destinatarios el fichero
+    se firma y se cifra una sola vez y se escribe una copia para cada uno,
+    FICHERO.ID.enc.signed, que solo cambia en la clave de sesión cifrada
 
     ARGS:
         cfg: namespace con la configuración del servidor
         filename: nombre del fichero a firmar y cifrar
-        dest_id: id del usuario al que se quiere enviar el fichero
+        dest_ids: id o lista de ids de los usuarios a los que se quiere
+        enviar el fichero
 
     """
+    dest_ids = normalizar_destinatarios(dest_ids)
 
     print("Firmando y Cifrando fichero offline\n")
 
@@ -394,22 +881,43 @@ def enc_sign(cfg, filename, dest_id) -> None:
         print("   %s\n" % str(e))
         sys.exit(1)
 
-    # Generamos el nombre del fichero
-    outfilename = ask_for_filename_if_needed(filename + ".enc.signed")
+    # Generamos el nombre de los ficheros
+    if len(dest_ids) == 1:
+        outfilenames = [ask_for_filename_if_needed(filename + ".enc.signed")]
+    else:
+        outfilenames = [ask_for_filename_if_needed("%s.%s.enc.signed" % (filename, dest_id))
+                        for dest_id in dest_ids]
+
+    # Dos destinatarios no pueden acabar en el mismo fichero
+    if len(set(map(os.path.abspath, outfilenames))) != len(outfilenames):
+        print("Error: se ha elegido el mismo fichero de salida para varios destinatarios")
+        sys.exit(1)
+
+    # Firmamos y preparamos el cifrado
+    cabeceras, _, cuerpo = enc_sign_aux(cfg, fp, dest_ids)
 
+    # Ciframos y escribimos en disco por bloques. Con varios destinatarios
+    # el primero se escribe mientras se cifra y el resto se copian de él
+    print("-> Cifrando y escribiendo fichero...", flush="True", end='')
     try:
-        ofp = open(outfilename, "wb")
+        with open(outfilenames[0], "wb") as ofp:
+            ofp.write(cabeceras[dest_ids[0]])
+            for chunk in cuerpo:
+                ofp.write(chunk)
+
+        cabecera_size = len(cabeceras[dest_ids[0]])
+        for dest_id, outfilename in zip(dest_ids[1:], outfilenames[1:]):
+            if os.path.abspath(outfilename) == os.path.abspath(outfilenames[0]):
+                raise ValueError("No se puede copiar %s sobre si mismo" % outfilename)
+            with open(outfilenames[0], "rb") as ifp, open(outfilename, "wb") as ofp:
+                ifp.seek(cabecera_size)
+                ofp.write(cabeceras[dest_id])
+                shutil.copyfileobj(ifp, ofp, cripto.CHUNK_SIZE)
     except Exception as e:
         print(str(e))
         sys.exit()
-
-    # Firmamos y ciframos
-    data = enc_sign_aux(cfg, fp, dest_id)
     fp.close()
+    print(colored('OK', color='green'))
 
-    # Escribimos en disco
-    print("-> Escribiendo fichero...", flush="True", end='')
-    ofp.write(data)
-    ofp.close()
-
-    print('Fichero firmando y cifrado escrito correctamente en %s\n' % outfilename)
+    for outfilename in outfilenames:
+        print('Fichero firmando y cifrado escrito correctamente en %s\n' % outfilename)
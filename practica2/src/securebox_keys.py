@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Modulo con la cache en disco de las claves públicas de otros
+usuarios de securebox.
+
+Cada clave se guarda por userID junto con su huella SHA256 y el instante
+en el que se obtuvo. Mientras no caduca se usa sin preguntar al servidor
+y sin parsear el PEM, porque se guardan directamente el módulo y el
+exponente. Cuando caduca se vuelve a pedir, y si el servidor devuelve una
+clave con otra huella se rechaza: la primera clave vista queda fijada
+hasta que el usuario pida refrescarla de forma explícita.
+
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+
+# Fichero en el que se guarda la cache
+KEY_CACHE_FILE = 'public_keys.json'
+
+# Segundos que se considera valida una clave de la cache
+KEY_CACHE_TTL = 24 * 60 * 60
+
+
+class ClaveCambiada(Exception):
+    """ El servidor ha devuelto para un usuario una clave distinta
+    a la que se tenía fijada
+    """
+
+    def __init__(self, user_id, fijada, recibida):
+        self.user_id = user_id
+        self.fijada = fijada
+        self.recibida = recibida
+        super().__init__('La clave pública del usuario %s ha cambiado\n'
+                         '\tHuella fijada:   %s\n\tHuella recibida: %s'
+                         % (user_id, fijada, recibida))
+
+
+def fingerprint(public_key):
+    """Calcula la huella de una clave pública
+
+    ARGUMENTOS:
+        public_key: clave pública RSA
+
+    RETURN:
+        SHA256 en hexadecimal de la clave en formato DER
+    """
+    return SHA256.new(public_key.export_key(format='DER')).hexdigest()
+
+
+class CacheClaves():
+    """ Cache de claves públicas guardada en un fichero JSON
+    """
+
+    def __init__(self, file=KEY_CACHE_FILE, ttl=KEY_CACHE_TTL):
+        """Carga la cache del fichero. Si no existe o no se puede leer
+        se empieza con la cache vacia
+
+        ARGUMENTOS:
+            file: fichero de la cache
+            ttl: segundos que se considera valida una clave
+
+        """
+        self.file = file
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        try:
+            with open(file, 'r') as fp:
+                self.entradas = json.load(fp)
+        except (OSError, ValueError):
+            self.entradas = {}
+
+    def get(self, user_id):
+        """Devuelve la clave guardada de un usuario o None si no está
+        o ha caducado
+
+        ARGUMENTOS:
+            user_id: id del usuario
+
+        """
+        with self.lock:
+            entrada = self.entradas.get(user_id)
+            if entrada is None or time.time() - entrada['ts'] > self.ttl:
+                return None
+            return RSA.construct((int(entrada['n'], 16), entrada['e']))
+
+    def put(self, user_id, public_key, refresh=False):
+        """Guarda la clave de un usuario recibida del servidor
+
+        ARGUMENTOS:
+            user_id: id del usuario
+            public_key: clave pública RSA del usuario
+            refresh: aceptar la clave aunque tenga distinta huella que la fijada
+
+        RETURN:
+            La huella de la clave
+
+        EXCEPCIONES:
+            ClaveCambiada si la huella no coincide con la fijada y no se
+            ha pedido refrescarla
+        """
+        huella = fingerprint(public_key)
+        with self.lock:
+            entrada = self.entradas.get(user_id)
+            if entrada and entrada['fingerprint'] != huella and not refresh:
+                raise ClaveCambiada(user_id, entrada['fingerprint'], huella)
+
+            self.entradas[user_id] = {
+                'n': '%x' % public_key.n,
+                'e': public_key.e,
+                'fingerprint': huella,
+                'ts': time.time()
+            }
+            self.guardar()
+        return huella
+
+    def guardar(self):
+        """Escribe la cache en disco. Se escribe en un fichero temporal que
+        luego se renombra para no dejar nunca el fichero a medias
+        """
+        directorio = os.path.dirname(os.path.abspath(self.file))
+        fd, tmp = tempfile.mkstemp(dir=directorio, prefix='.public_keys_')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(self.entradas, fp, indent=4)
+            os.replace(tmp, self.file)
+        except OSError:
+            os.remove(tmp)
+            raise
+
+
+def get_key_cache(cfg):
+    """Devuelve la cache de claves compartida por todo el programa,
+    cargandola la primera vez
+
+    ARGUMENTOS:
+        cfg: namespace con la configuración del cliente
+
+    """
+    if getattr(cfg, 'key_cache', None) is None:
+        cfg.key_cache = CacheClaves(getattr(cfg, 'key_cache_file', KEY_CACHE_FILE),
+                                    getattr(cfg, 'key_cache_ttl', KEY_CACHE_TTL))
+    return cfg.key_cache
@@ -14,6 +14,7 @@ from Crypto.PublicKey import RSA
 from securebox_utils import api_call, format_error
 import securebox_crypto as cripto
 from securebox_utils import query_yes_no
+from securebox_agent import Agente, ClienteAgente, agent_socket_path
 import json
 import getpass
 from termcolor import colored, cprint
@@ -35,7 +36,7 @@ class User():
     
     """
 
-    def __init__(self, user_id, name, email, private_key, passphrase=None, alias=None):
+    def __init__(self, user_id, name, email, private_key, passphrase=None, alias=None, agente=None):
         self.user_id = user_id
         self.name = name
         self.email = email
@@ -43,6 +44,29 @@ class User():
         self.private_key = private_key
         self.__ascii_key = None
         self.passphrase = passphrase
+        self.agente = agente
+
+    def sign_hash(self, sha256_hash):
+        """Firma un hash SHA256 con la clave privada del usuario, o con
+        el agente si la clave está en él
+        """
+        if self.agente:
+            return self.agente.sign_hash(sha256_hash)
+        return cripto.sign_hash(self.private_key, sha256_hash)
+
+    def rsa_decrypt(self, data):
+        """Descifra con RSA usando la clave privada del usuario, o el
+        agente si la clave está en él
+        """
+        if self.agente:
+            return self.agente.rsa_decrypt(data)
+        return cripto.rsa_decrypt(self.private_key, data)
+
+    def key_size(self):
+        """Devuelve el tamaño en bytes de la clave privada del usuario"""
+        if self.agente:
+            return self.agente.key_size
+        return self.private_key.size_in_bytes()
 
     def serialize(self, file='user_config.json', force=False):
         fp = open(file, "w")
@@ -92,10 +116,12 @@ class User():
             return False
 
     @staticmethod
-    def load_user_from_file(file='user_config.json'):
+    def load_user_from_file(file='user_config.json', usar_agente=True):
         """Intenta cargar los datos de usuario desde un fichero
-        Si la clave privada del usuario está cifrada, solicitará al usuario
-        introducir la contraseña para desbloquear su clave privada.
+        Si hay un agente de securebox con la clave de este usuario, se usa
+        el agente y no se descifra la clave. Si no, y la clave privada del
+        usuario está cifrada, solicitará al usuario introducir la contraseña
+        para desbloquear su clave privada.
         """
         with open(file, 'r') as fp:
             data = json.load(fp)
@@ -105,6 +131,14 @@ class User():
             alias = data['alias']
             encrypted = data['encrypted']
 
+            if usar_agente:
+                agente = ClienteAgente.conectar()
+                if agente and agente.user_id == user_id:
+                    print("    Usando la clave privada del agente de securebox\n")
+                    return User(user_id, name, email, None, alias=alias, agente=agente)
+                elif agente:
+                    agente.close()
+
             private_key = None
             if encrypted:
                 password = None
@@ -180,12 +214,12 @@ def crear_identidad(cfg, params):
 
     # Registramos la clave pública
     print('-> Registrando clave pública...', flush=True, end='')
-    res, status = api_call(cfg.api_base_url, cfg.api_key, REGISTER,
+    res, status = api_call(cfg, REGISTER,
                            args={
                                'nombre': params[0],
                                'email': params[1],
                                'publicKey': exported_public_key
-                           })
+                           }, idempotent=False)
 
     creation_ts = res['ts']
     if status != 200:
@@ -205,7 +239,7 @@ def crear_identidad(cfg, params):
 
     print('-> Buscando ID de usuario asignado...', end='')
 
-    res, status = api_call(cfg.api_base_url, cfg.api_key, SEARCH, args={
+    res, status = api_call(cfg, SEARCH, args={
         'data_search': params[1]})
 
     if status != 200:
@@ -239,8 +273,7 @@ def buscar_usuarios(cfg, data):
         data: cadena con la que se realiza la búsqueda
     """
     print("Buscando usuario '%s' en el servidor..." % data, flush=True, end='')
-    res, status = api_call(cfg.api_base_url, cfg.api_key,
-                           SEARCH, args={'data_search': data})
+    res, status = api_call(cfg, SEARCH, args={'data_search': data})
     if status != 200:
         print('Error buscando usuarios:\n\t%s' % format_error(res), end='')
         sys.exit()
@@ -270,8 +303,7 @@ def borrar_usuario(cfg, userid):
           userid, flush=True, end='')
 
     # Realizamos la llamada a la api
-    res, status = api_call(cfg.api_base_url, cfg.api_key,
-                           DELETE, args={'userID': userid})
+    res, status = api_call(cfg, DELETE, args={'userID': userid})
 
     if not User.check_if_user_exists():
         print("\nError: No se ha encontrado una identidad. Registra un nuevo usuario usando --create_id")
@@ -301,3 +333,56 @@ def borrar_usuario(cfg, userid):
             cprint('ERROR', 'red')
 
     print('Identidad con ID#%s borrada correctamente' % userid)
+
+
+def arrancar_agente(cfg):
+    """Descifra la clave privada del usuario y arranca un agente en segundo
+    plano que la guarda para los siguientes comandos
+
+    ARGS:
+        cfg: configuración del cliente
+
+    """
+    if not User.check_if_user_exists():
+        print("No existe ninguna identidad registrada")
+        sys.exit()
+
+    user = User.load_user_from_file(usar_agente=False)
+    try:
+        agente = Agente(user.user_id, user.private_key,
+                        idle_timeout=cfg.agent_idle_timeout)
+    except OSError as e:
+        print("Error arrancando el agente:\n\t%s" % e)
+        sys.exit()
+
+    if os.fork() != 0:
+        # El proceso padre deja el socket al agente y termina
+        agente.server.socket.close()
+        print("Agente de securebox escuchando en %s" % agente.path)
+        print("Terminará tras %d segundos sin uso o con --agent_stop" % cfg.agent_idle_timeout)
+        return
+
+    # Proceso del agente: se separa de la terminal y atiende peticiones
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    try:
+        agente.serve()
+    finally:
+        os._exit(0)
+
+
+def parar_agente(cfg):
+    """Para el agente de securebox si está en marcha
+
+    ARGS:
+        cfg: configuración del cliente
+
+    """
+    agente = ClienteAgente.conectar()
+    if agente is None:
+        print("No hay ningún agente escuchando en %s" % agent_socket_path())
+        return
+    agente.stop()
+    print("Agente de securebox parado")
@@ -15,12 +15,21 @@ incluidas en ninguno de los demás modulos.
 import os.path
 import sys
 import io
+import binascii
+from itertools import chain
 import argparse
 import json
+import time
+import threading
 import requests
+import requests.adapters
 from termcolor import colored
 
 
+# Bytes que se entregan a requests en cada lectura de un MultipartStream
+CHUNK_LECTURA = 64 * 1024
+
+
 class Payload(io.BytesIO):
     """ Fichero en memoría como BytesIO pero con
     nombre para que la libreria requests lo detecte
@@ -32,6 +41,71 @@ class Payload(io.BytesIO):
         super().__init__(initial_bytes)
 
 
+class MultipartStream():
+    """ Cuerpo multipart/form-data con un solo fichero que se genera
+    a medida que requests lo va enviando, sin tenerlo entero en memoria.
+    Como se conoce el tamaño total, la petición lleva Content-Length
+    """
+
+    def __init__(self, field, filename, chunks, length):
+        """Crea un nuevo MultipartStream
+
+        ARGUMENTOS:
+            field: nombre del campo del formulario
+            filename: nombre del fichero que verá el servidor
+            chunks: iterable con los bloques de datos del fichero
+            length: tamaño total en bytes de los bloques
+
+        """
+        boundary = binascii.hexlify(os.urandom(16)).decode('ascii')
+        self.content_type = 'multipart/form-data; boundary=' + boundary
+
+        head = ('--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'
+                'Content-Type: application/octet-stream\r\n\r\n').format(
+                    boundary, field, filename).encode('utf-8')
+        tail = '\r\n--{}--\r\n'.format(boundary).encode('utf-8')
+
+        self.length = len(head) + length + len(tail)
+        self.parts = chain([head], chunks, [tail])
+        self.actual = b''
+        self.pos = 0
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        while True:
+            data = self.read(CHUNK_LECTURA)
+            if not data:
+                return
+            yield data
+
+    def read(self, size=-1):
+        """Devuelve los siguientes bytes del cuerpo. Puede devolver menos de
+        size bytes; solo devuelve b'' al final
+
+        ARGUMENTOS:
+            size: número máximo de bytes a devolver. Si es negativo se
+            devuelve todo lo que queda
+
+        """
+        if size is None or size < 0:
+            data = self.actual[self.pos:] + b''.join(self.parts)
+            self.actual, self.pos = b'', 0
+            return data
+
+        while self.pos >= len(self.actual):
+            self.actual = next(self.parts, None)
+            self.pos = 0
+            if self.actual is None:
+                self.actual = b''
+                return b''
+
+        data = self.actual[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+
 class CustomParser(argparse.ArgumentParser):
     """Argparser con ayuda personalizada y algunos tweaks
 
@@ -141,26 +215,157 @@ def format_error(res):
     return '{} {}: {}\n'.format(res['http_error_code'], res['error_code'], res['description'])
 
 
-def api_call(base, api_key, endpoint, args=None, files=None):
-    """Realiza llamadas a la api de securebox
+# Códigos HTTP tras los que se repite una petición idempotente
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class ApiClient():
+    """Cliente de la api de securebox. Usa una única requests.Session para
+    que todas las peticiones reutilicen las conexiones TCP+TLS abiertas, y
+    repite con espera exponencial las peticiones idempotentes que fallan
+    por errores de red o del servidor.
+    """
+
+    def __init__(self, base, api_key, pool_size=10, retries=3, backoff=0.5,
+                 timeout=(5, 60)):
+        """Crea un nuevo ApiClient
+
+        ARGUMENTOS:
+            base: la base de la url a la que enviar las peticiones
+            api_key: token para usar con la api
+            pool_size: número máximo de conexiones abiertas con el servidor
+            retries: número de veces que se repite una petición fallida
+            backoff: segundos de espera antes del primer reintento. Se
+            duplica en cada reintento
+            timeout: tupla con los segundos de espera para conectar y
+            para recibir datos
+
+        """
+        self.base = base
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = tuple(timeout)
+
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = 'Bearer ' + api_key
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def post(self, endpoint, args=None, files=None, stream=None, idempotent=True,
+             stream_response=False):
+        """Manda una petición POST a la api
+
+        ARGUMENTOS:
+            endpoint: endpoint al que enviar la petición. Se concatena con la base
+            args: diccionario con los los parametros a enviar en formato JSON
+            files: ficheros a enviar a el servidor
+            stream: MultipartStream con un fichero a enviar sin cargarlo en memoria
+            idempotent: si es False la petición no se repite nunca, porque
+            puede haber llegado al servidor aunque falle
+            stream_response: no descargar el cuerpo de la respuesta hasta que
+            se lea
+
+        RETURN:
+            El objeto requests.Response de la respuesta
+
+        """
+        url = '{}/{}'.format(self.base, endpoint)
+        headers = {}
+        if stream is not None:
+            headers['Content-Type'] = stream.content_type
+            data = stream
+        else:
+            data = None
+
+        # Un cuerpo que se genera mientras se envia no se puede repetir
+        reintentos = self.retries if idempotent and stream is None else 0
+
+        for intento in range(reintentos + 1):
+            try:
+                r = self.session.post(url, json=args if data is None else None,
+                                      data=data, files=files, headers=headers,
+                                      timeout=self.timeout, stream=stream_response)
+            except (requests.ConnectionError, requests.Timeout):
+                if intento == reintentos:
+                    raise
+            else:
+                if r.status_code not in RETRY_STATUS or intento == reintentos:
+                    return r
+                r.close()
+
+            time.sleep(self.backoff * 2 ** intento)
+
+
+def get_api_client(cfg):
+    """Devuelve el cliente de la api compartido por todo el programa,
+    creandolo con la configuración la primera vez
+
+    ARGUMENTOS:
+        cfg: namespace con la configuración del cliente
+
+    """
+    if getattr(cfg, 'api_client', None) is None:
+        cfg.api_client = ApiClient(
+            cfg.api_base_url, cfg.api_key,
+            pool_size=getattr(cfg, 'http_pool_size', 10),
+            retries=getattr(cfg, 'http_retries', 3),
+            backoff=getattr(cfg, 'http_backoff', 0.5),
+            timeout=getattr(cfg, 'http_timeout', (5, 60)))
+    return cfg.api_client
+
+
+def api_call(cfg, endpoint, args=None, files=None, stream=None, idempotent=True):
+    """Realiza llamadas a la api de securebox a través del cliente compartido
 
     ARGUMENTOS:
-        base: la base de la url a la que enviar las peticiones
-        api_key: token para usar con la api
+        cfg: namespace con la configuración del cliente
         endpoint: endpoint al que enviar la petición. Se concatena con la base
         args: diccionario con los los parametros a enviar en formato JSON. Por defecto None
         files: ficheros a enviar a el servidor. Por defecto None
+        stream: MultipartStream con un fichero a enviar sin cargarlo en memoria.
+        Por defecto None
+        idempotent: si es False la petición no se repite si puede haber llegado
+        al servidor. Por defecto True
 
     RETURN:
         La respuesta parseada en formato JSON y el codigo de estado HTTP
 
     """
-    url = '{}/{}'.format(base, endpoint)
+    r = get_api_client(cfg).post(endpoint, args=args, files=files, stream=stream,
+                                 idempotent=idempotent)
+    return r.json(), r.status_code
 
-    headers = {'Authorization': 'Bearer ' + api_key}
 
-    r = requests.post(url, json=args, files=files, headers=headers)
-    return r.json(), r.status_code
+class LimitadorTasa():
+    """ Reparte las llamadas a esperar() de varios hilos para que no se
+    hagan más de un número de peticiones por segundo
+    """
+
+    def __init__(self, tasa):
+        """Crea un nuevo LimitadorTasa
+
+        ARGUMENTOS:
+            tasa: peticiones por segundo permitidas. 0 o None para no limitar
+
+        """
+        self.intervalo = 1 / tasa if tasa else 0
+        self.siguiente = time.monotonic()
+        self.lock = threading.Lock()
+
+    def esperar(self):
+        """Bloquea hasta que se pueda hacer la siguiente petición"""
+        if not self.intervalo:
+            return
+
+        with self.lock:
+            ahora = time.monotonic()
+            turno = max(self.siguiente, ahora)
+            self.siguiente = turno + self.intervalo
+
+        if turno > ahora:
+            time.sleep(turno - ahora)
 
 
 def query_yes_no(question, default="yes"):
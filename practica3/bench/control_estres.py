@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Prueba de estrés del control de llamadas. Abre cientos de conexiones de
+señalización simultaneas contra una instancia de Control, cada una manda un
+CALLING, y mide cuanto tarda en contestar a todas y cuantos hilos usa.
+
+Uso (desde el directorio practica3):
+    python3 -m bench.control_estres --conexiones 500
+"""
+import argparse
+import json
+import selectors
+import socket
+import threading
+import time
+
+from src.control import Control
+
+
+class _App():
+    """ Sustituto de appJar: ejecuta los callbacks en el momento
+    """
+
+    def queueFunction(self, func, *args, **kwargs):
+        func(*args, **kwargs)
+
+
+class GuiFalsa():
+    """ Gui sin ventanas que solo cuenta los callbacks recibidos
+    """
+
+    def __init__(self):
+        self.app = _App()
+        self.llamadas = 0
+        self.ocupados = 0
+
+    def callback_calling(self, udp_port_dest=None, addr_dest=None):
+        self.llamadas += 1
+
+    def callback_call_busy(self, nick):
+        self.ocupados += 1
+
+    def callback_connection_closed_unexpectedly(self):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Prueba de estrés del control de llamadas')
+    parser.add_argument('--conexiones', type=int, default=500)
+    parser.add_argument('--puerto', type=int, default=9000)
+    args = parser.parse_args()
+
+    gui = GuiFalsa()
+    control = Control(gui, args.puerto)
+    control.debug = False
+
+    selector = selectors.DefaultSelector()
+    inicio = time.time()
+
+    for i in range(args.conexiones):
+        s = socket.create_connection(('127.0.0.1', control.port))
+        s.sendall("CALLING estres{} 6000".format(i).encode('utf-8'))
+        s.setblocking(False)
+        selector.register(s, selectors.EVENT_READ)
+
+    hilos_max = threading.active_count()
+    conectado = time.time()
+
+    # Todas menos la primera tienen que recibir CALL_BUSY y ser cerradas
+    pendientes = args.conexiones - 1
+    while pendientes > 0 and time.time() - inicio < 30:
+        for key, _ in selector.select(timeout=1):
+            data = key.fileobj.recv(1024)
+            if data.startswith(b"CALL_BUSY") or not data:
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+                pendientes -= 1
+        hilos_max = max(hilos_max, threading.active_count())
+
+    fin = time.time()
+
+    # Medimos cuanto tarda en parar el bucle de eventos
+    control.exit()
+    parada = time.time()
+    while any(t.name != threading.current_thread().name and t.is_alive()
+              and t.daemon for t in threading.enumerate()):
+        if time.time() - parada > 5:
+            break
+        time.sleep(0.001)
+    parada = time.time() - parada
+
+    print(json.dumps({
+        'conexiones': args.conexiones,
+        'llamadas': gui.llamadas,
+        'ocupados': gui.ocupados,
+        'sin_respuesta': pendientes,
+        'segundos_conexion': round(conectado - inicio, 4),
+        'segundos_total': round(fin - inicio, 4),
+        'hilos_max': hilos_max,
+        'segundos_parada': round(parada, 4),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""Prueba de fuzz y rendimiento del parser del protocolo de control.
+
+Primero parte un flujo de miles de mensajes en trozos aleatorios, como
+haría TCP, y comprueba que el parser recupera exactamente los mismos
+mensajes. Hace lo mismo con mensajes sin terminador, como los que mandan
+los clientes antiguos, entregando el resto con flush() como hace Control
+pasados ESPERA_RESTO segundos. Después manda miles de comandos seguidos por
+una sola conexión a una instancia de Control y comprueba que llegan todos
+los callbacks, y por último repite la llamada con un cliente sin entramado.
+
+Uso (desde el directorio practica3):
+    python3 -m bench.control_parser --mensajes 20000
+"""
+import argparse
+import json
+import random
+import socket
+import string
+import time
+
+from src.control import Control
+from src.framing import ESPERA_RESTO, ParserControl, empaquetar
+
+
+def mensaje_aleatorio(rnd):
+    """ Genera un mensaje de control valido con argumentos aleatorios
+    """
+    nick = ''.join(rnd.choice(string.ascii_letters + string.digits + '#_')
+                   for _ in range(rnd.randint(1, 20)))
+    return rnd.choice([
+        "CALLING {} {}".format(nick, rnd.randint(1024, 65535)),
+        "CALL_ACCEPTED {} {}".format(nick, rnd.randint(1024, 65535)),
+        "CALL_END {}".format(nick),
+        "CALL_DENIED",
+        "CALL_BUSY",
+        "CALL_HOLD",
+        "CALL_RESUME",
+    ])
+
+
+def fuzz(n, semilla):
+    """ Trocea aleatoriamente un flujo de n mensajes y comprueba el parser.
+    Devuelve la tupla (correcto, mensajes por segundo)
+    """
+    rnd = random.Random(semilla)
+    originales = [mensaje_aleatorio(rnd) for _ in range(n)]
+    flujo = b''.join(empaquetar(m) for m in originales)
+
+    trozos = []
+    i = 0
+    while i < len(flujo):
+        tam = rnd.choice([1, 2, 7, 64, 1024, 4096])
+        trozos.append(flujo[i:i + tam])
+        i += tam
+
+    parser = ParserControl()
+    inicio = time.perf_counter()
+    recibidos = []
+    for trozo in trozos:
+        recibidos.extend(parser.feed(trozo))
+    segundos = time.perf_counter() - inicio
+
+    return recibidos == originales, n / segundos
+
+
+def fuzz_legado(n, semilla):
+    """ Comprueba el parser con n mensajes sin terminador. Cada mensaje llega
+    entero o partido en varios trozos, y se llama a flush() cuando ya no
+    llegan más datos. Algunos son CALL_END sin nick, que también se tienen
+    que entregar. Devuelve True si se recuperan exactamente los mismos mensajes
+    """
+    rnd = random.Random(semilla)
+    originales = [mensaje_aleatorio(rnd) if rnd.random() < 0.9 else "CALL_END"
+                  for _ in range(n)]
+
+    parser = ParserControl()
+    recibidos = []
+    for m in originales:
+        data = m.encode('utf-8')
+        n_cortes = min(len(data) - 1, rnd.randint(0, 3))
+        cortes = sorted(rnd.sample(range(1, len(data)), n_cortes))
+        for a, b in zip([0] + cortes, cortes + [len(data)]):
+            recibidos.extend(parser.feed(data[a:b]))
+        recibidos.extend(parser.flush())
+
+    return recibidos == originales and not parser.entramado
+
+
+class _App():
+    def queueFunction(self, func, *args, **kwargs):
+        func(*args, **kwargs)
+
+
+class GuiFalsa():
+    """ Gui sin ventanas que cuenta los callbacks de la llamada
+    """
+
+    def __init__(self):
+        self.app = _App()
+        self.llamadas = 0
+        self.pausas = 0
+        self.reanudaciones = 0
+        self.finales = 0
+
+    def callback_calling(self, udp_port_dest=None, addr_dest=None):
+        self.llamadas += 1
+
+    def callback_call_pause(self):
+        self.pausas += 1
+
+    def callback_call_resume(self):
+        self.reanudaciones += 1
+
+    def callback_call_end(self):
+        self.finales += 1
+
+    def callback_connection_closed_unexpectedly(self):
+        pass
+
+
+def pipeline(n, puerto):
+    """ Manda n pares CALL_HOLD/CALL_RESUME seguidos por una sola conexión.
+    Devuelve la tupla (gui, segundos)
+    """
+    gui = GuiFalsa()
+    control = Control(gui, puerto)
+    control.debug = False
+
+    flujo = empaquetar("CALLING bench 6000") + \
+        b''.join(empaquetar("CALL_HOLD") + empaquetar("CALL_RESUME")
+                 for _ in range(n))
+
+    inicio = time.perf_counter()
+    s = socket.create_connection(('127.0.0.1', control.port))
+    s.sendall(flujo)
+
+    while gui.reanudaciones < n and time.perf_counter() - inicio < 30:
+        time.sleep(0.001)
+    segundos = time.perf_counter() - inicio
+
+    s.close()
+    control.exit()
+    return gui, segundos
+
+
+def legado(n, puerto):
+    """ Hace de cliente antiguo: manda una llamada, n pares
+    CALL_HOLD/CALL_RESUME y un CALL_END sin nick, sin terminador, cada uno en
+    su propio envio y esperando más de ESPERA_RESTO entre ellos. Los comandos
+    se parten en dos envios seguidos para que Control tenga que juntar los
+    trozos. Devuelve la gui con los callbacks recibidos
+    """
+    gui = GuiFalsa()
+    control = Control(gui, puerto)
+    control.debug = False
+
+    s = socket.create_connection(('127.0.0.1', control.port))
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    for m in ["CALLING bench 6000"] + ["CALL_HOLD", "CALL_RESUME"] * n + ["CALL_END"]:
+        data = m.encode('utf-8')
+        s.sendall(data[:len(data) // 2])
+        s.sendall(data[len(data) // 2:])
+        time.sleep(3 * ESPERA_RESTO)
+
+    inicio = time.perf_counter()
+    while gui.finales < 1 and time.perf_counter() - inicio < 5:
+        time.sleep(0.001)
+
+    s.close()
+    control.exit()
+    return gui
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Fuzz y rendimiento del parser de control')
+    parser.add_argument('--mensajes', type=int, default=20000)
+    parser.add_argument('--puerto', type=int, default=9100)
+    parser.add_argument('--semilla', type=int, default=1)
+    parser.add_argument('--legado', type=int, default=20,
+                        help='pares CALL_HOLD/CALL_RESUME del cliente sin entramado')
+    args = parser.parse_args()
+
+    correcto, velocidad = fuzz(args.mensajes, args.semilla)
+    correcto_legado = fuzz_legado(args.mensajes, args.semilla)
+    gui, segundos = pipeline(args.mensajes // 2, args.puerto)
+    gui_legado = legado(args.legado, args.puerto + 1)
+
+    print(json.dumps({
+        'fuzz_correcto': correcto,
+        'fuzz_mensajes_s': round(velocidad),
+        'fuzz_legado_correcto': correcto_legado,
+        'pipeline_comandos': 1 + 2 * (args.mensajes // 2),
+        'pipeline_llamadas': gui.llamadas,
+        'pipeline_pausas': gui.pausas,
+        'pipeline_reanudaciones': gui.reanudaciones,
+        'pipeline_segundos': round(segundos, 4),
+        'legado_comandos': 2 + 2 * args.legado,
+        'legado_llamadas': gui_legado.llamadas,
+        'legado_pausas': gui_legado.pausas,
+        'legado_reanudaciones': gui_legado.reanudaciones,
+        'legado_finales': gui_legado.finales,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Generador de carga contra el servidor de descubrimiento local. Arranca
+un ServidorDescubrimiento con usuarios sintéticos y lanza N clientes Server
+concurrentes, cada uno en su hilo, que se registran y mandan una mezcla de
+QUERY y LIST_USERS. Mide la latencia de cada comando y saca p50 y p99,
+junto con los aciertos, fallos y caducados de las caches de los clientes.
+
+Uso (desde el directorio practica3):
+    python3 -m bench.discovery_carga --clientes 20 --usuarios 10000
+"""
+import argparse
+import json
+import random
+import threading
+import time
+
+from src.discovery import ServidorDescubrimiento
+from src.server import Server
+
+
+def percentil(valores, p):
+    """ Devuelve el percentil p de una lista de valores, en milisegundos
+    """
+    if not valores:
+        return None
+    valores = sorted(valores)
+    idx = min(len(valores) - 1, int(round(p / 100 * (len(valores) - 1))))
+    return round(valores[idx] * 1000, 3)
+
+
+def cliente(i, args, servidor, nicks, tiempos, cache, lock):
+    """ Hilo de un cliente. Hace args.peticiones peticiones, guarda la
+    latencia de cada una en tiempos y suma sus contadores de cache en cache
+    """
+    rnd = random.Random(args.semilla + i)
+    server = Server('127.0.0.1', servidor.host, servidor.port,
+                    protocols=[0, 1], pipeline=args.pipeline)
+    propios = {'REGISTER': [], 'QUERY': [], 'QUERY_LOTE': [], 'LIST_USERS': []}
+
+    def medir(comando, func, *a):
+        inicio = time.perf_counter()
+        func(*a)
+        propios[comando].append(time.perf_counter() - inicio)
+
+    medir('REGISTER', server.register, 'carga%d' % i, 6000 + i, 'pass')
+    for _ in range(args.peticiones):
+        r = rnd.random()
+        if r < args.prob_list:
+            medir('LIST_USERS', server.list_users)
+        elif r < args.prob_list + args.prob_lote:
+            medir('QUERY_LOTE', server.query_varios,
+                  rnd.sample(nicks, args.lote), args.cache)
+        else:
+            medir('QUERY', server.query, rnd.choice(nicks), args.cache)
+
+    with lock:
+        for comando, valores in propios.items():
+            tiempos[comando].extend(valores)
+        for contador, valor in server.cache.estadisticas().items():
+            cache[contador] = cache.get(contador, 0) + valor
+    server.quit()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Carga contra el servidor de descubrimiento local')
+    parser.add_argument('--clientes', type=int, default=20)
+    parser.add_argument('--usuarios', type=int, default=10000)
+    parser.add_argument('--peticiones', type=int, default=200,
+                        help='peticiones de cada cliente')
+    parser.add_argument('--prob-list', type=float, default=0.02,
+                        help='fracción de peticiones que son LIST_USERS')
+    parser.add_argument('--prob-lote', type=float, default=0.1,
+                        help='fracción de peticiones que son lotes de QUERY')
+    parser.add_argument('--lote', type=int, default=10,
+                        help='nicks de cada lote de QUERY')
+    parser.add_argument('--cache', action='store_true',
+                        help='responder QUERY desde la cache de Server')
+    parser.add_argument('--sin-pipeline', dest='pipeline', action='store_false')
+    parser.add_argument('--semilla', type=int, default=1)
+    args = parser.parse_args()
+
+    servidor = ServidorDescubrimiento(usuarios=args.usuarios, semilla=args.semilla)
+    nicks = list(servidor.usuarios)
+
+    tiempos = {'REGISTER': [], 'QUERY': [], 'QUERY_LOTE': [], 'LIST_USERS': []}
+    cache = {}
+    lock = threading.Lock()
+    hilos = [threading.Thread(target=cliente,
+                              args=(i, args, servidor, nicks, tiempos, cache, lock))
+             for i in range(args.clientes)]
+
+    inicio = time.perf_counter()
+    for t in hilos:
+        t.start()
+    for t in hilos:
+        t.join()
+    segundos = time.perf_counter() - inicio
+
+    servidor.exit()
+
+    print(json.dumps({
+        'clientes': args.clientes,
+        'usuarios': args.usuarios,
+        'pipeline': args.pipeline,
+        'cache': args.cache,
+        'segundos': round(segundos, 3),
+        'peticiones_s': round(sum(len(v) for v in tiempos.values()) / segundos),
+        # Suma de las caches de todos los clientes
+        'cache_usuarios': cache,
+        'comandos': {
+            comando: {
+                'n': len(valores),
+                'p50_ms': percentil(valores, 50),
+                'p99_ms': percentil(valores, 99),
+            } for comando, valores in tiempos.items()
+        },
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Benchmark de FEC con perdidas inyectadas. Envia frames sintéticos por
+loopback tirando cada datagrama con una probabilidad dada y mide cuantos
+frames llegan completos, con y sin paridades, frente al ancho de banda extra.
+
+Uso (desde el directorio practica3):
+    python3 -m bench.fec_perdidas --frames 300 --perdidas 0.01,0.05 --k 0,1,2
+"""
+import argparse
+import os
+import random
+import socket
+
+from src.batchio import LectorLotes, enviar_lote
+from src.fec import generar_paridades
+from src.fragment import MAX_DATAGRAMA, fragmentar, Reensamblador
+
+
+def ejecutar(frames, tam_frame, perdidas, k, semilla):
+    """ Envia frames por loopback con perdidas y devuelve la tupla
+    (frames completos, bytes de datos, bytes de paridad)
+    ARGS:
+        frames: número de frames a enviar
+        tam_frame: tamaño de cada frame en bytes
+        perdidas: probabilidad de perder cada datagrama
+        k: paridades por grupo de fragmentos
+        semilla: semilla del generador aleatorio
+    """
+    rnd = random.Random(semilla)
+    rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    rx.bind(('127.0.0.1', 0))
+    tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    destino = rx.getsockname()
+
+    lector = LectorLotes(rx)
+    reensamblador = Reensamblador()
+    completos = 0
+    bytes_datos = 0
+    bytes_paridad = 0
+
+    for frame_id in range(1, frames + 1):
+        data = os.urandom(tam_frame)
+        datagramas = fragmentar(frame_id, data)
+        paridades = generar_paridades(frame_id, [d[1] for d in datagramas], k)
+
+        # Ningún datagrama puede necesitar fragmentación IP
+        assert all(len(h) + len(c) <= MAX_DATAGRAMA for h, c in datagramas + paridades)
+
+        bytes_datos += sum(len(h) + len(c) for h, c in datagramas)
+        bytes_paridad += sum(len(h) + len(c) for h, c in paridades)
+
+        enviados = [d for d in datagramas + paridades if rnd.random() >= perdidas]
+        enviar_lote(tx, destino, enviados)
+
+        # Vaciamos el socket antes de mandar el siguiente frame
+        while True:
+            try:
+                lote = lector.leer(timeout=0.01)
+            except socket.timeout:
+                break
+            for datagrama in lote:
+                if reensamblador.add(datagrama) is not None:
+                    completos += 1
+
+    rx.close()
+    tx.close()
+    return completos, bytes_datos, bytes_paridad
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de FEC con perdidas')
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--tam', type=int, default=60000,
+                        help='tamaño de cada frame en bytes')
+    parser.add_argument('--perdidas', default='0.01,0.02,0.05,0.1')
+    parser.add_argument('--k', default='0,1,2,3,4')
+    parser.add_argument('--semilla', type=int, default=1)
+    args = parser.parse_args()
+
+    print("{:>8} {:>3} {:>10} {:>10}".format(
+        "perdidas", "k", "frames_ok", "overhead"))
+
+    for perdidas in map(float, args.perdidas.split(',')):
+        for k in map(int, args.k.split(',')):
+            completos, datos, paridad = ejecutar(
+                args.frames, args.tam, perdidas, k, args.semilla)
+            print("{:>8.3f} {:>3} {:>9.1f}% {:>9.1f}%".format(
+                perdidas, k, 100 * completos / args.frames, 100 * paridad / datos))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""Benchmark del parseo de LIST_USERS con listas sintéticas de usuarios.
+Compara el parser incremental de Server.list_users con el parseo anterior,
+que volvia a pasar la expresión regular sobre todo el buffer tras cada recv.
+Los dos leen la respuesta de un servidor local por TCP.
+
+Uso (desde el directorio practica3):
+    python3 -m bench.list_users --usuarios 10000,50000,100000
+"""
+import argparse
+import json
+import random
+import re
+import socket
+import threading
+import time
+
+from src.server import Server
+from src.user import User
+
+
+def servir(srv, respuesta):
+    """ Servidor de descubrimiento mínimo que contesta siempre con la misma
+    lista de usuarios
+    """
+    while True:
+        c, _ = srv.accept()
+        while True:
+            data = c.recv(1024)
+            if not data or data.startswith(b'QUIT'):
+                break
+            c.sendall(respuesta)
+        c.close()
+
+
+def generar_respuesta(n, semilla):
+    """ Genera una respuesta de LIST_USERS con n usuarios. Algunos nicks
+    llevan espacios y '#' como en el servidor real
+    """
+    rnd = random.Random(semilla)
+    usuarios = []
+    for i in range(n):
+        nick = rnd.choice(['user%d', 'us#er%d', 'el usuario %d', '#%d#']) % i
+        usuarios.append("{} 10.{}.{}.{} {} {}.{}#".format(
+            nick, rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(1, 254),
+            rnd.randint(1024, 65535), rnd.randint(1500000000, 1600000000),
+            rnd.randint(0, 99999999)))
+    return ("OK USERS_LIST %d " % n + ''.join(usuarios)).encode('utf-8')
+
+
+def list_users_antiguo(sock):
+    """ Parseo de LIST_USERS anterior al parser incremental, para comparar
+    """
+    sock.sendall(b'LIST_USERS')
+    frame1 = sock.recv(30)
+    words = frame1.split()
+    num_users = int(words[2])
+    data = b' '.join(words[3:])
+
+    num_users_received = len(re.findall(
+        "[0-9]{7,11}.[0-9]{1,8}#", data.decode('utf-8')))
+
+    while num_users_received < num_users:
+        data += sock.recv(2048)
+        num_users_received = len(re.findall(
+            "[0-9]{7,11}.[0-9]{1,8}#", data.decode('utf-8')))
+
+    user_lst = []
+    separadores = re.findall("[0-9]{7,11}.[0-9]{1,8}#", data.decode('utf-8'))
+    last_idx = 0
+    data_decoded = data.decode('utf-8')
+    for separador in separadores:
+        idx_separador = data_decoded.index(separador, last_idx)
+        raw_user_data = data_decoded[last_idx:idx_separador + len(separador) - 1]
+        last_idx = idx_separador + len(separador)
+        dat = raw_user_data.split()
+        user_lst.append(User(dat[0], dat[1], dat[2], dat[3] if len(dat) == 4 else None))
+    return user_lst
+
+
+def medir(func, *args):
+    inicio = time.perf_counter()
+    resultado = func(*args)
+    return resultado, time.perf_counter() - inicio
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de LIST_USERS')
+    parser.add_argument('--usuarios', default='10000,25000,50000,100000')
+    parser.add_argument('--max-antiguo', type=int, default=25000,
+                        help='no medir el parseo anterior por encima de este tamaño')
+    parser.add_argument('--semilla', type=int, default=1)
+    args = parser.parse_args()
+
+    resultados = []
+    for n in map(int, args.usuarios.split(',')):
+        respuesta = generar_respuesta(n, args.semilla)
+
+        srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        srv.bind(('127.0.0.1', 0))
+        srv.listen(1)
+        t = threading.Thread(target=servir, args=(srv, respuesta))
+        t.daemon = True
+        t.start()
+
+        server = Server('127.0.0.1', '127.0.0.1', srv.getsockname()[1])
+        users, segundos = medir(server.list_users)
+        server.quit()
+
+        fila = {'usuarios': n, 'bytes': len(respuesta),
+                'recibidos': len(users), 'segundos': round(segundos, 4)}
+
+        if n <= args.max_antiguo:
+            sock = socket.create_connection(srv.getsockname())
+            _, segundos = medir(list_users_antiguo, sock)
+            sock.close()
+            fila['segundos_antiguo'] = round(segundos, 4)
+
+        resultados.append(fila)
+
+    print(json.dumps(resultados, indent=2))
+
+
+if __name__ == '__main__':
+    main()
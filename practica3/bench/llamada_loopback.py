@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""Benchmark de una videollamada completa por localhost, sin ventanas.
+Crea dos extremos con su Control y su UDPControl reales, establece la
+llamada con la señalización de siempre y envia en los dos sentidos frames
+sintéticos o los de un fichero de video. Al terminar saca en JSON la
+latencia de captura a pantalla, los fps conseguidos, las perdidas y el
+tiempo de CPU de cada etapa.
+
+La latencia se mide con el timestamp de captura de la cabecera; en
+localhost los dos extremos comparten reloj.
+
+También se sacan los frames que no se han podido enviar y los datagramas
+que ha tirado el kernel por tener lleno el buffer de recepción
+(RcvbufErrors de /proc/net/snmp). Este contador es de toda la máquina, no
+solo de la llamada. En V0 cada frame va en un solo datagrama, así que a
+partir de 720p casi todos pasan de 65507 bytes y no llega ninguno.
+
+Uso (desde el directorio practica3):
+    python3 -m bench.llamada_loopback --segundos 10 --version 1
+    python3 -m bench.llamada_loopback --video prueba.mp4
+"""
+import argparse
+import json
+import re
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from src.capture import Captura
+from src.control import Control
+from src.udp import UDPControl
+from src.user import User
+
+
+class FuenteSintetica():
+    """ Fuente de video con el interfaz de cv2.VideoCapture. Genera una
+    textura que se desplaza en cada frame para que la compresión trabaje
+    como con video real
+    """
+
+    def __init__(self, width, height, semilla=1):
+        rnd = np.random.RandomState(semilla)
+        ruido = rnd.randint(0, 256, (height // 8, width // 8, 3), np.uint8)
+        self.base = cv2.resize(ruido, (width, height),
+                               interpolation=cv2.INTER_LINEAR)
+        self.n = 0
+
+    def read(self):
+        self.n += 1
+        return True, np.roll(self.base, 4 * self.n, axis=1)
+
+    def set(self, prop, valor):
+        pass
+
+    def release(self):
+        pass
+
+
+class _App():
+    """ Sustituto de appJar: ejecuta los callbacks en el momento
+    """
+
+    def queueFunction(self, func, *args, **kwargs):
+        func(*args, **kwargs)
+
+    def setStatusbar(self, *args, **kwargs):
+        pass
+
+
+class Extremo():
+    """ Un extremo de la llamada. Hace de gui para Control y UDPControl y
+    guarda el instante en el que se muestra cada frame
+    """
+
+    def __init__(self, nombre, args, puerto_control, puerto_udp):
+        self.app = _App()
+        self.nombre = nombre
+        self.args = args
+        self.latencias = []
+        self.lock = threading.Lock()
+        self.en_llamada = threading.Event()
+        self.captura = None
+
+        self.control = Control(self, puerto_control)
+        self.control.debug = False
+        self.udp_control = UDPControl(self, puerto_udp,
+                                      retardo_jitter=args.jitter,
+                                      lotes=not args.sin_lotes,
+                                      fec=not args.sin_fec,
+                                      salida_video=self.mostrar)
+        self.udp_control.version = args.version
+        self.user = User(nombre, '127.0.0.1', self.control.port)
+        self.user.udpport = self.udp_control.listen_port
+
+    def mostrar(self, info, imagen):
+        """ Salida de video del decodificador: apunta la latencia del frame
+        """
+        latencia = time.time() - info.timestamp_us / 1000000
+        with self.lock:
+            self.latencias.append(latencia)
+
+    def empezar(self, udp_port_dest, addr_dest):
+        """ Arranca el envio y la recepción de video con el otro extremo
+        """
+        self.udp_control.udp_port_dest = udp_port_dest
+        self.udp_control.addr_dest = addr_dest
+        self.udp_control.empezar_videollamada()
+
+        if self.args.video:
+            cap = cv2.VideoCapture(self.args.video)
+        else:
+            w, h = map(int, self.args.resolucion.split('x'))
+            cap = FuenteSintetica(w, h)
+
+        self.captura = Captura(cap, self.udp_control, lambda: True,
+                               fps=self.args.fps, calidad=self.args.calidad,
+                               tasa=None if self.args.sin_tasa else self.udp_control.tasa)
+        self.captura.start()
+        self.en_llamada.set()
+
+    def parar(self):
+        """ Para la captura, los hilos de video y el de control y espera a
+        que terminen antes de que se cierre el interprete
+        """
+        if self.captura:
+            self.captura.stop()
+            self.captura.cap.release()
+        self.udp_control.parar()
+        self.control.exit()
+
+    # Callbacks de Control
+    def callback_calling(self, udp_port_dest=None, addr_dest=None):
+        self.control.call_accepted(self.nombre, self.udp_control.port)
+        self.empezar(udp_port_dest, addr_dest)
+
+    def callback_accepted_or_denied(self, respuesta, udp_port_dest=None, addr_dest=None):
+        if respuesta == 1:
+            self.empezar(udp_port_dest, addr_dest)
+
+    def callback_call_end(self):
+        pass
+
+    def callback_call_busy(self, nick):
+        pass
+
+    def callback_call_pause(self):
+        pass
+
+    def callback_call_resume(self):
+        pass
+
+    def callback_connection_closed_unexpectedly(self):
+        pass
+
+    def resultados(self, segundos):
+        """ Devuelve las estadisticas de lo que ha recibido y mostrado este extremo
+        """
+        udp = self.udp_control
+        with self.lock:
+            latencias = sorted(self.latencias)
+
+        res = {
+            'frames_mostrados': len(latencias),
+            'fps_mostrados': round(len(latencias) / segundos, 2),
+            'frames_completos': udp.reensamblador.completos,
+            'frames_incompletos': udp.reensamblador.descartados,
+            'frames_recuperados_fec': udp.reensamblador.recuperados,
+            'fragmentos_recibidos': udp.reensamblador.fragmentos_recibidos,
+            'fragmentos_esperados': udp.reensamblador.fragmentos_esperados,
+            'latencia_ms': {
+                'p50': percentil(latencias, 50),
+                'p95': percentil(latencias, 95),
+                'p99': percentil(latencias, 99),
+            },
+            'nivel_tasa': udp.tasa.parametros(),
+        }
+        res.update(udp.jitter.estadisticas())
+        res.update(udp.decoder.estadisticas())
+        return res
+
+    def resultados_envio(self, segundos):
+        """ Devuelve las estadisticas de lo que ha capturado y enviado este extremo
+        """
+        return {
+            'frames_capturados': self.captura.capturados,
+            'fps_capturados': round(self.captura.capturados / segundos, 2),
+            'capturas_retrasadas': self.captura.retrasados,
+            'frames_enviados': self.udp_control.frame_count,
+            'frames_no_enviados': self.udp_control.frames_no_enviados,
+            'cola_envio': self.udp_control.queue_in.estadisticas(),
+        }
+
+
+def percentil(valores, p):
+    """ Devuelve el percentil p de una lista ordenada, en milisegundos
+    """
+    if not valores:
+        return None
+    idx = min(len(valores) - 1, int(round(p / 100 * (len(valores) - 1))))
+    return round(valores[idx] * 1000, 2)
+
+
+def contadores_udp():
+    """ Devuelve los contadores UDP del kernel de /proc/net/snmp, o un
+    diccionario vacio si no existe (fuera de Linux)
+    """
+    try:
+        with open('/proc/net/snmp') as fp:
+            lineas = [l.split() for l in fp if l.startswith('Udp:')]
+    except OSError:
+        return {}
+    if len(lineas) < 2:
+        return {}
+    return dict(zip(lineas[0][1:], map(int, lineas[1][1:])))
+
+
+def cpu_hilos():
+    """ Devuelve un diccionario con los segundos de CPU de cada etapa, sumando
+    los hilos que ejecutan la misma función. Los hilos se identifican por el
+    nombre que les pone threading: Thread-N (funcion)
+    """
+    cpu = {}
+    for t in threading.enumerate():
+        m = re.search(r'\((\w+)\)', t.name)
+        if not m or t.ident is None:
+            continue
+        try:
+            reloj = time.pthread_getcpuclockid(t.ident)
+            segundos = time.clock_gettime(reloj)
+        except (AttributeError, OSError):
+            continue
+        cpu[m.group(1)] = cpu.get(m.group(1), 0) + segundos
+    return cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Videollamada completa por localhost sin ventanas')
+    parser.add_argument('--segundos', type=float, default=10)
+    parser.add_argument('--version', type=int, default=1, choices=[0, 1])
+    parser.add_argument('--video', default=None,
+                        help='fichero de video en lugar de frames sintéticos')
+    parser.add_argument('--resolucion', default='640x480')
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--calidad', type=int, default=50)
+    parser.add_argument('--jitter', type=float, default=0.1,
+                        help='retardo del buffer de jitter en segundos')
+    parser.add_argument('--sin-tasa', action='store_true',
+                        help='no adaptar la calidad a los informes de recepción')
+    parser.add_argument('--sin-fec', action='store_true')
+    parser.add_argument('--sin-lotes', action='store_true')
+    parser.add_argument('--puerto', type=int, default=9200)
+    args = parser.parse_args()
+
+    a = Extremo('a', args, args.puerto, args.puerto + 100)
+    b = Extremo('b', args, args.puerto + 10, args.puerto + 200)
+
+    if not a.control.llamar(a.user, b.user):
+        raise Exception("No se ha podido establecer la llamada")
+    if not (a.en_llamada.wait(5) and b.en_llamada.wait(5)):
+        raise Exception("La llamada no ha empezado")
+
+    cpu_inicio = cpu_hilos()
+    udp_inicio = contadores_udp()
+    inicio = time.monotonic()
+    time.sleep(args.segundos)
+    segundos = time.monotonic() - inicio
+    cpu_fin = cpu_hilos()
+    udp_fin = contadores_udp()
+
+    a.control.call_end(a.nombre)
+    resultados = {
+        'segundos': round(segundos, 3),
+        'version': args.version,
+        'fuente': args.video or 'sintetica %s' % args.resolucion,
+        'a_a_b': dict(b.resultados(segundos), **a.resultados_envio(segundos)),
+        'b_a_a': dict(a.resultados(segundos), **b.resultados_envio(segundos)),
+        # Datagramas descartados por el kernel durante la llamada
+        'kernel_udp': {
+            contador: udp_fin[contador] - udp_inicio[contador]
+            for contador in ('RcvbufErrors', 'InErrors')
+            if contador in udp_fin and contador in udp_inicio
+        },
+        # CPU de los dos extremos sumados, en segundos de CPU por segundo
+        'cpu_etapas': {
+            etapa: round((cpu_fin[etapa] - cpu_inicio.get(etapa, 0)) / segundos, 4)
+            for etapa in sorted(cpu_fin)
+        },
+    }
+    a.parar()
+    b.parar()
+
+    print(json.dumps(resultados, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Modulo de entrada/salida de datagramas por lotes. Python no expone
+recvmmsg/sendmmsg, asi que se aproximan: en recepción, una sola espera con
+select y después se vacia el socket con recv_into sobre buffers reservados de
+antemano; en envio, sendmsg con la cabecera y el trozo del frame por separado
+para no concatenarlos.
+"""
+import select
+import socket
+
+# Tamaño máximo de un datagrama UDP
+MAX_DATAGRAMA = 65535
+
+# sendmsg no existe en todas las plataformas (por ejemplo Windows)
+HAY_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+
+class LectorLotes():
+    def __init__(self, sock, tam_lote=64):
+        """ Reserva los buffers de recepción y pone el socket en modo no bloqueante
+        ARGS:
+            sock: socket UDP del que se lee
+            tam_lote: número máximo de datagramas que se leen de una vez
+        """
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.buffers = [bytearray(MAX_DATAGRAMA) for _ in range(tam_lote)]
+        self.vistas = [memoryview(b) for b in self.buffers]
+
+        # Estadisticas
+        self.lecturas = 0
+        self.datagramas = 0
+
+    def leer(self, timeout):
+        """ Espera a que haya datos y lee todos los datagramas disponibles, hasta
+        llenar el lote. Devuelve una lista de memoryviews que solo son validas
+        hasta la siguiente llamada. Lanza socket.timeout si no llega nada
+        ARGS:
+            timeout: segundos de espera máxima
+        """
+        rl, _, _ = select.select([self.sock], [], [], timeout)
+        if not rl:
+            raise socket.timeout
+
+        lote = []
+        for vista in self.vistas:
+            try:
+                n = self.sock.recv_into(vista)
+            except (BlockingIOError, InterruptedError):
+                break
+            lote.append(vista[:n])
+
+        self.lecturas += 1
+        self.datagramas += len(lote)
+        return lote
+
+
+def enviar_lote(sock, destino, datagramas):
+    """ Envia una lista de datagramas. Cada datagrama es una lista de buffers
+    que se envian juntos con sendmsg, sin copiarlos a un solo bytes
+    ARGS:
+        sock: socket UDP por el que se envia
+        destino: tupla (ip, puerto) de destino
+        datagramas: lista de listas de buffers
+    """
+    if HAY_SENDMSG:
+        for buffers in datagramas:
+            sock.sendmsg(buffers, [], 0, destino)
+    else:
+        for buffers in datagramas:
+            sock.sendto(b''.join(buffers), destino)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Modulo de captura de video. Un hilo dedicado lee frames de la webcam o de
+un fichero, los comprime a JPG y los mete en la cola de envio de UDPControl
+a un ritmo fijo, sin pasar por el hilo de la GUI.
+"""
+import cv2
+import threading
+import time
+
+
+class Captura():
+    def __init__(self, cap, udp_control, activo, fps=30, calidad=50, preview=None, tasa=None):
+        """ Crea el hilo de captura, sin arrancarlo
+        ARGS:
+            cap: fuente de video con el interfaz de cv2.VideoCapture
+            udp_control: instancia de UDPControl a cuya cola se envian los frames
+            activo: función sin argumentos que indica si hay que enviar video
+            fps: frames por segundo que se capturan
+            calidad: calidad JPG de 0 a 100
+            preview: función opcional a la que se pasa cada frame reducido
+            para la vista previa local
+            tasa: ControlTasa opcional del que se leen la calidad, la escala y
+            los fps antes de cada frame
+        """
+        self.cap = cap
+        self.udp_control = udp_control
+        self.activo = activo
+        self.fps = fps
+        self.calidad = calidad
+        self.escala = 1.0
+        self.preview = preview
+        self.tasa = tasa
+
+        self.parar = False
+        self.hilo = None
+
+        # Estadisticas
+        self.capturados = 0
+        self.retrasados = 0
+
+    def start(self):
+        """ Arranca el hilo de captura
+        """
+        self.parar = False
+        self.hilo = threading.Thread(target=self.capturar)
+        self.hilo.daemon = True
+        self.hilo.start()
+
+    def stop(self):
+        """ Para el hilo de captura y espera a que termine, para que se pueda
+        liberar la fuente de video de forma segura
+        """
+        self.parar = True
+        if self.hilo is not None and self.hilo is not threading.current_thread():
+            self.hilo.join()
+        self.hilo = None
+
+    def capturar(self):
+        """ Hilo de captura. Los instantes de captura se calculan sumando el
+        periodo al instante anterior, no al final del trabajo, para que el
+        intervalo entre frames no acumule deriva. Si el hilo se retrasa más de
+        un periodo se saltan los frames perdidos en lugar de intentar recuperarlos
+        """
+        siguiente = time.monotonic()
+
+        while not self.parar:
+            if self.tasa:
+                self.calidad, self.escala, self.fps = self.tasa.parametros()
+
+            if self.activo():
+                self.capturar_frame()
+
+            periodo = 1 / self.fps
+            siguiente += periodo
+            espera = siguiente - time.monotonic()
+
+            if espera > 0:
+                time.sleep(espera)
+            elif -espera > periodo:
+                self.retrasados += 1
+                siguiente = time.monotonic()
+
+    def capturar_frame(self):
+        """ Captura un frame, lo comprime a JPG y lo añade a la cola de envio
+        """
+        # Capturamos un frame de la cámara o del vídeo
+        ret, frame = self.cap.read()
+        timestamp = time.time()
+
+        if not ret:
+            # Fin del fichero de video, volvemos a empezar
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            return
+
+        if self.preview:
+            self.preview(cv2.resize(frame, (128, 96)))
+
+        if self.escala != 1.0:
+            frame = cv2.resize(frame, None, fx=self.escala, fy=self.escala,
+                               interpolation=cv2.INTER_AREA)
+
+        # Compresión JPG (se puede variar la calidad)
+        encode_param = [cv2.IMWRITE_JPEG_QUALITY, self.calidad]
+        result, encimg = cv2.imencode('.jpg', frame, encode_param)
+
+        if result == False:
+            print('Error al codificar imagen')
+            return
+
+        self.capturados += 1
+
+        # Añadimos a la cola junto con el instante de captura y la resolución
+        height, width = frame.shape[:2]
+        self.udp_control.queue_in.put(
+            (timestamp, width, height, encimg.tobytes()))
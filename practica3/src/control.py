@@ -2,17 +2,17 @@
 """Modulo de Control de llamdas
 """
 import socket
+import selectors
 import threading
-import socket
-import select
-import threading
+import queue
 import time
+from src.framing import ParserControl, empaquetar, ESPERA_RESTO
 
 
 class Control():
     def __init__(self, gui, port=8080):
-        """Inicializa esta clase. Crea los sockets e hilos necesarios para
-        enviar y recibir llamadas
+        """Inicializa esta clase. Crea el socket de escucha y el hilo que atiende
+        todas las conexiones de control con un único bucle de eventos
         ARGS:
             gui: instancia de la gui de la aplicación
             port: puerto por defecto en el que se esperan conexiones. puede cambiar si el proporcionado
@@ -29,13 +29,10 @@ class Control():
         self.socket_in = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket_in.setblocking(False)
 
-        self.inputs = [self.socket_in]
-        self.outputs = []
-
         while port < 65535:
             try:
                 self.socket_in.bind(('0.0.0.0', port))
-                self.socket_in.listen(1)
+                self.socket_in.listen(128)
                 self.port = port
                 break
             except:
@@ -49,131 +46,352 @@ class Control():
 
         self.busy = False
 
-        # Crea el hilo que accepta peticiones
+        # El bucle de eventos vigila el socket de escucha, todas las conexiones
+        # y un par de sockets que sirve para despertarlo desde otros hilos
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket_in, selectors.EVENT_READ, None)
+
+        self.despertador, self.despertador_out = socket.socketpair()
+        self.despertador.setblocking(False)
+        self.despertador_out.setblocking(False)
+        self.selector.register(self.despertador, selectors.EVENT_READ, None)
+
+        # Funciones que otros hilos piden ejecutar dentro del bucle
+        self.pendientes = queue.Queue()
+
+        # Conexiones con un mensaje sin terminador pendiente y el instante en
+        # el que recibieron datos por última vez
+        self.con_resto = {}
+
+        # Cola de salida de cada conexión con lo que falta por enviar, y
+        # conexiones que hay que cerrar cuando se vacie su cola
+        self.salida = {}
+        self.por_cerrar = set()
+
+        # Crea el hilo del bucle de eventos
         t = threading.Thread(target=self.connection_loop)
         t.daemon = True
         t.start()
 
     def exit(self):
         """Función que cambia el flag stop_threads indicando que los hilos creados por esta instancia
-        deben cerrarse
+        deben cerrarse y despierta el bucle para que lo vea inmediatamente
         """
         self.stop_threads = True
+        self.despertar()
 
-    def connection_loop(self):
-        """Hilo que está esperando recibir conexiones. Cuando recibe una conexión lanza otro hilo
-        que atiende los mensajes enviados por esa conexión
+    def despertar(self):
+        """Despierta al bucle de eventos si está esperando en el selector
         """
+        try:
+            self.despertador_out.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
 
-        while True:
-            # comprobamos si se puede hacer un accept usando un timeout de 0.5 segundos
-            rl, wl, _ = select.select(
-                self.inputs, self.outputs, self.inputs, 0.5)
-            for s in rl:
-                conn, addr = s.accept()
-                t = threading.Thread(
-                    target=self.client_thread, args=(conn, addr))
-                t.daemon = True
-                t.start()
-
-            # si el timeout ha terminado y se ha recibido la señal para parar hilos
-            if len(rl) == 0 and self.stop_threads:
-                self.socket_in.close()
-                break  # terminamos thread
-
-    def client_thread(self, conn, addr):
-        """ Hilo que está esperando a recibir mensajes de una conexión tcp.
+    def en_bucle(self, func, *args):
+        """Pide que se ejecute una función dentro del hilo del bucle de eventos.
+        Es la forma segura de registrar o cerrar sockets desde otros hilos
         ARGS:
-            conn: socket TCP en el que se escucha
-            addr: dirección ip del otro extremo de la conexión TCP
+            func: función a ejecutar
+            args: argumentos de la función
+        """
+        self.pendientes.put((func, args))
+        self.despertar()
+
+    def callback(self, func, *args):
+        """Invoca un callback de la gui en el hilo de la gui
+        ARGS:
+            func: callback de la gui
+            args: argumentos del callback
+        """
+        self.gui.app.queueFunction(func, *args)
 
+    def connection_loop(self):
+        """Hilo del bucle de eventos. Acepta conexiones nuevas y lee los mensajes de
+        todas las conexiones abiertas sin crear un hilo por conexión
+        """
+
+        while not self.stop_threads:
+            timeout = ESPERA_RESTO if self.con_resto else None
+            for key, eventos in self.selector.select(timeout):
+                if key.fileobj is self.socket_in:
+                    self.aceptar()
+                elif key.fileobj is self.despertador:
+                    try:
+                        while self.despertador.recv(1024):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    if eventos & selectors.EVENT_WRITE:
+                        self.escribir(key.fileobj)
+                    # Puede que la conexión se haya cerrado al escribir
+                    if eventos & selectors.EVENT_READ and key.fileobj.fileno() >= 0:
+                        self.atender(key.fileobj, key.data)
+
+            while not self.pendientes.empty():
+                func, args = self.pendientes.get()
+                func(*args)
+
+            if self.con_resto:
+                self.procesar_restos()
+
+        # Cerramos todas las conexiones al terminar
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+        self.despertador_out.close()
+
+    def aceptar(self):
+        """Acepta una conexión entrante y la añade al bucle de eventos
+        """
+        try:
+            conn, addr = self.socket_in.accept()
+        except (BlockingIOError, ConnectionAbortedError):
+            return
+        self.registrar(conn, addr)
+
+    def registrar(self, conn, addr):
+        """Añade una conexión al bucle de eventos. Solo se puede llamar desde el
+        hilo del bucle
+        ARGS:
+            conn: socket TCP de la conexión
+            addr: dirección del otro extremo de la conexión TCP
         """
         conn.setblocking(False)
-        _in = [conn]
+        self.selector.register(conn, selectors.EVENT_READ,
+                               (addr, ParserControl()))
 
-        while True:
-            _in = list(filter(lambda x: x._closed == False, _in))
-            if not _in:
+    def cerrar(self, conn):
+        """Quita una conexión del bucle de eventos y la cierra. Solo se puede
+        llamar desde el hilo del bucle
+        ARGS:
+            conn: socket TCP de la conexión
+        """
+        self.con_resto.pop(conn, None)
+        self.salida.pop(conn, None)
+        self.por_cerrar.discard(conn)
+        if conn.fileno() >= 0:
+            try:
+                self.selector.unregister(conn)
+            except (KeyError, ValueError):
+                pass
+        conn.close()
+
+    def enviar(self, c, data, cerrar=False):
+        """Manda datos por una conexión sin bloquear el bucle. Lo que no cabe
+        en el buffer del socket se queda en la cola de salida de la conexión y
+        se manda cuando se pueda escribir. Solo se puede llamar desde el hilo
+        del bucle; desde otros hilos hay que usar en_bucle
+        ARGS:
+            c: socket TCP de la conexión
+            data: bytes a enviar
+            cerrar: cerrar la conexión cuando se haya enviado todo. Mientras
+            tanto no se leen más mensajes de ella
+        """
+        # La conexión se ha podido cerrar antes de que llegue la petición
+        if c is None or c.fileno() < 0 or c not in self.selector.get_map():
+            return
+
+        self.salida.setdefault(c, bytearray()).extend(data)
+        if cerrar:
+            self.por_cerrar.add(c)
+        self.escribir(c)
+
+    def escribir(self, c):
+        """Envia todo lo que se pueda de la cola de salida de una conexión y
+        ajusta los eventos que se vigilan de ella. Solo se puede llamar desde
+        el hilo del bucle
+        ARGS:
+            c: socket TCP de la conexión
+        """
+        salida = self.salida.get(c)
+        try:
+            while salida:
+                del salida[:c.send(salida)]
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            if self.debug:
+                print("Error enviando mensaje: %s" % e)
+            self.cerrar_con_error(c)
+            return
+
+        if not salida:
+            self.salida.pop(c, None)
+            if c in self.por_cerrar:
+                self.cerrar(c)
                 return
 
-            rl, _, _ = select.select(_in, [], _in, 0.2)
-            for c in rl:
-                try:
-                    data = conn.recv(1024)
-                except ConnectionResetError:
-                    return
-
-                if not data:
-                    conn.close()
-                    if c is self.llamada_actual:
-                        self.gui.callback_connection_closed_unexpectedly()
-                    self.busy = False
-                    return
-
-                # Pasamos a string
-                request = data.decode('utf-8')
-
-                if self.debug:
-                    print("OUT -> IN: %s" % request)
-
-                # separamos en palabras
-                w = request.split()
-
-                # Parseamos en funcioón del mensaje recibido e invocamos
-                # los callbacks de la gui correspondientes
-                if request.startswith("CALLING"):
-                    if self.busy:
-                        conn.send(b"CALL_BUSY")
-                        conn.close()
-                        self.gui.callback_call_busy(w[1])
-                        break
-                    else:
-                        self.busy = True
-                        self.llamada_actual = conn
-                        self.src_nick = w[1]
-                        self.src_port = int(w[2])
-                        self.gui.callback_calling(self.src_port, addr[0])
-                elif request.startswith("CALL_ACCEPTED"):
-                    if self.llamada_actual == None:
-                        self.llamada_actual = conn
-                        self.gui.callback_accepted_or_denied(
-                            1, int(w[2]), addr[0])
-                    else:
-                        conn.close()
-                        return
-                elif request.startswith("CALL_END"):
-                    if c is self.llamada_actual:
-                        self.llamada_actual = None
-                        c.close()
-                        self.busy = False
-                        self.gui.callback_call_end()
-                        return
-                elif request.startswith("CALL_DENIED"):
-                    self.busy = False
-                    conn.close()
-                    self.gui.callback_accepted_or_denied(0)
-                elif request.startswith("CALL_HOLD"):
-                    if c is self.llamada_actual:
-                        self.gui.callback_call_pause()
-                    else:
-                        c.close()
-                        return
-                elif request.startswith("CALL_RESUME"):
-                    if c is self.llamada_actual:
-                        self.gui.callback_call_resume()
-                    else:
-                        c.close()
-                        return
-                else:
-                    c.send(b"BAD REQUEST")
-                    c.close()
-                    return
+        eventos = selectors.EVENT_WRITE if salida else 0
+        if c not in self.por_cerrar:
+            eventos |= selectors.EVENT_READ
 
-            if not rl and self.stop_threads:
-                # parar thread cuando se acctiva el flag stop_threads
-                break
+        key = self.selector.get_key(c)
+        if key.events != eventos:
+            self.selector.modify(c, eventos, key.data)
 
-    # Funciones para enviar comandos al otro extremo.
+    def atender(self, c, datos):
+        """ Lee de una conexión tcp y procesa todos los mensajes completos recibidos.
+        ARGS:
+            c: socket TCP del que se lee
+            datos: tupla (addr, parser) con la dirección del otro extremo y el
+            parser de la conexión
+
+        """
+        addr, parser = datos
+        try:
+            data = c.recv(4096)
+        except BlockingIOError:
+            return
+        except ConnectionResetError:
+            data = b''
+
+        if not data:
+            self.descartar(c)
+            return
+
+        if not self.despachar(c, addr, parser.feed(data)):
+            return
+
+        # Si queda un mensaje sin terminador de un cliente que no usa entramado
+        # lo procesamos cuando deje de llegar más
+        if parser.pendiente() and not parser.entramado:
+            self.con_resto[c] = time.monotonic()
+        else:
+            self.con_resto.pop(c, None)
+
+    def procesar_restos(self):
+        """ Procesa los mensajes sin terminador que llevan ESPERA_RESTO segundos
+        sin recibir más datos
+        """
+        ahora = time.monotonic()
+        for c, instante in list(self.con_resto.items()):
+            if ahora - instante < ESPERA_RESTO:
+                continue
+
+            del self.con_resto[c]
+            addr, parser = self.selector.get_key(c).data
+            self.despachar(c, addr, parser.flush())
+
+    def descartar(self, c):
+        """ Cierra una conexión que el otro extremo ha cerrado. Si era la de
+        la llamada en curso avisa a la gui
+        ARGS:
+            c: socket TCP de la conexión
+        """
+        self.cerrar(c)
+        if c is self.llamada_actual:
+            self.llamada_actual = None
+            self.callback(self.gui.callback_connection_closed_unexpectedly)
+        self.busy = False
+
+    def despachar(self, c, addr, requests):
+        """ Procesa una serie de mensajes de una conexión. Un mensaje mal
+        formado o un error al responder solo cierran esa conexión, para no
+        parar el bucle que atiende a todas. Devuelve False si la conexión se
+        ha cerrado
+        ARGS:
+            c: socket TCP del que se han leido los mensajes
+            addr: dirección del otro extremo de la conexión TCP
+            requests: iterable con los mensajes recibidos, sin terminador
+        """
+        try:
+            for request in requests:
+                if not self.procesar(c, addr, request):
+                    return False
+        except (ValueError, IndexError, OSError) as e:
+            if self.debug:
+                print("Error procesando mensaje de %s: %s" % (addr[0], e))
+            self.cerrar_con_error(c)
+            return False
+        return True
+
+    def cerrar_con_error(self, c):
+        """ Cierra una conexión que ha fallado. Si era la de la llamada en
+        curso avisa a la gui
+        ARGS:
+            c: socket TCP de la conexión
+        """
+        self.cerrar(c)
+        if c is self.llamada_actual:
+            self.llamada_actual = None
+            self.busy = False
+            self.callback(self.gui.callback_connection_closed_unexpectedly)
+
+    def procesar(self, c, addr, request):
+        """ Procesa un mensaje de control. Devuelve False si la conexión se ha
+        cerrado al procesarlo
+        ARGS:
+            c: socket TCP del que se ha leido el mensaje
+            addr: dirección ip del otro extremo de la conexión TCP
+            request: mensaje recibido, sin terminador
+        """
+        if self.debug:
+            print("OUT -> IN: %s" % request)
+
+        # separamos en palabras
+        w = request.split()
+
+        # CALLING y CALL_ACCEPTED llevan un nick y un puerto
+        if w and w[0] in ("CALLING", "CALL_ACCEPTED") and \
+                (len(w) != 3 or not w[2].isdigit() or not 0 < int(w[2]) < 65536):
+            self.enviar(c, empaquetar("BAD REQUEST"), cerrar=True)
+            return False
+
+        # Parseamos en funcioón del mensaje recibido e invocamos
+        # los callbacks de la gui correspondientes
+        if request.startswith("CALLING"):
+            if self.busy:
+                self.enviar(c, empaquetar("CALL_BUSY"), cerrar=True)
+                self.callback(self.gui.callback_call_busy, w[1])
+                return False
+            else:
+                self.busy = True
+                self.llamada_actual = c
+                self.src_nick = w[1]
+                self.src_port = int(w[2])
+                self.callback(self.gui.callback_calling, self.src_port, addr[0])
+        elif request.startswith("CALL_ACCEPTED"):
+            if self.llamada_actual == None:
+                self.llamada_actual = c
+                self.callback(self.gui.callback_accepted_or_denied,
+                              1, int(w[2]), addr[0])
+            else:
+                self.cerrar(c)
+                return False
+        elif request.startswith("CALL_END"):
+            if c is self.llamada_actual:
+                self.llamada_actual = None
+                self.cerrar(c)
+                self.busy = False
+                self.callback(self.gui.callback_call_end)
+                return False
+        elif request.startswith("CALL_DENIED"):
+            self.busy = False
+            self.cerrar(c)
+            self.callback(self.gui.callback_accepted_or_denied, 0)
+            return False
+        elif request.startswith("CALL_HOLD"):
+            if c is self.llamada_actual:
+                self.callback(self.gui.callback_call_pause)
+            else:
+                self.cerrar(c)
+                return False
+        elif request.startswith("CALL_RESUME"):
+            if c is self.llamada_actual:
+                self.callback(self.gui.callback_call_resume)
+            else:
+                self.cerrar(c)
+                return False
+        else:
+            self.enviar(c, empaquetar("BAD REQUEST"), cerrar=True)
+            return False
+
+        return True
+
+    # Funciones para enviar comandos al otro extremo. Se llaman desde el hilo
+    # de la gui, asi que los mensajes se mandan desde el bucle de eventos
     def llamar(self, my_user, dest_user):
         """ Realiza la llamada a otro usuario.
         ARGS:
@@ -187,9 +405,9 @@ class Control():
             # Creamos socket para cuando llammemos nosotros
             self.socket_out = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             # Le dejamos 10 segundos para conectarse
-            self.socket_out.settimeout(10)   
+            self.socket_out.settimeout(10)
             self.socket_out.connect((dest_user.ip, dest_user.port))
-            self.socket_out.settimeout(None)   
+            self.socket_out.settimeout(None)
         except (ConnectionRefusedError, socket.timeout) as _:
             return False
 
@@ -199,14 +417,9 @@ class Control():
         if self.debug:
             print("IN -> OUT: %s" % request)
 
-        # Enviamos calling
-        self.socket_out.send(request.encode('utf-8'))
-
-        # Nos ponemos a escuchar en la conexión creada
-        t = threading.Thread(target=self.client_thread,
-                             args=(self.socket_out, (dest_user.ip,)))
-        t.daemon = True
-        t.start()
+        # Añadimos la conexión creada al bucle de eventos y enviamos calling
+        self.en_bucle(self.registrar, self.socket_out, (dest_user.ip,))
+        self.en_bucle(self.enviar, self.socket_out, empaquetar(request))
 
         return True
 
@@ -221,7 +434,7 @@ class Control():
         if self.debug:
             print("IN -> OUT: %s" % request)
 
-        self.llamada_actual.send(request.encode('utf-8'))
+        self.en_bucle(self.enviar, self.llamada_actual, empaquetar(request))
 
     def call_denied(self):
         """ Manda el mensaje CALL_DENIED al otro extremo de la
@@ -232,9 +445,8 @@ class Control():
         if self.debug:
             print("IN -> OUT: %s" % request)
 
-        self.llamada_actual.send(request.encode('utf-8'))
+        self.en_bucle(self.enviar, self.llamada_actual, empaquetar(request), True)
         self.busy = False
-        self.llamada_actual.close()
         self.llamada_actual = None
 
     def call_hold(self):
@@ -245,7 +457,7 @@ class Control():
         if self.debug:
             print("IN -> OUT: %s" % request)
 
-        self.llamada_actual.send(request.encode('utf-8'))
+        self.en_bucle(self.enviar, self.llamada_actual, empaquetar(request))
 
     def call_resume(self):
         """ Envia el mensaje CALL_RESUME al otro exremo de la llamada
@@ -255,7 +467,7 @@ class Control():
         if self.debug:
             print("IN -> OUT: %s" % request)
 
-        self.llamada_actual.send(request.encode('utf-8'))
+        self.en_bucle(self.enviar, self.llamada_actual, empaquetar(request))
 
     def call_end(self, nick):
         """ Envia el mensaje CALL_END al otro extremo de la llamada
@@ -266,5 +478,5 @@ class Control():
         request = "CALL_END %s" % nick
         if self.debug:
             print("IN -> OUT: %s" % request)
-        self.llamada_actual.send(request.encode('utf-8'))
+        self.en_bucle(self.enviar, self.llamada_actual, empaquetar(request))
         self.llamada_actual = None
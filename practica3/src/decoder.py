@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""Modulo de decodificación de video. Separa la descompresión de los frames
+del hilo de recepción usando un pequeño pool de hilos (OpenCV libera el GIL
+mientras decodifica) y entrega a la GUI siempre el frame más reciente.
+"""
+from PIL import Image, ImageTk
+from collections import deque
+import numpy as np
+import cv2
+import threading
+
+
+class DecodificadorVideo():
+    def __init__(self, gui, hilos=2, max_pendientes=2, salida=None):
+        """ Crea el pool de hilos de decodificación
+        ARGS:
+            gui: instancia de la gui de la aplicación
+            hilos: número de hilos que decodifican en paralelo
+            max_pendientes: frames que pueden esperar a ser decodificados. Si llega
+            uno nuevo con la cola llena se descarta el más antiguo
+            salida: función opcional a la que se pasan el InfoFrame y la imagen de
+            cada frame en lugar de mostrarlo en la GUI
+        """
+        self.gui = gui
+        self.salida = salida
+        self.pendientes = deque(maxlen=max_pendientes)
+        self.cond = threading.Condition()
+        self.parar = False
+
+        # Último frame decodificado que aún no se ha mostrado
+        self.lock_mostrar = threading.Lock()
+        self.listo = None
+        self.mostrar_en_cola = False
+        self.ultimo_seq = None
+
+        # Estadisticas
+        self.decodificados = 0
+        self.descartados = 0
+        self.obsoletos = 0
+        self.mostrados = 0
+
+        self.hilos = []
+        for _ in range(hilos):
+            t = threading.Thread(target=self.decodificar)
+            t.daemon = True
+            t.start()
+            self.hilos.append(t)
+
+    def submit(self, info, img):
+        """ Encola un frame para decodificarlo. Nunca bloquea
+        ARGS:
+            info: InfoFrame con la cabecera del frame
+            img: imagen JPG
+        """
+        with self.cond:
+            if len(self.pendientes) == self.pendientes.maxlen:
+                self.descartados += 1
+            self.pendientes.append((info, img))
+            self.cond.notify()
+
+    def close(self):
+        """ Termina los hilos de decodificación y espera a que acaben, para
+        que ninguno siga dentro de OpenCV cuando se cierra el programa
+        """
+        with self.cond:
+            self.parar = True
+            self.pendientes.clear()
+            self.cond.notify_all()
+
+        for t in self.hilos:
+            if t is not threading.current_thread():
+                t.join()
+
+    def estadisticas(self):
+        """ Devuelve un diccionario con los contadores del decodificador
+        """
+        return {
+            'decodificados': self.decodificados,
+            'descartados': self.descartados,
+            'obsoletos': self.obsoletos,
+            'mostrados': self.mostrados,
+        }
+
+    def decodificar(self):
+        """ Hilo del pool. Descomprime los frames pendientes y los deja listos
+        para que la GUI los muestre
+        """
+        while True:
+            with self.cond:
+                while not self.pendientes and not self.parar:
+                    self.cond.wait()
+                if self.parar:
+                    return
+                info, img = self.pendientes.popleft()
+
+            # Descompresión de los datos, una vez recibidos
+            decimg = cv2.imdecode(np.frombuffer(img, np.uint8), 1)
+            if decimg is None:
+                continue
+
+            # Conversión de formato para su uso en el GUI
+            cv2_im = cv2.cvtColor(decimg, cv2.COLOR_BGR2RGB)
+            imagen = Image.fromarray(cv2_im)
+
+            with self.lock_mostrar:
+                self.decodificados += 1
+                # Con varios hilos un frame puede terminar después de otro más nuevo
+                if self.ultimo_seq is not None and info.seq - self.ultimo_seq <= 0:
+                    self.obsoletos += 1
+                    continue
+
+                if self.listo is not None:
+                    self.obsoletos += 1
+                self.ultimo_seq = info.seq
+                self.listo = (info, imagen)
+
+                if self.mostrar_en_cola:
+                    continue
+                self.mostrar_en_cola = True
+
+            self.gui.app.queueFunction(self.mostrar)
+
+    def mostrar(self):
+        """ Muestra en la GUI el último frame decodificado. Se ejecuta en el
+        hilo de la GUI, que es el único que puede crear imagenes de Tk
+        """
+        with self.lock_mostrar:
+            listo = self.listo
+            self.listo = None
+            self.mostrar_en_cola = False
+
+        # Si la llamada ha terminado no pisamos la imagen por defecto
+        if listo is None or self.parar:
+            return
+
+        info, imagen = listo
+        if self.salida:
+            self.salida(info, imagen)
+            self.mostrados += 1
+            return
+
+        img_tk = ImageTk.PhotoImage(imagen)
+        self.gui.app.setImageSize("video", 640, 360)
+        self.gui.app.setImageData("video", img_tk, fmt='PhotoImage')
+        self.mostrados += 1
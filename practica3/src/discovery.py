@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""Servidor de descubrimiento local. Implementa REGISTER, QUERY, LIST_USERS
+y QUIT igual que el servidor de la práctica para poder probar y medir la
+clase Server sin conexión. Puede arrancar con usuarios sintéticos.
+
+Las conexiones que terminan sus peticiones en salto de linea reciben las
+respuestas terminadas en salto de linea y pueden mandar varias peticiones
+seguidas. Al resto se les trata como el servidor original: cada recv es una
+petición y las respuestas no llevan terminador.
+
+Uso (desde el directorio practica3):
+    python3 -m src.discovery --puerto 8000 --usuarios 1000
+"""
+import argparse
+import random
+import selectors
+import socket
+import threading
+import time
+
+
+class Conexion():
+    def __init__(self, addr):
+        """ Estado de una conexión con un cliente
+        ARGS:
+            addr: dirección del cliente
+        """
+        self.addr = addr
+        self.entrada = b''
+        self.salida = bytearray()
+        self.entramado = False
+        self.cerrar = False
+
+
+class ServidorDescubrimiento():
+    def __init__(self, host='127.0.0.1', port=0, usuarios=0, semilla=1):
+        """ Crea el servidor y arranca el hilo que atiende todas las conexiones
+        ARGS:
+            host: dirección en la que escuchar
+            port: puerto en el que escuchar, 0 para que lo elija el sistema
+            usuarios: número de usuarios sintéticos con los que arrancar
+            semilla: semilla de los usuarios sintéticos
+        """
+        self.debug = False
+        self.stop_threads = False
+
+        # nick -> (ip, puerto, password, protocolos, timestamp)
+        self.usuarios = {}
+        self.lista = None
+        self.poblar(usuarios, semilla)
+
+        self.socket_in = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket_in.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket_in.bind((host, port))
+        self.socket_in.listen(128)
+        self.socket_in.setblocking(False)
+        self.host, self.port = self.socket_in.getsockname()
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket_in, selectors.EVENT_READ, None)
+
+        # Par de sockets para despertar al bucle al pararlo
+        self.despertador, self.despertador_out = socket.socketpair()
+        self.despertador.setblocking(False)
+        self.selector.register(self.despertador, selectors.EVENT_READ, None)
+
+        self.hilo = threading.Thread(target=self.bucle)
+        self.hilo.daemon = True
+        self.hilo.start()
+
+    def poblar(self, n, semilla=1):
+        """ Añade n usuarios sintéticos. Algunos nicks llevan espacios y '#'
+        como los de los usuarios reales
+        ARGS:
+            n: número de usuarios
+            semilla: semilla del generador aleatorio
+        """
+        rnd = random.Random(semilla)
+        for i in range(n):
+            nick = rnd.choice(['user%d', 'us#er%d', 'el usuario %d']) % i
+            ip = "10.{}.{}.{}".format(rnd.randint(0, 255), rnd.randint(0, 255),
+                                      rnd.randint(1, 254))
+            protocolos = rnd.choice(['V0', 'V0#V1'])
+            self.usuarios[nick] = (ip, rnd.randint(1024, 65535), 'pass',
+                                   protocolos, "%.2f" % rnd.uniform(1.5e9, 1.6e9))
+        self.lista = None
+
+    def exit(self):
+        """ Para el bucle del servidor y espera a que termine
+        """
+        self.stop_threads = True
+        try:
+            self.despertador_out.send(b'\0')
+        except OSError:
+            pass
+        self.hilo.join()
+
+    def bucle(self):
+        """ Hilo del bucle de eventos. Acepta conexiones, lee peticiones y
+        manda las respuestas pendientes
+        """
+        while not self.stop_threads:
+            for key, eventos in self.selector.select():
+                if key.fileobj is self.socket_in:
+                    self.aceptar()
+                elif key.fileobj is self.despertador:
+                    continue
+                else:
+                    if eventos & selectors.EVENT_READ:
+                        self.leer(key.fileobj, key.data)
+                    if eventos & selectors.EVENT_WRITE and key.fileobj.fileno() >= 0:
+                        self.escribir(key.fileobj, key.data)
+
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+        self.despertador_out.close()
+
+    def aceptar(self):
+        """ Acepta una conexión y la añade al bucle
+        """
+        try:
+            conn, addr = self.socket_in.accept()
+        except (BlockingIOError, ConnectionAbortedError):
+            return
+        conn.setblocking(False)
+        self.selector.register(conn, selectors.EVENT_READ, Conexion(addr))
+
+    def cerrar(self, conn):
+        """ Quita una conexión del bucle y la cierra
+        """
+        self.selector.unregister(conn)
+        conn.close()
+
+    def leer(self, conn, estado):
+        """ Lee de una conexión y responde a las peticiones completas
+        ARGS:
+            conn: socket del cliente
+            estado: Conexion del cliente
+        """
+        try:
+            data = conn.recv(65536)
+        except BlockingIOError:
+            return
+        except ConnectionResetError:
+            data = b''
+
+        if not data:
+            self.cerrar(conn)
+            return
+
+        estado.entrada += data
+        if b'\n' in estado.entrada:
+            estado.entramado = True
+
+        if estado.entramado:
+            *peticiones, estado.entrada = estado.entrada.split(b'\n')
+        else:
+            peticiones, estado.entrada = [estado.entrada], b''
+
+        for peticion in peticiones:
+            peticion = peticion.decode('utf-8', errors='replace').strip()
+            if not peticion:
+                continue
+            if self.debug:
+                print("C -> S: " + peticion)
+
+            estado.salida += self.responder(peticion, estado)
+            if estado.entramado:
+                estado.salida += b'\n'
+            if estado.cerrar:
+                break
+
+        self.escribir(conn, estado)
+
+    def escribir(self, conn, estado):
+        """ Manda lo que se pueda de las respuestas pendientes de una conexión
+        y vigila si se puede escribir mientras queden datos
+        ARGS:
+            conn: socket del cliente
+            estado: Conexion del cliente
+        """
+        try:
+            enviados = conn.send(estado.salida)
+            del estado.salida[:enviados]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.cerrar(conn)
+            return
+
+        if not estado.salida and estado.cerrar:
+            self.cerrar(conn)
+            return
+
+        eventos = selectors.EVENT_READ
+        if estado.salida:
+            eventos |= selectors.EVENT_WRITE
+        if self.selector.get_key(conn).events != eventos:
+            self.selector.modify(conn, eventos, estado)
+
+    def responder(self, peticion, estado):
+        """ Devuelve los bytes de la respuesta a una petición
+        ARGS:
+            peticion: texto de la petición sin terminador
+            estado: Conexion del cliente
+        """
+        w = peticion.split()
+
+        if w[0] == 'REGISTER' and len(w) >= 6:
+            nick = ' '.join(w[1:-4])
+            ip, port, password, protocolos = w[-4:]
+            anterior = self.usuarios.get(nick)
+            if anterior and anterior[2] != password:
+                return b'NOK WRONG_PASS'
+
+            ts = anterior[4] if anterior else "%.2f" % time.time()
+            self.usuarios[nick] = (ip, port, password, protocolos, ts)
+            self.lista = None
+            return "OK WELCOME {} {}".format(nick, ts).encode('utf-8')
+
+        elif w[0] == 'QUERY' and len(w) >= 2:
+            nick = peticion[len('QUERY '):].strip()
+            user = self.usuarios.get(nick)
+            if not user:
+                return b'NOK USER_UNKNOWN'
+            return "OK USER_FOUND {} {} {} {}".format(
+                nick, user[0], user[1], user[3]).encode('utf-8')
+
+        elif w[0] == 'LIST_USERS':
+            # La lista solo se vuelve a generar cuando se registra alguien
+            if self.lista is None:
+                self.lista = "OK USERS_LIST {} {}".format(
+                    len(self.usuarios),
+                    ''.join("{} {} {} {}#".format(nick, u[0], u[1], u[4])
+                            for nick, u in self.usuarios.items())).encode('utf-8')
+            return self.lista
+
+        elif w[0] == 'QUIT':
+            estado.cerrar = True
+            return b'OK BYE'
+
+        return b'NOK BAD_COMMAND'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Servidor de descubrimiento local')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--puerto', type=int, default=8000)
+    parser.add_argument('--usuarios', type=int, default=0)
+    args = parser.parse_args()
+
+    servidor = ServidorDescubrimiento(args.host, args.puerto, args.usuarios)
+    servidor.debug = True
+    print("Escuchando en {}:{}".format(servidor.host, servidor.port))
+
+    try:
+        servidor.hilo.join()
+    except KeyboardInterrupt:
+        servidor.exit()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""Modulo de corrección de errores (FEC) para los fragmentos de video. Por
+cada grupo de n fragmentos de un frame se envian k paquetes de paridad XOR
+entrelazados: la paridad j cubre los fragmentos j, j+k, j+2k... del grupo.
+Asi el receptor puede reconstruir sin retransmisiones hasta k fragmentos
+perdidos de un grupo siempre que caigan en paridades distintas, lo que incluye
+cualquier rafaga de k pérdidas seguidas.
+"""
+import struct
+
+# Cabecera de paridad: marca, id del frame, número de fragmentos de datos
+# del frame, primer fragmento del grupo, tamaño del grupo, número de
+# paridades del grupo, indice de esta paridad y XOR de las longitudes
+CABECERA_PARIDAD = struct.Struct('!BIHHBBBH')
+
+# Primer byte de los datagramas de paridad
+MARCA_PARIDAD = 0xF3
+
+# Fragmentos de datos por grupo de protección
+TAM_GRUPO = 10
+
+# Máximo de paridades por grupo
+MAX_PARIDADES = 4
+
+
+def es_paridad(datagrama):
+    """Indica si un datagrama es un paquete de paridad
+    ARGS:
+        datagrama: datagrama recibido
+    """
+    return len(datagrama) > CABECERA_PARIDAD.size and datagrama[0] == MARCA_PARIDAD
+
+
+def redundancia_para(perdidas):
+    """ Elige cuantas paridades por grupo enviar según la fracción de
+    fragmentos que se pierden en la red
+    ARGS:
+        perdidas: fracción de fragmentos perdidos medida por el receptor
+    """
+    if perdidas <= 0.001:
+        return 0
+    elif perdidas < 0.02:
+        return 1
+    elif perdidas < 0.05:
+        return 2
+    elif perdidas < 0.10:
+        return 3
+    return MAX_PARIDADES
+
+
+def xor_buffers(buffers, longitud):
+    """ Calcula el XOR de varios buffers rellenando con ceros hasta la longitud dada
+    ARGS:
+        buffers: lista de bytes o memoryviews
+        longitud: longitud del resultado
+    """
+    acumulado = 0
+    for b in buffers:
+        acumulado ^= int.from_bytes(bytes(b).ljust(longitud, b'\0'), 'big')
+    return acumulado.to_bytes(longitud, 'big')
+
+
+def generar_paridades(frame_id, chunks, k, n=TAM_GRUPO):
+    """ Genera los datagramas de paridad de un frame. Cada datagrama es una
+    lista [cabecera, payload] como los de fragment.fragmentar
+    ARGS:
+        frame_id: número de secuencia del frame
+        chunks: lista con los trozos de datos del frame
+        k: paridades por grupo, 0 para no enviar ninguna
+        n: fragmentos de datos por grupo
+    """
+    if k <= 0:
+        return []
+
+    total = len(chunks)
+    datagramas = []
+
+    for inicio in range(0, total, n):
+        fin = min(inicio + n, total)
+        for j in range(min(k, fin - inicio)):
+            cubiertos = [chunks[i] for i in range(inicio + j, fin, k)]
+            longitud = max(len(c) for c in cubiertos)
+            longitud_xor = 0
+            for c in cubiertos:
+                longitud_xor ^= len(c)
+
+            cabecera = CABECERA_PARIDAD.pack(MARCA_PARIDAD, frame_id & 0xFFFFFFFF,
+                                             total, inicio, n, k, j, longitud_xor)
+            datagramas.append([cabecera, xor_buffers(cubiertos, longitud)])
+
+    return datagramas
+
+
+def leer_paridad(datagrama):
+    """ Separa un datagrama de paridad en sus campos. Devuelve una tupla
+    (frame_id, total, inicio, n, k, j, longitud_xor, payload)
+    ARGS:
+        datagrama: datagrama de paridad
+    """
+    _, frame_id, total, inicio, n, k, j, longitud_xor = \
+        CABECERA_PARIDAD.unpack_from(datagrama)
+    payload = bytes(memoryview(datagrama)[CABECERA_PARIDAD.size:])
+    return frame_id, total, inicio, n, k, j, longitud_xor, payload
+
+
+def recuperar(chunks, paridades):
+    """ Reconstruye los fragmentos perdidos que se pueden recuperar con las
+    paridades recibidas. Modifica chunks y devuelve el número de fragmentos
+    recuperados
+    ARGS:
+        chunks: lista de fragmentos del frame, None en los que faltan
+        paridades: lista de tuplas (inicio, n, k, j, longitud_xor, payload)
+    """
+    total = len(chunks)
+    recuperados = 0
+
+    for inicio, n, k, j, longitud_xor, payload in paridades:
+        cubiertos = range(inicio + j, min(inicio + n, total), k)
+        faltan = [i for i in cubiertos if chunks[i] is None]
+        if len(faltan) != 1:
+            continue
+
+        otros = [chunks[i] for i in cubiertos if chunks[i] is not None]
+        longitud = longitud_xor
+        for c in otros:
+            longitud ^= len(c)
+
+        if longitud > len(payload):
+            continue
+
+        chunks[faltan[0]] = xor_buffers(otros + [payload], len(payload))[:longitud]
+        recuperados += 1
+
+    return recuperados
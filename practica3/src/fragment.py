@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Modulo de fragmentación de frames de video. Divide cada frame comprimido
+en trozos que caben en un datagrama UDP sin que IP tenga que fragmentar y los
+vuelve a juntar en el receptor.
+"""
+import struct
+from collections import OrderedDict
+from src.fec import CABECERA_PARIDAD, es_paridad, leer_paridad, recuperar
+
+# Cabecera de cada fragmento: marca, id del frame, indice del fragmento y
+# número total de fragmentos del frame
+CABECERA_FRAGMENTO = struct.Struct('!BIHH')
+
+# Primer byte de los datagramas fragmentados. No es un digito ASCII, asi que
+# no se confunde con un datagrama V0, que empieza por el número de frame
+MARCA_FRAGMENTO = 0xF1
+
+# MTU de ethernet menos cabeceras IP (20) y UDP (8)
+MTU = 1500
+MAX_DATAGRAMA = MTU - 20 - 8
+
+# Tamaño máximo del payload de un fragmento. Las paridades llevan el payload
+# de los fragmentos con una cabecera más grande, y también tienen que caber
+MAX_PAYLOAD = MAX_DATAGRAMA - max(CABECERA_FRAGMENTO.size, CABECERA_PARIDAD.size)
+
+# Un frame no puede tener más fragmentos de los que caben en un unsigned short
+MAX_FRAGMENTOS = 0xFFFF
+
+
+def fragmentar(frame_id, data, max_payload=MAX_PAYLOAD):
+    """Divide un frame en datagramas listos para enviar. Cada datagrama es una
+    lista [cabecera, trozo] para poder enviarlo sin concatenar con sendmsg.
+    ARGS:
+        frame_id: número de secuencia del frame
+        data: bytes del frame
+        max_payload: tamaño máximo de datos por fragmento
+    """
+    total = max(1, -(-len(data) // max_payload))
+
+    if total > MAX_FRAGMENTOS:
+        raise ValueError("Frame demasiado grande: %d bytes" % len(data))
+
+    frame_id &= 0xFFFFFFFF
+    view = memoryview(data)
+    datagramas = []
+
+    for idx in range(total):
+        chunk = view[idx * max_payload:(idx + 1) * max_payload]
+        datagramas.append([CABECERA_FRAGMENTO.pack(
+            MARCA_FRAGMENTO, frame_id, idx, total), chunk])
+
+    return datagramas
+
+
+def es_fragmento(datagrama):
+    """Indica si un datagrama lleva cabecera de fragmento
+    ARGS:
+        datagrama: datagrama recibido
+    """
+    return len(datagrama) > 0 and datagrama[0] == MARCA_FRAGMENTO
+
+
+class Reensamblador():
+    """Tabla de reensamblado de frames. Guarda como mucho max_frames frames
+    incompletos; si llega uno nuevo y la tabla está llena se descarta el más
+    antiguo. Si llegan paquetes de paridad se usan para reconstruir los
+    fragmentos perdidos.
+    """
+
+    def __init__(self, max_frames=8):
+        """Crea una tabla de reensamblado vacia.
+        ARGS:
+            max_frames: número máximo de frames incompletos que se guardan a la vez
+        """
+        self.max_frames = max_frames
+        self.frames = OrderedDict()
+        self.ultimo_completo = None
+
+        # Estadisticas
+        self.completos = 0
+        self.descartados = 0
+        self.fragmentos_invalidos = 0
+        self.fragmentos_recibidos = 0
+        self.fragmentos_esperados = 0
+        self.recuperados = 0
+
+    def add(self, datagrama):
+        """Añade un fragmento o un paquete de paridad a la tabla. Devuelve una
+        tupla (frame_id, bytes) si con este datagrama se ha completado un frame,
+        None en caso contrario.
+        ARGS:
+            datagrama: datagrama recibido, con cabecera de fragmento o de paridad
+        """
+        if es_paridad(datagrama):
+            frame_id, total, inicio, n, k, j, longitud_xor, payload = \
+                leer_paridad(datagrama)
+            if total == 0 or inicio >= total or k == 0 or j >= k:
+                self.fragmentos_invalidos += 1
+                return None
+        elif len(datagrama) >= CABECERA_FRAGMENTO.size:
+            marca, frame_id, idx, total = CABECERA_FRAGMENTO.unpack_from(datagrama)
+            if marca != MARCA_FRAGMENTO or total == 0 or idx >= total:
+                self.fragmentos_invalidos += 1
+                return None
+            payload = bytes(memoryview(datagrama)[CABECERA_FRAGMENTO.size:])
+        else:
+            self.fragmentos_invalidos += 1
+            return None
+
+        # Fragmentos de frames anteriores al último entregado ya no sirven
+        if self.ultimo_completo is not None and \
+                _es_anterior(frame_id, self.ultimo_completo):
+            return None
+
+        if es_paridad(datagrama):
+            entrada = self._entrada(frame_id, total)
+            if entrada is None:
+                return None
+            entrada[3].append((inicio, n, k, j, longitud_xor, payload))
+        else:
+            self.fragmentos_recibidos += 1
+
+            # Caso rapido: frame que cabe en un solo datagrama
+            if total == 1 and frame_id not in self.frames:
+                self._completar(frame_id, total)
+                return frame_id, payload
+
+            entrada = self._entrada(frame_id, total)
+            if entrada is None:
+                return None
+
+            chunks = entrada[2]
+            if chunks[idx] is None:
+                chunks[idx] = payload
+                entrada[1] += 1
+
+        if entrada[1] < total and entrada[3]:
+            recuperados = recuperar(entrada[2], entrada[3])
+            entrada[1] += recuperados
+            self.recuperados += recuperados
+
+        if entrada[1] < total:
+            return None
+
+        del self.frames[frame_id]
+        self._completar(frame_id, total)
+        return frame_id, b''.join(entrada[2])
+
+    def _entrada(self, frame_id, total):
+        """Devuelve la entrada de la tabla de un frame, creándola si no existe.
+        Cada entrada es una lista [total, recibidos, fragmentos, paridades]
+        """
+        entrada = self.frames.get(frame_id)
+        if entrada is None:
+            if len(self.frames) >= self.max_frames:
+                _, viejo = self.frames.popitem(last=False)
+                self.fragmentos_esperados += viejo[0]
+                self.descartados += 1
+            entrada = [total, 0, [None] * total, []]
+            self.frames[frame_id] = entrada
+        elif entrada[0] != total:
+            self.fragmentos_invalidos += 1
+            return None
+        return entrada
+
+    def _completar(self, frame_id, total):
+        """Marca un frame como entregado y descarta los frames incompletos
+        anteriores a él, que ya nunca se van a mostrar
+        """
+        self.completos += 1
+        self.fragmentos_esperados += total
+        self.ultimo_completo = frame_id
+
+        for viejo in [f for f in self.frames if _es_anterior(f, frame_id)]:
+            self.fragmentos_esperados += self.frames.pop(viejo)[0]
+            self.descartados += 1
+
+
+def _es_anterior(a, b):
+    """Compara dos números de secuencia de 32 bits teniendo en cuenta el
+    desbordamiento. Devuelve True si a es anterior o igual a b.
+    """
+    return ((b - a) & 0xFFFFFFFF) < 0x80000000
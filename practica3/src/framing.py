@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Modulo de entramado del protocolo de control. Los mensajes que envia esta
+aplicación terminan en salto de linea, y el parser guarda un buffer por
+conexión del que va sacando mensajes completos aunque TCP los junte o los
+parta.
+
+Los clientes que no terminan sus mensajes siguen funcionando: si el buffer
+se queda con datos sin terminador durante ESPERA_RESTO segundos, el dueño
+del parser llama a flush() y el resto se entrega tal cual, aunque le falten
+argumentos, para que se procese o se responda con BAD REQUEST.
+En cuanto una conexión manda un salto de linea se asume que usa entramado y
+flush() ya no entrega mensajes a medias.
+"""
+
+# Número mínimo de argumentos de cada comando
+ARGUMENTOS = {
+    'CALLING': 2,
+    'CALL_ACCEPTED': 2,
+    'CALL_END': 1,
+    'CALL_DENIED': 0,
+    'CALL_BUSY': 0,
+    'CALL_HOLD': 0,
+    'CALL_RESUME': 0,
+}
+
+# Tamaño máximo de un mensaje. Si el buffer crece más sin formar un mensaje
+# se entrega tal cual para que se responda con BAD REQUEST
+MAX_MENSAJE = 4096
+
+# Segundos sin datos nuevos tras los que se procesa un resto sin terminador
+ESPERA_RESTO = 0.05
+
+
+def empaquetar(request):
+    """ Convierte un mensaje de control en los bytes que se envian
+    ARGS:
+        request: mensaje sin terminador
+    """
+    return (request + '\n').encode('utf-8')
+
+
+class ParserControl():
+    def __init__(self):
+        """ Crea un parser con el buffer vacio. Hay que usar uno por conexión
+        """
+        self.buffer = b''
+        self.entramado = False
+
+    def feed(self, data):
+        """ Añade datos recibidos al buffer y devuelve la lista de mensajes
+        terminados que se pueden sacar de él
+        ARGS:
+            data: bytes leidos del socket
+        """
+        self.buffer += data
+        mensajes = []
+
+        if b'\n' in self.buffer:
+            self.entramado = True
+            *lineas, self.buffer = self.buffer.split(b'\n')
+            for linea in lineas:
+                mensajes.extend(separar(linea.decode('utf-8', errors='replace')))
+
+        if len(self.buffer) > MAX_MENSAJE:
+            mensajes.append(self.buffer.decode('utf-8', errors='replace'))
+            self.buffer = b''
+
+        return mensajes
+
+    def pendiente(self):
+        """ Indica si quedan datos sin terminador en el buffer
+        """
+        return len(self.buffer) > 0
+
+    def flush(self):
+        """ Entrega el resto sin terminador como uno o varios mensajes si la
+        conexión no usa entramado. Solo se llama cuando no han llegado más
+        datos en ESPERA_RESTO segundos, asi que un comando al que le faltan
+        argumentos se entrega igual: un CALL_END sin nick tiene que terminar
+        la llamada. Devuelve la lista de mensajes
+        """
+        if self.entramado or not self.buffer:
+            return []
+
+        resto = self.buffer.decode('utf-8', errors='replace')
+        self.buffer = b''
+        return separar(resto)
+
+
+def separar(texto):
+    """ Separa varios mensajes sin terminador que vienen en el mismo texto,
+    cortando delante de cada comando conocido una vez que el mensaje anterior
+    tiene todos sus argumentos
+    ARGS:
+        texto: texto recibido
+    """
+    palabras = texto.split()
+    if not palabras:
+        return []
+
+    mensajes = []
+    actual = [palabras[0]]
+    for palabra in palabras[1:]:
+        if palabra in ARGUMENTOS and \
+                len(actual) - 1 >= ARGUMENTOS.get(actual[0], 0):
+            mensajes.append(' '.join(actual))
+            actual = [palabra]
+        else:
+            actual.append(palabra)
+    mensajes.append(' '.join(actual))
+    return mensajes
+
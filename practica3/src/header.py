@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Modulo de cabeceras del protocolo de video. Soporta las dos versiones
+anunciadas al servidor de descubrimiento:
+    V0: cabecera de texto "orden#timestamp#resolucion#fps#"
+    V1: cabecera binaria de tamaño fijo empaquetada con struct
+"""
+import struct
+
+VERSION_ASCII = 0
+VERSION_BINARIA = 1
+
+# Versiones que soporta esta aplicación
+VERSIONES = [VERSION_ASCII, VERSION_BINARIA]
+
+# Cabecera V1: version, flags, ancho, alto, fps, relleno, número de secuencia
+# y timestamp de captura en microsegundos
+CABECERA_V1 = struct.Struct('!BBHHBxIQ')
+
+# Longitud máxima de la cabecera de texto de V0
+MAX_CABECERA_V0 = 128
+
+
+class InfoFrame():
+    def __init__(self, version, seq, timestamp_us, width, height, fps, flags=0):
+        """ Datos de la cabecera de un frame
+        ARGS:
+            version: versión del protocolo con la que se recibió el frame
+            seq: número de secuencia del frame
+            timestamp_us: instante de captura en microsegundos desde epoch
+            width: ancho del frame
+            height: alto del frame
+            fps: frames por segundo a los que envia el otro extremo
+            flags: bits de opciones del frame
+        """
+        self.version = version
+        self.seq = seq
+        self.timestamp_us = timestamp_us
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.flags = flags
+
+
+def negociar_version(remotas, propias=VERSIONES):
+    """ Devuelve la versión más alta que soportan los dos extremos. Si no
+    se conocen las versiones del otro extremo se usa V0
+    ARGS:
+        remotas: lista de versiones del otro extremo
+        propias: lista de versiones de esta aplicación
+    """
+    comunes = set(remotas or []) & set(propias)
+    return max(comunes) if comunes else VERSION_ASCII
+
+
+def parsear_versiones(texto):
+    """ Convierte la lista de protocolos que devuelve el servidor (V0#V1) en
+    una lista de enteros. Los protocolos desconocidos se ignoran
+    ARGS:
+        texto: lista de protocolos separados por '#'
+    """
+    versiones = []
+    for v in texto.split('#'):
+        if v.startswith('V') and v[1:].isdigit():
+            versiones.append(int(v[1:]))
+    return versiones
+
+
+def empaquetar(version, seq, timestamp, width, height, fps, flags=0):
+    """ Genera la cabecera de un frame en la versión indicada
+    ARGS:
+        version: VERSION_ASCII o VERSION_BINARIA
+        seq: número de secuencia del frame
+        timestamp: instante de captura en segundos desde epoch
+        width: ancho del frame
+        height: alto del frame
+        fps: frames por segundo
+        flags: bits de opciones, solo en V1
+    """
+    if version == VERSION_BINARIA:
+        return CABECERA_V1.pack(VERSION_BINARIA, flags, width, height, fps,
+                                seq & 0xFFFFFFFF, int(timestamp * 1000000))
+
+    return "{}#{}#{}x{}#{}#".format(
+        seq, timestamp, width, height, fps).encode('utf-8')
+
+
+def desempaquetar(data):
+    """ Lee la cabecera de un frame sin copiar la imagen. Devuelve una tupla
+    (InfoFrame, memoryview de la imagen) o None si la cabecera no es valida
+    ARGS:
+        data: bytes o memoryview del frame completo
+    """
+    view = memoryview(data)
+
+    if len(view) and view[0] == VERSION_BINARIA:
+        if len(view) < CABECERA_V1.size:
+            return None
+        version, flags, width, height, fps, seq, ts_us = \
+            CABECERA_V1.unpack_from(view)
+        info = InfoFrame(version, seq, ts_us, width, height, fps, flags)
+        return info, view[CABECERA_V1.size:]
+
+    # V0: la cabecera de texto es corta, buscamos los 4 separadores solo
+    # al principio del frame para no copiar la imagen
+    inicio = bytes(view[:MAX_CABECERA_V0])
+    idx = -1
+    for _ in range(4):
+        idx = inicio.find(b'#', idx + 1)
+        if idx < 0:
+            return None
+
+    try:
+        campos = inicio[:idx].decode('utf-8').split('#')
+        width, height = campos[2].split('x')
+        info = InfoFrame(VERSION_ASCII, int(campos[0]),
+                         int(float(campos[1]) * 1000000),
+                         int(width), int(height), int(campos[3]))
+    except (ValueError, IndexError, UnicodeDecodeError):
+        return None
+
+    return info, view[idx + 1:]
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""Modulo del buffer de jitter. Ordena los frames recibidos por número de
+secuencia y los entrega al ritmo marcado por los timestamps del emisor.
+"""
+import heapq
+import threading
+import time
+
+
+class JitterBuffer():
+    def __init__(self, retardo=0.1, max_frames=30):
+        """ Crea un buffer de jitter vacio
+        ARGS:
+            retardo: segundos que se retiene cada frame para absorber el jitter de la red
+            max_frames: número máximo de frames en el buffer. Si se llena se descarta
+            el más antiguo
+        """
+        self.retardo = retardo
+        self.max_frames = max_frames
+
+        self.frames = []
+        self.cond = threading.Condition()
+
+        # Diferencia mínima observada entre el reloj local y el del emisor.
+        # Tomar la mínima hace que el frame que menos ha tardado marque el ritmo
+        self.offset = None
+        self.ultimo_entregado = None
+
+        # Estadisticas
+        self.entregados = 0
+        self.tardios = 0
+        self.perdidos = 0
+        self.desbordados = 0
+
+    def push(self, info, img):
+        """ Añade un frame al buffer. Los frames anteriores al último entregado
+        o que llegan cuando ya ha pasado su instante de reproducción se descartan
+        ARGS:
+            info: InfoFrame con la cabecera del frame
+            img: datos de la imagen
+        """
+        ahora = time.time()
+        emision = info.timestamp_us / 1000000
+
+        with self.cond:
+            if self.offset is None or ahora - emision < self.offset:
+                self.offset = ahora - emision
+
+            if self.ultimo_entregado is not None and \
+                    _diferencia(info.seq, self.ultimo_entregado) <= 0:
+                self.tardios += 1
+                return False
+
+            if ahora > self._instante_reproduccion(info):
+                self.tardios += 1
+                return False
+
+            if len(self.frames) >= self.max_frames:
+                heapq.heappop(self.frames)
+                self.desbordados += 1
+
+            heapq.heappush(self.frames, _Entrada(info, img))
+            self.cond.notify()
+            return True
+
+    def pop(self, timeout=0.2):
+        """ Espera a que el primer frame del buffer tenga que reproducirse y lo
+        devuelve como una tupla (InfoFrame, img). Devuelve None si pasa el timeout
+        ARGS:
+            timeout: tiempo máximo de espera en segundos
+        """
+        limite = time.time() + timeout
+
+        with self.cond:
+            while True:
+                ahora = time.time()
+                if self.frames:
+                    entrada = self.frames[0]
+                    espera = self._instante_reproduccion(entrada.info) - ahora
+                    if espera <= 0:
+                        heapq.heappop(self.frames)
+                        self._entregar(entrada.info)
+                        return entrada.info, entrada.img
+                else:
+                    espera = limite - ahora
+
+                espera = min(espera, limite - ahora)
+                if espera <= 0:
+                    return None
+                self.cond.wait(espera)
+
+    def clear(self):
+        """ Vacia el buffer y olvida la sincronización con el emisor
+        """
+        with self.cond:
+            self.frames = []
+            self.offset = None
+            self.ultimo_entregado = None
+
+    def profundidad(self):
+        """ Número de frames que hay en el buffer
+        """
+        with self.cond:
+            return len(self.frames)
+
+    def estadisticas(self):
+        """ Devuelve un diccionario con el estado del buffer
+        """
+        with self.cond:
+            return {
+                'profundidad': len(self.frames),
+                'entregados': self.entregados,
+                'tardios': self.tardios,
+                'perdidos': self.perdidos,
+                'desbordados': self.desbordados,
+            }
+
+    def _instante_reproduccion(self, info):
+        """ Instante, en el reloj local, en el que se debe mostrar un frame
+        """
+        return info.timestamp_us / 1000000 + self.offset + self.retardo
+
+    def _entregar(self, info):
+        """ Actualiza el último frame entregado y cuenta los huecos de la
+        secuencia como frames perdidos
+        """
+        if self.ultimo_entregado is not None:
+            self.perdidos += max(0, _diferencia(info.seq, self.ultimo_entregado) - 1)
+        self.ultimo_entregado = info.seq
+        self.entregados += 1
+
+
+class _Entrada():
+    """ Elemento del heap del buffer, ordenado por número de secuencia
+    """
+    __slots__ = ('info', 'img')
+
+    def __init__(self, info, img):
+        self.info = info
+        self.img = img
+
+    def __lt__(self, other):
+        return _diferencia(self.info.seq, other.info.seq) < 0
+
+
+def _diferencia(a, b):
+    """ Diferencia a - b entre dos números de secuencia de 32 bits teniendo en
+    cuenta el desbordamiento
+    """
+    d = (a - b) & 0xFFFFFFFF
+    return d - 0x100000000 if d >= 0x80000000 else d
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""Modulo de control de tasa del video. El receptor mide perdidas, jitter y
+retardo de cola y se los manda al emisor en un datagrama de informe. El emisor
+ajusta con ellos la calidad JPG, la resolución y los fps del video que envia.
+"""
+import struct
+import threading
+import time
+
+# Informe del receptor: marca, perdidas de frames y de fragmentos en tanto
+# por mil, jitter y retardo de cola en microsegundos
+INFORME = struct.Struct('!BHHII')
+
+# Primer byte de los datagramas de informe. Distinto de la marca de
+# fragmento y de cualquier digito ASCII de V0
+MARCA_INFORME = 0xF2
+
+# Niveles de calidad de mejor a peor: (calidad JPG, escala, fps)
+NIVELES = [
+    (80, 1.0, 30),
+    (65, 1.0, 30),
+    (50, 1.0, 30),
+    (40, 0.75, 30),
+    (35, 0.75, 20),
+    (30, 0.5, 20),
+    (25, 0.5, 15),
+    (20, 0.5, 10),
+]
+
+# Nivel con el que se empieza, el que se usaba antes de tener control de tasa
+NIVEL_INICIAL = 2
+
+
+def es_informe(datagrama):
+    """Indica si un datagrama es un informe del receptor
+    ARGS:
+        datagrama: datagrama recibido
+    """
+    return len(datagrama) == INFORME.size and datagrama[0] == MARCA_INFORME
+
+
+class Estimador():
+    """ Parte del receptor. Calcula las estadisticas de la red a partir de los
+    frames que van llegando y genera los informes para el emisor
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jitter = 0.0
+        self.transito_min = None
+        self.retardo_cola = 0.0
+        self.ultimo_transito = None
+
+        # Frames del intervalo actual
+        self.primer_seq = None
+        self.ultimo_seq = None
+        self.recibidos = 0
+
+    def frame_recibido(self, info):
+        """ Actualiza las estadisticas con un frame completo recibido
+        ARGS:
+            info: InfoFrame con la cabecera del frame
+        """
+        transito = time.time() - info.timestamp_us / 1000000
+
+        with self.lock:
+            # Jitter entre llegadas como en RTP (RFC 3550)
+            if self.ultimo_transito is not None:
+                d = abs(transito - self.ultimo_transito)
+                self.jitter += (d - self.jitter) / 16
+            self.ultimo_transito = transito
+
+            # El tránsito mínimo es el retardo de propagación más la diferencia
+            # de relojes; lo que sobra es tiempo esperando en colas
+            if self.transito_min is None or transito < self.transito_min:
+                self.transito_min = transito
+            self.retardo_cola += (transito - self.transito_min -
+                                  self.retardo_cola) / 8
+
+            if self.primer_seq is None:
+                self.primer_seq = info.seq
+            if self.ultimo_seq is None or \
+                    ((info.seq - self.ultimo_seq) & 0xFFFFFFFF) < 0x80000000:
+                self.ultimo_seq = info.seq
+            self.recibidos += 1
+
+    def informe(self, perdidas_red=0.0):
+        """ Genera el datagrama de informe del intervalo actual y empieza uno
+        nuevo. Devuelve None si no se ha recibido nada
+        ARGS:
+            perdidas_red: fracción de fragmentos perdidos en la red en el intervalo,
+            antes de corregirlos con FEC
+        """
+        with self.lock:
+            if self.primer_seq is None:
+                return None
+
+            esperados = ((self.ultimo_seq - self.primer_seq) & 0xFFFFFFFF) + 1
+            perdidas = max(0, esperados - self.recibidos) * 1000 // esperados
+
+            datagrama = INFORME.pack(MARCA_INFORME, min(perdidas, 1000),
+                                     min(int(perdidas_red * 1000), 1000),
+                                     int(self.jitter * 1000000),
+                                     int(self.retardo_cola * 1000000))
+
+            self.primer_seq = None
+            self.ultimo_seq = None
+            self.recibidos = 0
+            return datagrama
+
+
+class ControlTasa():
+    """ Parte del emisor. Baja de nivel en cuanto hay perdidas o crecen el
+    jitter o el retardo de cola y sube de uno en uno cuando la red lleva un
+    rato limpia
+    """
+
+    def __init__(self, perdidas_max=0.05, jitter_max=0.03, retardo_max=0.1,
+                 informes_subir=3):
+        """ Crea el controlador en el nivel inicial
+        ARGS:
+            perdidas_max: fracción de perdidas a partir de la que se baja de nivel
+            jitter_max: segundos de jitter a partir de los que se baja de nivel
+            retardo_max: segundos de retardo de cola a partir de los que se baja de nivel
+            informes_subir: informes limpios seguidos necesarios para subir de nivel
+        """
+        self.perdidas_max = perdidas_max
+        self.jitter_max = jitter_max
+        self.retardo_max = retardo_max
+        self.informes_subir = informes_subir
+
+        self.nivel = NIVEL_INICIAL
+        self.limpios = 0
+
+        # Últimos valores recibidos del receptor
+        self.perdidas = 0.0
+        self.perdidas_red = 0.0
+        self.jitter = 0.0
+        self.retardo_cola = 0.0
+
+    def parametros(self):
+        """ Devuelve la tupla (calidad JPG, escala, fps) del nivel actual
+        """
+        return NIVELES[self.nivel]
+
+    def informe(self, datagrama):
+        """ Procesa un informe del receptor y ajusta el nivel
+        ARGS:
+            datagrama: datagrama de informe
+        """
+        _, perdidas, perdidas_red, jitter, retardo = INFORME.unpack(datagrama)
+        self.perdidas = perdidas / 1000
+        self.perdidas_red = perdidas_red / 1000
+        self.jitter = jitter / 1000000
+        self.retardo_cola = retardo / 1000000
+
+        if self.perdidas > 3 * self.perdidas_max or \
+                self.jitter > 3 * self.jitter_max or \
+                self.retardo_cola > 3 * self.retardo_max:
+            self.bajar(2)
+        elif self.perdidas > self.perdidas_max or \
+                self.jitter > self.jitter_max or \
+                self.retardo_cola > self.retardo_max:
+            self.bajar(1)
+        elif self.perdidas < self.perdidas_max / 5 and \
+                self.jitter < self.jitter_max / 2 and \
+                self.retardo_cola < self.retardo_max / 2:
+            self.limpios += 1
+            if self.limpios >= self.informes_subir:
+                self.nivel = max(0, self.nivel - 1)
+                self.limpios = 0
+        else:
+            self.limpios = 0
+
+    def bajar(self, pasos):
+        """ Baja la calidad el número de niveles indicado
+        ARGS:
+            pasos: niveles que se baja
+        """
+        self.nivel = min(len(NIVELES) - 1, self.nivel + pasos)
+        self.limpios = 0
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""Modulo de la cola de envio de video. Es una cola acotada que, cuando se
+llena, descarta el frame más antiguo: en video en directo es mejor perder un
+frame viejo que enviarlo tarde.
+"""
+from collections import deque
+import queue
+import threading
+import time
+
+
+class ColaEnvio():
+    def __init__(self, max_frames=5):
+        """ Crea una cola de envio vacia
+        ARGS:
+            max_frames: número máximo de frames en la cola
+        """
+        self.frames = deque(maxlen=max_frames)
+        self.cond = threading.Condition()
+
+        # Estadisticas
+        self.encolados = 0
+        self.descartados = 0
+        self.enviados = 0
+        self.edad_max = 0.0
+        self.edad_media = 0.0
+
+    def put(self, item):
+        """ Añade un frame a la cola. Nunca bloquea; si la cola está llena se
+        descarta el frame más antiguo
+        ARGS:
+            item: frame a enviar
+        """
+        with self.cond:
+            if len(self.frames) == self.frames.maxlen:
+                self.descartados += 1
+            self.frames.append((time.monotonic(), item))
+            self.encolados += 1
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        """ Saca el frame más antiguo de la cola. Lanza queue.Empty si no hay
+        ninguno antes del timeout, igual que queue.Queue
+        ARGS:
+            timeout: segundos de espera máxima, None para esperar siempre
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.frames, timeout):
+                raise queue.Empty
+
+            encolado, item = self.frames.popleft()
+            edad = time.monotonic() - encolado
+            self.enviados += 1
+            self.edad_max = max(self.edad_max, edad)
+            self.edad_media += (edad - self.edad_media) / 16
+            return item
+
+    def clear(self):
+        """ Vacia la cola de forma atómica. Los frames que se tiran cuentan
+        como descartados
+        """
+        with self.cond:
+            self.descartados += len(self.frames)
+            self.frames.clear()
+
+    def qsize(self):
+        """ Número de frames en la cola
+        """
+        with self.cond:
+            return len(self.frames)
+
+    def estadisticas(self):
+        """ Devuelve un diccionario con los contadores de la cola
+        """
+        with self.cond:
+            return {
+                'en_cola': len(self.frames),
+                'encolados': self.encolados,
+                'descartados': self.descartados,
+                'enviados': self.enviados,
+                'edad_max': self.edad_max,
+                'edad_media': self.edad_media,
+            }
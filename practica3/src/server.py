@@ -4,12 +4,219 @@ la clase Server.
 
 """
 import socket
+import select
 import time
 import sys
 import os
+import threading
 from typing import List
 import re
 from src.user import User
+from src.header import parsear_versiones
+from src.usercache import CacheUsuarios
+from src.framing import empaquetar, ESPERA_RESTO
+
+
+# Fin de cada usuario en la respuesta de LIST_USERS: el timestamp de creación
+# seguido de '#'. Hay que buscar el timestamp porque hay gente muy lista que
+# pone hashtags en su nombre para que un parseo que podria ser muy simple se
+# convierta en un parseo complicado
+FIN_USUARIO = re.compile(rb'[0-9]{7,11}.[0-9]{1,8}$')
+LONGITUD_TIMESTAMP = 11 + 1 + 8
+
+CABECERA_LISTA = re.compile(rb'OK USERS_LIST ([0-9]+) ?')
+
+# El resto de respuestas tampoco llevan terminador, pero el servidor contesta
+# las peticiones de una en una. Una respuesta está completa cuando tiene todos
+# sus campos y no llegan más datos en ESPERA_RESTO segundos: el último campo
+# puede llegar partido en otro segmento TCP. Los servidores que admiten
+# pipeline terminan cada respuesta con un salto de linea
+RESPUESTA = re.compile(
+    rb'\s*(OK USER_FOUND .+ \S+ [0-9]+ V[0-9]+(?:#V[0-9]+)*'
+    rb'|OK WELCOME .+ [0-9]+(?:\.[0-9]+)?'
+    rb'|OK BYE'
+    rb'|NOK [A-Z_]+)\s*$', re.DOTALL)
+MAX_RESPUESTA = 4096
+
+# Segundos que se espera una respuesta antes de dar la conexión por perdida
+TIMEOUT = 10
+
+
+class ParserUsuarios():
+    """Parser incremental de la respuesta de LIST_USERS. Cada byte se examina
+    una sola vez, aunque los usuarios lleguen partidos entre varios recv.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        # Principio del usuario actual y posición desde la que buscar '#'
+        self.inicio = 0
+        self.pos = 0
+        self.total = None
+        self.recibidos = 0
+        self.error = False
+
+    def terminado(self):
+        """Indica si ya se han recibido todos los usuarios anunciados
+        """
+        return self.error or (self.total is not None and self.recibidos >= self.total)
+
+    def feed(self, data):
+        """Añade un trozo de la respuesta y devuelve la lista de usuarios que
+        se han completado con él
+        ARGS:
+            data: bytes recibidos del servidor
+        """
+        self.buffer += data
+        users = []
+
+        if self.total is None:
+            cabecera = CABECERA_LISTA.match(self.buffer)
+            if cabecera is None:
+                # Respuesta de error, o cabecera que aún no ha llegado entera
+                if not b'OK USERS_LIST '.startswith(bytes(self.buffer[:14])):
+                    self.error = True
+                return users
+            if not cabecera.group(0).endswith(b' ') and cabecera.group(1) != b'0':
+                # Puede que falten digitos del número de usuarios
+                return users
+            self.total = int(cabecera.group(1))
+            self.inicio = self.pos = cabecera.end()
+
+        while self.recibidos < self.total:
+            idx = self.buffer.find(b'#', self.pos)
+            if idx < 0:
+                self.pos = len(self.buffer)
+                break
+
+            self.pos = idx + 1
+            cola = bytes(self.buffer[max(self.inicio, idx - LONGITUD_TIMESTAMP - 1):idx])
+            if not FIN_USUARIO.search(cola):
+                # Es un '#' dentro del nick
+                continue
+
+            user = self.crear_usuario(bytes(self.buffer[self.inicio:idx]))
+            self.inicio = self.pos
+            self.recibidos += 1
+            if user:
+                users.append(user)
+
+        # Quitamos del buffer lo ya procesado cuando ocupa más de la mitad
+        if self.inicio > len(self.buffer) // 2:
+            del self.buffer[:self.inicio]
+            self.pos -= self.inicio
+            self.inicio = 0
+
+        return users
+
+    @staticmethod
+    def crear_usuario(raw):
+        """Crea un User a partir de los datos de un usuario: nick ip puerto timestamp.
+        El nick puede tener espacios
+        ARGS:
+            raw: bytes del usuario sin el '#' final
+        """
+        dat = raw.decode('utf-8', errors='replace').split()
+        if len(dat) < 3:
+            return None
+        if len(dat) == 3:
+            return User(dat[0], dat[1], dat[2], None)
+
+        port = int(dat[-2]) if dat[-2].isdigit() else dat[-2]
+        return User(' '.join(dat[:-3]), dat[-3], port, dat[-1])
+
+    def resto(self):
+        """Devuelve los bytes recibidos detrás del último usuario, que ya
+        pertenecen a la siguiente respuesta
+        """
+        return bytes(self.buffer[self.inicio:])
+
+
+class LectorRespuestas():
+    """Lee respuestas del servidor de descubrimiento de un socket. Las
+    respuestas se separan aunque lleguen varias en el mismo recv o una
+    respuesta llegue partida en varios.
+    """
+
+    def __init__(self, sock, entramado=False):
+        """
+        ARGS:
+            sock: socket conectado al servidor
+            entramado: el servidor termina las respuestas en salto de linea
+        """
+        self.sock = sock
+        self.entramado = entramado
+        self.buffer = bytearray()
+
+    def recibir(self):
+        """Añade al buffer los siguientes datos del socket
+        """
+        data = self.sock.recv(4096)
+        if not data:
+            raise ConnectionError("El servidor ha cerrado la conexión")
+        self.buffer += data
+
+    def hay_datos(self, espera=0):
+        """Indica si hay datos recibidos esperando en el socket
+        ARGS:
+            espera: segundos que se espera a que lleguen datos
+        """
+        listos, _, _ = select.select([self.sock], [], [], espera)
+        return bool(listos)
+
+    def respuesta(self):
+        """Devuelve la siguiente respuesta como texto
+        """
+        while True:
+            if self.entramado:
+                idx = self.buffer.find(b'\n')
+                if idx >= 0:
+                    linea = bytes(self.buffer[:idx]).strip()
+                    del self.buffer[:idx + 1]
+                    if linea:
+                        return linea.decode('utf-8', errors='replace')
+                    continue
+            else:
+                m = RESPUESTA.match(self.buffer)
+                if m and not self.hay_datos(ESPERA_RESTO):
+                    response = m.group(1).decode('utf-8', errors='replace')
+                    self.buffer.clear()
+                    return response
+
+            if len(self.buffer) > MAX_RESPUESTA:
+                # No hay forma de volver a sincronizarse con las respuestas
+                raise ConnectionError("Bad Response from server")
+            self.recibir()
+
+    def usuarios(self, parser):
+        """Generador con los usuarios de una respuesta a LIST_USERS. Si el
+        servidor responde con un error se marca el error en el parser
+        ARGS:
+            parser: ParserUsuarios de la respuesta
+        """
+        while len(self.buffer.lstrip()) < 3:
+            self.recibir()
+
+        if self.buffer.lstrip().startswith(b'NOK'):
+            self.respuesta()
+            parser.error = True
+            return
+
+        data = bytes(self.buffer.lstrip())
+        self.buffer.clear()
+        while True:
+            for user in parser.feed(data):
+                yield user
+            if parser.error:
+                raise ConnectionError("Bad Response from server")
+            if parser.terminado():
+                break
+
+            data = self.sock.recv(4096)
+            if not data:
+                raise ConnectionError("El servidor ha cerrado la conexión")
+
+        self.buffer += parser.resto()
 
 
 class Server():
@@ -19,26 +226,134 @@ class Server():
         de conexiones con el mismo.
     """
 
-    def __init__(self, my_addr, host, port: int, protocols=[0], debug=False):
+    def __init__(self, my_addr, host, port: int, protocols=[0], debug=False, ttl=60,
+                 pipeline=False):
         """ Inicializa una instancia de la clase que se ocupa de la comunicación
         con el servidor de descubrimiento. Abre una conexión con el servidor y la deja abierta
         para mandar peticiones
+        ARGS:
+            ttl: segundos que se guardan en cache los usuarios recibidos
+            pipeline: el servidor separa las peticiones y las respuestas con
+            saltos de linea, asi que se pueden mandar varias peticiones seguidas
+            sin esperar a las respuestas
         """
-        # Creamos el socket
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket = None
+        self.host = host
+        self.port = port
         self.my_addr = my_addr
         self.protocols = protocols
         self.debug = debug
+        self.pipeline = pipeline
+
+        # Última petición REGISTER, para repetirla si hay que reconectar
+        self.registro = None
+
+        # El socket se comparte entre el hilo de la gui y el de refresco
+        self.lock = threading.RLock()
+        self.cache = CacheUsuarios(ttl)
+        self.parar_refresco = threading.Event()
+        self.hilo_refresco = None
 
         # Conectamos con el servidor
         try:
-            self.socket.connect((host, port))
+            self.conectar()
         except Exception as e:
             raise Exception("Error connectando con el servidor: %s" % str(e))
 
     def __del__(self):
         self.quit()
 
+    def conectar(self):
+        """ Abre la conexión con el servidor
+        """
+        self.socket = socket.create_connection((self.host, self.port), TIMEOUT)
+        self.lector = LectorRespuestas(self.socket, self.pipeline)
+
+    def reconectar(self):
+        """ Cierra la conexión actual y abre otra. Si el usuario se habia
+        registrado se vuelve a registrar para mantener la sesión
+        """
+        if self.debug:
+            print("Reconectando con el servidor")
+
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+
+        self.conectar()
+        if self.registro:
+            self.enviar([self.registro])
+            self.lector.respuesta()
+
+    def enviar(self, requests):
+        """ Manda una o varias peticiones seguidas al servidor
+        ARGS:
+            requests: lista de peticiones
+        """
+        for request in requests:
+            if self.debug:
+                print("C -> S: " + request)
+
+        if self.pipeline:
+            self.socket.sendall(b''.join(empaquetar(r) for r in requests))
+        else:
+            self.socket.sendall(requests[0].encode('utf-8'))
+
+    def leer(self, request):
+        """ Lee la respuesta a una petición. Para LIST_USERS devuelve la lista de
+        usuarios o None si el servidor responde con un error, para el resto de
+        peticiones el texto de la respuesta
+        ARGS:
+            request: petición a la que corresponde la respuesta
+        """
+        if request == 'LIST_USERS':
+            parser = ParserUsuarios()
+            users = list(self.lector.usuarios(parser))
+            for user in users:
+                self.cache.put(user)
+
+            if self.debug:
+                print("S -> C: %d usuarios" % len(users))
+            return None if parser.error else users
+
+        response = self.lector.respuesta()
+        if self.debug:
+            print("S -> C: " + response)
+        return response
+
+    def peticiones(self, requests):
+        """ Manda varias peticiones y devuelve la lista de sus respuestas en el
+        mismo orden. Si el servidor admite pipeline se mandan todas seguidas y
+        se tarda un solo RTT. Si la conexión se ha caido se reconecta y se
+        vuelve a intentar una vez
+        ARGS:
+            requests: lista de peticiones
+        """
+        with self.lock:
+            try:
+                return self.intercambiar(requests)
+            except OSError:
+                self.reconectar()
+                return self.intercambiar(requests)
+
+    def intercambiar(self, requests):
+        """ Manda las peticiones y lee sus respuestas. Hay que llamarla con el
+        lock cogido
+        ARGS:
+            requests: lista de peticiones
+        """
+        responses = []
+        if self.pipeline:
+            self.enviar(requests)
+            for request in requests:
+                responses.append(self.leer(request))
+        else:
+            for request in requests:
+                self.enviar([request])
+                responses.append(self.leer(request))
+        return responses
+
     def register(self, nickname, port: int, password):
         """ Registra un usuario en la aplicación. Manda un mensaje
         con el formato REGISTER nick ip port password protocols
@@ -58,23 +373,13 @@ class Server():
             password,
             "#".join(list(map(lambda x: "V"+str(x), self.protocols))))
 
-        # imprimimos en consola
-        if self.debug:
-            print("C -> S: " + request)
-
-        # Enviamos el mensaje
-        self.socket.send(request.encode('utf-8'))
-
-        # Leemos la respuesta
-        response = self.socket.recv(1024).decode('utf-8')
-
-        if self.debug:
-            print("S -> C: " + response)
+        response, = self.peticiones([request])
 
         # Creamos un objeto user si todo ha ido bien
         if response.startswith("OK WELCOME"):
+            self.registro = request
             w = response.split()
-            return User(w[2], self.my_addr, port, float(w[3]), password)
+            return User(' '.join(w[2:-1]), self.my_addr, port, float(w[-1]), password)
         elif response.startswith("NOK WRONG_PASS"):
             return None
         else:
@@ -88,81 +393,108 @@ class Server():
         """
         return self.register(user.name, user.port, user.password)
 
-    def query(self, nickname) -> User:
-        """Solicita la información de un usuario
+    def query(self, nickname, cache=True) -> User:
+        """Solicita la información de un usuario. Si está en la cache y se
+        conocen sus versiones del protocolo se devuelve sin preguntar al servidor
 
         ARGS:
             nickname: nick del usuario del que se quiere la información
+            cache: si es False se pregunta siempre al servidor
         """
-        request = "QUERY {}".format(nickname)
+        return self.query_varios([nickname], cache)[nickname]
 
-        if self.debug:
-            print("C -> S: " + request)
+    def query_varios(self, nicknames, cache=True):
+        """Solicita la información de varios usuarios. Las consultas que no
+        están en la cache se mandan juntas al servidor. Devuelve un diccionario
+        con el User de cada nick, o None si no existe
+
+        ARGS:
+            nicknames: lista de nicks
+            cache: si es False se pregunta siempre al servidor
+        """
+        users = {}
+        if cache:
+            for nick in nicknames:
+                users[nick] = self.cache.get(nick, con_protocolos=True)
 
-        self.socket.send(request.encode('utf-8'))
-        response = self.socket.recv(1024).decode('utf-8')
+        faltan = [n for n in nicknames if not users.get(n)]
+        if faltan:
+            responses = self.peticiones(["QUERY {}".format(n) for n in faltan])
+            for nick, response in zip(faltan, responses):
+                users[nick] = self.parsear_query(nick, response)
 
         if self.debug:
-            print("S -> C: " + response)
+            print("Cache de usuarios: %s" % self.cache.estadisticas())
+        return users
+
+    def parsear_query(self, nickname, response):
+        """Crea el User de una respuesta a QUERY y actualiza la cache
 
+        ARGS:
+            nickname: nick por el que se ha preguntado
+            response: respuesta del servidor
+        """
         words = response.split()
 
         if words[0] == 'OK' and words[1] == 'USER_FOUND':
-            protocols = words[-1]
+            protocols = parsear_versiones(words[-1])
             port = int(words[-2])
             ip = words[-3]
             nick = ' '.join(words[2:-3])
-            return User(nick, ip, port, 0)
+            user = User(nick, ip, port, 0, protocols=protocols)
+            self.cache.put(user)
+            return user
         else:
+            self.cache.remove(nickname)
             return None
 
     def list_users(self) -> List[User]:
-        """Obtiene y devuelve la lista de todos los usuarios.
-        """
-        self.socket.send(b'LIST_USERS')
-        # No sabemos cuantos usuarios hay, por eso leemos un poco
-        frame1 = self.socket.recv(30)
-
-        words = frame1.split()
-
-        if words[0] == b"OK" and words[1] == b"USERS_LIST":
-            num_users = int(words[2])
-            data = b' '.join(words[3:])
-
-            # Contamos los usuarios con una expresión regular porque hay gente muy
-            # lista que pone hashtags en su nombre para que un parseo que podria
-            # ser muy simple se convierta en un parseo complicado
-            num_users_received = len(re.findall(
-                "[0-9]{7,11}.[0-9]{1,8}#", data.decode('utf-8')))
-
-            while num_users_received < num_users:
-                data += self.socket.recv(2048)
-                num_users_received = len(re.findall(
-                    "[0-9]{7,11}.[0-9]{1,8}#", data.decode('utf-8')))
-
-            user_lst = []
-
-            separadores = re.findall(
-                "[0-9]{7,11}.[0-9]{1,8}#", data.decode('utf-8'))
-            last_idx = 0
-            data_decoded = data.decode('utf-8')
-
-            for separador in separadores:
-                idx_separador = data_decoded.index(separador, last_idx)
-                raw_user_data = data_decoded[last_idx:
-                                             idx_separador + len(separador) - 1]
-                last_idx = idx_separador + len(separador)
-                dat = raw_user_data.split()
-                user = User(dat[0], dat[1], dat[2], dat[3]
-                            if len(dat) == 4 else None)
-                user_lst.append(user)
-            return user_lst
+        """Obtiene y devuelve la lista de todos los usuarios. Los usuarios
+        recibidos se guardan en la cache.
+        """
+        users, = self.peticiones(['LIST_USERS'])
+
+        if users is not None:
+            self.cache.limpiar()
+
+        if self.debug:
+            print("Cache de usuarios: %s" % self.cache.estadisticas())
+        return users
+
+    def empezar_refresco(self, periodo=30):
+        """Arranca un hilo que refresca la cache con LIST_USERS cada cierto tiempo
+        ARGS:
+            periodo: segundos entre dos refrescos
+        """
+        if self.hilo_refresco and self.hilo_refresco.is_alive():
+            return
+
+        self.parar_refresco.clear()
+        self.hilo_refresco = threading.Thread(
+            target=self.refrescar, args=(periodo,))
+        self.hilo_refresco.daemon = True
+        self.hilo_refresco.start()
+
+    def refrescar(self, periodo):
+        """Hilo de refresco de la cache de usuarios
+        ARGS:
+            periodo: segundos entre dos refrescos
+        """
+        while not self.parar_refresco.wait(periodo):
+            try:
+                self.list_users()
+            except OSError as e:
+                # El socket está cerrado o se ha caido la conexión. Se vuelve a
+                # intentar en el siguiente periodo
+                if self.debug:
+                    print("Error refrescando la lista de usuarios: %s" % str(e))
 
     def quit(self) -> None:
+        self.parar_refresco.set()
 
         try:
-            self.socket.send("QUIT".encode('utf-8'))
-            response = self.socket.revc(1024)
-            self.socket.close()
+            with self.lock:
+                self.enviar(["QUIT"])
+                self.socket.close()
         except:
             pass
@@ -13,12 +13,31 @@ from typing import List
 import re
 from src.server import Server
 from src.user import User
+from src.fragment import fragmentar, es_fragmento, Reensamblador
+from src.header import VERSION_ASCII, empaquetar, desempaquetar
+from src.jitter import JitterBuffer
+from src.decoder import DecodificadorVideo
+from src.ratecontrol import Estimador, ControlTasa, es_informe
+from src.sendqueue import ColaEnvio
+from src.batchio import LectorLotes, enviar_lote
+from src.fec import generar_paridades, redundancia_para, es_paridad
 
 
 class UDPControl():
-    def __init__(self, gui, port=6000):
+    def __init__(self, gui, port=6000, retardo_jitter=0.1, lotes=True, fec=True,
+                 salida_video=None):
         """Inicializa la instancia de la clase de control del flujo de video
-        por UDP. Crea los dos sockets udp y la cola de envio
+        por UDP. Crea los dos sockets udp, la cola de envio y el buffer de jitter
+        ARGS:
+            gui: instancia de la gui de la aplicación
+            port: puerto UDP por defecto en el que se recibe el video
+            retardo_jitter: segundos que se retienen los frames recibidos antes de mostrarlos
+            lotes: si es True se leen los datagramas por lotes sobre buffers reservados;
+            si es False se usa un recvfrom por datagrama
+            fec: si es True se envian paquetes de paridad en V1. La cantidad se
+            ajusta según las perdidas que informa el otro extremo
+            salida_video: función opcional que recibe el InfoFrame y la imagen de
+            cada frame decodificado en lugar de mostrarlo en la GUI
         """
         self.udp_port_dest = None
         self.addr_dest = None
@@ -27,6 +46,8 @@ class UDPControl():
                                        socket.SOCK_DGRAM)  # UDP
         self.socket_in.setblocking(False)
         self.socket_in.settimeout(0.2)
+        # Buffer de recepción grande para aguantar las rafagas de fragmentos
+        self.socket_in.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
 
         while port < 65535:
             try:
@@ -44,70 +65,186 @@ class UDPControl():
         self.socket_out = socket.socket(socket.AF_INET,  # Internet
                                         socket.SOCK_DGRAM)  # UDP
 
+        self.lector = LectorLotes(self.socket_in) if lotes else None
+
         self.sending_video = False
         self.frame_count = 0
+        # Frames que no se han podido enviar, por ejemplo frames V0 que no
+        # caben en un datagrama UDP (más de 65507 bytes)
+        self.frames_no_enviados = 0
         self.fps = 30
+        # Versión del protocolo de video negociada con el otro extremo
+        self.version = VERSION_ASCII
         self.stop_threads = False
 
-        self.queue_in = queue.Queue()
+        self.queue_in = ColaEnvio()
+        self.reensamblador = Reensamblador()
+        self.jitter = JitterBuffer(retardo_jitter)
+        self.decoder = None
+        self.hilos = []
+        self.salida_video = salida_video
+
+        # Control de tasa: el estimador mide lo que recibimos y el controlador
+        # ajusta lo que enviamos según los informes del otro extremo
+        self.estimador = Estimador()
+        self.tasa = ControlTasa()
+        self.fec = fec
+
+        # Contadores del reensamblador en el último informe enviado
+        self.ultimos_recibidos = 0
+        self.ultimos_esperados = 0
 
     def empezar_videollamada(self):
-        """ Crea los dos hilos de recepción y envio de video
+        """ Crea los hilos de envio, recepción y reproducción de video y el
+        pool de hilos de decodificación
         """
-        t = threading.Thread(target=self.send_videmy_addro)
-        t.daemon = True
-        t.start()
-        t = threading.Thread(target=self.recive_video)
-        t.daemon = True
-        t.start()
+        self.decoder = DecodificadorVideo(self.gui, salida=self.salida_video)
+        self.hilos = []
+        for funcion in (self.send_videmy_addro, self.recive_video,
+                        self.reproducir_video):
+            t = threading.Thread(target=funcion)
+            t.daemon = True
+            t.start()
+            self.hilos.append(t)
+
+    def parar(self):
+        """ Para los hilos de la videollamada y espera a que terminen, incluidos
+        los de decodificación
+        """
+        self.stop_threads = True
+        for t in self.hilos:
+            if t is not threading.current_thread():
+                t.join()
+        if self.decoder:
+            self.decoder.close()
 
     def send_videmy_addro(self):
-        """ Hilo que se encarga de enviar video. Coge un frame de la cola de envio
-        y lo envia por el socket UDP
+        """ Hilo que se encarga de enviar video. Coge un frame de la cola de envio,
+        le añade la cabecera de la versión negociada y lo envia por el socket UDP.
+        En V1 el frame se divide en fragmentos del tamaño de la MTU; en V0 se envia
+        en un solo datagrama para ser compatible con el resto de clientes
         """
         while True:
             try:
-                img = self.queue_in.get(timeout=0.2)
+                timestamp, width, height, img = self.queue_in.get(timeout=0.2)
                 self.frame_count += 1
-                timestamp = str(time.time())
-                MESSAGE = str(self.frame_count)+"#"+timestamp + \
-                    "#"+"640x480"+"#"+str(self.fps)+"#"
-                MESSAGE = MESSAGE.encode("utf-8") + img
-
-                self.socket_out.sendto(
-                    MESSAGE, (self.addr_dest, self.udp_port_dest))
-
-            except:
+                fps = self.tasa.parametros()[2]
+                cabecera = empaquetar(self.version, self.frame_count, timestamp,
+                                      width, height, fps)
+                destino = (self.addr_dest, self.udp_port_dest)
+
+                if self.version == VERSION_ASCII:
+                    datagramas = [[cabecera, img]]
+                else:
+                    datagramas = fragmentar(self.frame_count, cabecera + img)
+                    if self.fec:
+                        k = redundancia_para(self.tasa.perdidas_red)
+                        datagramas += generar_paridades(
+                            self.frame_count, [d[1] for d in datagramas], k)
+
+                enviar_lote(self.socket_out, destino, datagramas)
+
+            except queue.Empty:
                 pass
+            except (OSError, ValueError):
+                self.frames_no_enviados += 1
+            except Exception as e:
+                # Un error inesperado no puede dejar la llamada sin video: se
+                # descarta el frame y se sigue con el siguiente
+                self.frames_no_enviados += 1
+                print("Error enviando frame de video: %r" % e)
 
             # Como es no bloqueante podemos acabar los hilos
             if self.stop_threads:
                 return
 
     def recive_video(self):
-        """ Hilo que se encarga de recibir video. Lee un datagrama del socket UDP
-        lo descomprime y lo muestra en la aplicación
+        """ Hilo que se encarga de recibir video. Lee del socket UDP todos los
+        datagramas disponibles y los procesa
         """
 
         while True:
             try:
-                data, _ = self.socket_in.recvfrom(80000)
-                img = data.split(b"#", 4)[4]
-
-                # Descompresión de los datos, una vez recibidos
-                decimg = cv2.imdecode(np.frombuffer(img, np.uint8), 1)
-                frame_compuesto = decimg
+                if self.lector:
+                    lote = self.lector.leer(timeout=0.2)
+                else:
+                    lote = [self.socket_in.recvfrom(65535)[0]]
 
-                # Conversión de formato para su uso en el GUI
-                cv2_im = cv2.cvtColor(frame_compuesto, cv2.COLOR_BGR2RGB)
-                img_tk = ImageTk.PhotoImage(Image.fromarray(cv2_im))
-
-                # Lo mostramos en el GUI
-                self.gui.app.setImageSize("video", 640, 360)
-                self.gui.app.setImageData("video", img_tk, fmt='PhotoImage')
+                for datagrama in lote:
+                    self.procesar_datagrama(datagrama)
 
             except socket.timeout:
                 pass
 
             if self.stop_threads:
                 return
+
+    def procesar_datagrama(self, datagrama):
+        """ Reensambla los fragmentos, usando las paridades si hace falta, y mete
+        los frames completos en el buffer de jitter. Los informes del otro
+        extremo se pasan al control de tasa
+        ARGS:
+            datagrama: datagrama recibido. Puede apuntar a un buffer que se
+            reutiliza, asi que no se guarda sin copiarlo
+        """
+        if es_informe(datagrama):
+            self.tasa.informe(datagrama)
+            return
+        elif es_fragmento(datagrama) or es_paridad(datagrama):
+            frame = self.reensamblador.add(datagrama)
+            if frame is None:
+                return
+            data = frame[1]
+        else:
+            # Datagrama V0, contiene el frame entero
+            data = bytes(datagrama)
+
+        frame = desempaquetar(data)
+        if frame is not None:
+            self.estimador.frame_recibido(frame[0])
+            self.jitter.push(*frame)
+
+    def reproducir_video(self):
+        """ Hilo que saca los frames del buffer de jitter cuando les toca
+        reproducirse y los pasa al pool de decodificación. Cada segundo actualiza
+        las estadisticas del buffer en la barra de estado y, si el otro extremo
+        usa V1, le manda un informe de recepción
+        """
+        ultimo_informe = time.time()
+
+        while True:
+            frame = self.jitter.pop(timeout=0.2)
+            if frame is not None:
+                self.decoder.submit(*frame)
+
+            if time.time() - ultimo_informe > 1:
+                ultimo_informe = time.time()
+                self.enviar_informe()
+                stats = self.jitter.estadisticas()
+                stats.update(self.decoder.estadisticas())
+                self.gui.app.setStatusbar(
+                    "Buffer: {profundidad} Tardios: {tardios} Perdidos: {perdidos} "
+                    "Descartados: {descartados}".format(**stats), field=1)
+
+            if self.stop_threads:
+                self.decoder.close()
+                return
+
+    def enviar_informe(self):
+        """ Manda al otro extremo las estadisticas de recepción para que ajuste
+        la calidad del video. Los clientes V0 no entienden los informes
+        """
+        if self.version == VERSION_ASCII:
+            return
+
+        # Perdidas de fragmentos desde el último informe, antes de aplicar FEC
+        recibidos = self.reensamblador.fragmentos_recibidos - self.ultimos_recibidos
+        esperados = self.reensamblador.fragmentos_esperados - self.ultimos_esperados
+        self.ultimos_recibidos = self.reensamblador.fragmentos_recibidos
+        self.ultimos_esperados = self.reensamblador.fragmentos_esperados
+        perdidas_red = max(0, esperados - recibidos) / esperados if esperados else 0.0
+
+        datagrama = self.estimador.informe(perdidas_red)
+        if datagrama is not None:
+            self.socket_out.sendto(
+                datagrama, (self.addr_dest, self.udp_port_dest))
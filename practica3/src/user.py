@@ -9,7 +9,7 @@ import os
 class User():
     filename = 'user.json'
 
-    def __init__(self, name, ip, port: int, creation_timestamp=None, password=None):
+    def __init__(self, name, ip, port: int, creation_timestamp=None, password=None, protocols=None):
         """ Crea una nueva instancia de la clase User
         ARGS:
             name: nickname del usuario
@@ -17,12 +17,14 @@ class User():
             port: puerto TCP en el que el usuario escucha 
             creation_timestamp: epoch de la creación del usuario
             password: contraseña del usuario
+            protocols: lista de versiones del protocolo de video que soporta
         """
         self.name = name
         self.ip = ip
         self.port = port
         self.password = password
         self.creation_timestamp = creation_timestamp
+        self.protocols = protocols
 
     def __str__(self):
         """Devuelve una cadena formateada con los datos del usuario
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Modulo con la cache de usuarios del servidor de descubrimiento. Guarda el
+último User conocido de cada nick durante un tiempo para no tener que
+preguntar al servidor en cada llamada.
+"""
+import threading
+import time
+
+
+class CacheUsuarios():
+    def __init__(self, ttl=60):
+        """ Crea una cache vacia
+        ARGS:
+            ttl: segundos que se considera valida una entrada
+        """
+        self.ttl = ttl
+        self.entradas = {}
+        self.lock = threading.Lock()
+
+        # Estadisticas
+        self.aciertos = 0
+        self.fallos = 0
+        self.caducados = 0
+
+    def get(self, nick, con_protocolos=False):
+        """ Devuelve el User guardado para un nick o None si no está o ha caducado
+        ARGS:
+            nick: nick del usuario
+            con_protocolos: solo acepta entradas en las que se conocen las
+            versiones del protocolo de video del usuario
+        """
+        with self.lock:
+            entrada = self.entradas.get(nick)
+            if entrada is None:
+                self.fallos += 1
+                return None
+
+            user, instante = entrada
+            if time.monotonic() - instante > self.ttl:
+                self.caducados += 1
+                return None
+            if con_protocolos and user.protocols is None:
+                self.fallos += 1
+                return None
+
+            self.aciertos += 1
+            return user
+
+    def put(self, user):
+        """ Guarda o refresca la entrada de un usuario. Si el usuario sigue en la
+        misma dirección se conservan las versiones que ya se conocian, porque
+        LIST_USERS no las devuelve
+        ARGS:
+            user: instancia de User
+        """
+        with self.lock:
+            entrada = self.entradas.get(user.name)
+            if entrada is not None and user.protocols is None:
+                anterior = entrada[0]
+                if anterior.ip == user.ip and anterior.port == user.port:
+                    user.protocols = anterior.protocols
+            self.entradas[user.name] = (user, time.monotonic())
+
+    def remove(self, nick):
+        """ Quita un usuario de la cache
+        ARGS:
+            nick: nick del usuario
+        """
+        with self.lock:
+            self.entradas.pop(nick, None)
+
+    def limpiar(self):
+        """ Quita las entradas caducadas
+        """
+        limite = time.monotonic() - self.ttl
+        with self.lock:
+            for nick in [n for n, (_, t) in self.entradas.items() if t < limite]:
+                del self.entradas[nick]
+
+    def estadisticas(self):
+        """ Devuelve un diccionario con el número de entradas, aciertos, fallos
+        y consultas que han encontrado una entrada caducada
+        """
+        with self.lock:
+            return {
+                'entradas': len(self.entradas),
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+                'caducados': self.caducados,
+            }
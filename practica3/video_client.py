@@ -14,27 +14,51 @@ from src.server import Server
 from src.user import User
 from src.control import Control
 from src.udp import UDPControl
+from src.header import VERSIONES, negociar_version
+from src.capture import Captura
 import netifaces
 
 
-SERVER_NAME = 'vega.ii.uam.es'
-SERVER_PORT = 8000
+# Se puede usar otro servidor, por ejemplo el local de src/discovery.py, con
+# las variables de entorno SERVER_NAME y SERVER_PORT
+SERVER_NAME = os.environ.get('SERVER_NAME', 'vega.ii.uam.es')
+SERVER_PORT = int(os.environ.get('SERVER_PORT', 8000))
+
+# El servidor de la práctica no separa las peticiones, asi que se mandan de
+# una en una. Con un servidor que las termina en salto de linea, como el
+# local, se pueden mandar varias seguidas (SERVER_PIPELINE=1)
+SERVER_PIPELINE = os.environ.get('SERVER_PIPELINE') == '1'
+
+# Segundos entre dos refrescos de la cache de usuarios del servidor
+REFRESCO_USUARIOS = 30
+
+# Muestra una vista previa de la propia cámara durante la llamada. Cada frame
+# de la vista previa tiene que pasar por el hilo de la GUI
+PREVIEW_LOCAL = False
 
 class VideoClient(object):
 
     def __init__(self, window_size, user_file=None):
         # Creamos una variable que contenga el GUI principal
         self.app = gui("Redes2 - P2P", "340x400", handleArgs=False)
+        # appJar ejecuta una función de queueFunction cada EVENT_SPEED ms (100 por
+        # defecto). Los callbacks de control y los frames de video llegan a la gui
+        # por esa cola, asi que la vaciamos más rapido
+        self.app.EVENT_SPEED = 5
         self.my_addr = None
         self.sending_video = False
         self.video_path = None
+        self.captura = None
+        self.preview_pendiente = False
+        self.ultimo_preview = None
 
         # Creamos la interfaz, intentamos obtener la IP
         self.crear_gui()
 
         try:
             self.server = Server(
-                self.my_addr, SERVER_NAME, SERVER_PORT, debug=True)
+                self.my_addr, SERVER_NAME, SERVER_PORT, protocols=VERSIONES, debug=True,
+                pipeline=SERVER_PIPELINE)
         except Exception as e:
             self.app.errorBox("Connection Error", str(e))
             self.app.stop()
@@ -58,6 +82,7 @@ class VideoClient(object):
             if self.user:
                 # Si todo va bien, iniciamos sesion automaticamente
                 self.user.save_to_file()
+                self.server.empezar_refresco(REFRESCO_USUARIOS)
                 self.cambiar_estado("Default")
                 self.app.setStatusbar("User: %s" % self.user.name, field=0)
 
@@ -69,10 +94,6 @@ class VideoClient(object):
             # Si no se carga, mostramos el login
             self.cambiar_estado("Registro")
 
-        # Cada 33 ms ejecutamos capturaVideo = 33 fps
-        self.app.setPollTime(33)
-        self.app.registerEvent(self.capturaVideo)
-
         self.sending_video = False
         self.use_webcam = True
 
@@ -87,6 +108,10 @@ class VideoClient(object):
             "LLamada Entrante", "Llamada entrante de {}. Aceptar?".format(self.control.src_nick))
         if response == "yes":
             self.udp_control = UDPControl(self)
+            # Consultamos al servidor las versiones que soporta el otro extremo
+            caller = self.server.query(self.control.src_nick)
+            self.udp_control.version = negociar_version(
+                caller.protocols if caller else None)
             self.control.call_accepted(self.user.name, self.udp_control.port)
             self.udp_control.udp_port_dest = udp_port_dest
             self.udp_control.addr_dest = addr_dest
@@ -97,7 +122,7 @@ class VideoClient(object):
 
             self.cap = cv2.VideoCapture(0)
             self.sending_video = True
-            self.app.setPollTime(33)
+            self.empezar_captura()
 
         else:
             self.control.call_denied()
@@ -122,7 +147,7 @@ class VideoClient(object):
             self.sending_video = True
             self.udp_control.stop_threads = False
             self.udp_control.empezar_videollamada()
-            self.app.setPollTime(33)
+            self.empezar_captura()
             self.app.infoBox("Llamada aceptada", "A conversar!!")
 
         else:
@@ -143,7 +168,7 @@ class VideoClient(object):
         """ Callback que se invoca cuando el otro extremo quiere pausar la llamada
         """
         self.sending_video = False
-        self.udp_control.queue_in.queue.clear()
+        self.udp_control.queue_in.clear()
 
     def callback_call_busy(self, nick):
         """Callback que se invoca cuando se recibe una llamada mientras ya hay una
@@ -235,6 +260,9 @@ class VideoClient(object):
         self.app.startFrame("RIGHT", row=0, column=1)
         self.app.addLabel("title", "Cliente Multimedia P2P - Redes2 ")
         self.app.addImage("video", "imgs/webcam.gif")
+        if PREVIEW_LOCAL:
+            self.app.addImage("preview", "imgs/webcam.gif")
+            self.app.setImageSize("preview", 128, 96)
 
         self.app.startFrame("BotonesDefault")
         self.app.addButtons(["Conectar", "Conectar con usuario seleccionado"], [
@@ -305,6 +333,7 @@ class VideoClient(object):
         if user:
             user.save_to_file()
             self.cambiar_estado("Default")
+            self.server.empezar_refresco(REFRESCO_USUARIOS)
             self.user = user
             self.app.setStatusbar("User: %s" % self.user.name, field=0)
         else:
@@ -357,6 +386,7 @@ class VideoClient(object):
         else:
 
             user = self.server.query(nick)
+            self.mostrar_cache()
 
             if not user:
                 self.app.errorBox("Usuario no encontraro",
@@ -364,6 +394,7 @@ class VideoClient(object):
                 return
 
             self.udp_control = UDPControl(self)
+            self.udp_control.version = negociar_version(user.protocols)
             self.user.udpport = self.udp_control.listen_port
 
             if self.use_webcam:
@@ -406,7 +437,7 @@ class VideoClient(object):
         """
         self.control.call_hold()
         self.sending_video = False
-        self.udp_control.queue_in.queue.clear()
+        self.udp_control.queue_in.clear()
 
     def reanudar(self, btn=None):
         """ Manda el mensaje CALL_RESUME al otro extremo de la llamada
@@ -427,7 +458,7 @@ class VideoClient(object):
         """
         self.control.call_end(self.user.name)
         self.sending_video = False
-        self.cap.release()
+        self.parar_captura()
         self.udp_control.stop_threads = True
         self.app.setImage("video", "imgs/webcam.gif")
         self.app.showFrame("BotonesDefault")
@@ -438,7 +469,7 @@ class VideoClient(object):
         parte del otro extremo de la llamada actual
         """
         self.sending_video = False
-        self.cap.release()
+        self.parar_captura()
         self.udp_control.stop_threads = True
         self.app.setImage("video", "imgs/webcam.gif")
         self.app.showFrame("BotonesDefault")
@@ -451,6 +482,7 @@ class VideoClient(object):
             button = nombre del boton que ha provocado la llamada de esta función
         """
         users = self.server.list_users()
+        self.mostrar_cache()
 
         if users:
             users = sorted(users, key=lambda x: x.name.lower())
@@ -462,6 +494,14 @@ class VideoClient(object):
         else:
             pass
 
+    def mostrar_cache(self):
+        """ Muestra en la barra de estado los contadores de la cache de usuarios.
+        Durante la llamada este campo lo usa UDPControl para las estadisticas del video
+        """
+        self.app.setStatusbar(
+            "Cache: {aciertos} aciertos, {fallos} fallos, "
+            "{caducados} caducados".format(**self.server.cache.estadisticas()), field=1)
+
     def quit(self, btn=None):
         self.control.exit()
         return True
@@ -469,30 +509,44 @@ class VideoClient(object):
     def start(self):
         self.app.go()
 
-    def capturaVideo(self):
-        """ Funcion que se ejecura 30 veces por segundo encargada de 
-        capturar fotogramas de la webcam o de un fichero video, comprimirlas
-        a JPG y añadirlas a la cola de envio
-
+    def empezar_captura(self):
+        """ Arranca el hilo que captura, comprime y encola los frames de la
+        fuente de video seleccionada
         """
+        self.captura = Captura(self.cap, self.udp_control,
+                               lambda: self.sending_video,
+                               fps=self.udp_control.fps,
+                               preview=self.actualizar_preview if PREVIEW_LOCAL else None,
+                               tasa=self.udp_control.tasa)
+        self.captura.start()
+
+    def parar_captura(self):
+        """ Para el hilo de captura y libera la fuente de video
+        """
+        if self.captura:
+            self.captura.stop()
+            self.captura = None
+        self.cap.release()
 
-        if self.sending_video:
-            # Capturamos un frame de la cámara o del vídeo
-            ret, frame = self.cap.read()
-
-            self.last_frame_small = cv2.resize(frame, (128, 96))
-            cv2_im = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            img_tk = ImageTk.PhotoImage(Image.fromarray(cv2_im))
-
-            # Compresión JPG al 50% de resolución (se puede variar)
-            encode_param = [cv2.IMWRITE_JPEG_QUALITY, 50]
-            result, encimg = cv2.imencode('.jpg', frame, encode_param)
-
-            if result == False:
-                print('Error al codificar imagen')
-            encimg = encimg.tobytes()
-            # Añadimos a lacola
-            self.udp_control.queue_in.put(encimg)
+    def actualizar_preview(self, frame):
+        """ Callback que invoca el hilo de captura con cada frame reducido. Solo
+        se pide a la GUI que lo muestre si no tiene ya uno pendiente
+        ARGS:
+            frame: frame reducido en formato BGR
+        """
+        self.ultimo_preview = frame
+        if not self.preview_pendiente:
+            self.preview_pendiente = True
+            self.app.queueFunction(self.mostrar_preview)
+
+    def mostrar_preview(self):
+        """ Muestra el último frame de la vista previa. Se ejecuta en el hilo
+        de la GUI
+        """
+        self.preview_pendiente = False
+        cv2_im = cv2.cvtColor(self.ultimo_preview, cv2.COLOR_BGR2RGB)
+        img_tk = ImageTk.PhotoImage(Image.fromarray(cv2_im))
+        self.app.setImageData("preview", img_tk, fmt='PhotoImage')
 
 
 if __name__ == '__main__':